@@ -0,0 +1,15 @@
+__author__ = 'aloysio'
+
+from korova.models import Book
+
+
+class SetActiveBookMiddleware(object):
+    """
+    Resolves the session's active book once per request and exposes it as request.active_book.
+    Later calls to Book.get_active_book(request) reuse the same instance.
+    """
+
+    def process_request(self, request):
+        request.active_book = None
+        if hasattr(request, 'session'):
+            request.active_book = Book.get_active_book(request)
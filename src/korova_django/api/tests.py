@@ -1,3 +1,518 @@
-from django.test import TestCase
+from django.test import LiveServerTestCase, TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+from korova.models import *
+from korova.currencies import currencies
+from korova.loadtest import SCENARIOS, LoadTest, percentile
+from korova.profiling import list_captures, load_capture, slowest_queries, top_functions
+from unittest import skipUnless
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+brl = currencies['BRL']
+
 
 # Create your tests here.
+class KorovaApiFixture(object):
+
+    def setUp(self):
+        user = User.objects.create_user('api_test', 'api_test@test.com', 'abc123')
+        self.profile = Profile.create(brl, "API Test Profile", user)
+        self.book = self.profile.create_book(code="A01", name="A01", start=timezone.now())
+        self.group = self.book.create_top_level_group(name='API Group', code='AG01')
+        self.asset = self.group.create_account('A01', 'cash', brl, 'ASSET')
+        self.liability = self.group.create_account('A02', 'loan', brl, 'LIABILITY')
+        self.client.login(username='api_test', password='abc123')
+        session = self.client.session
+        session['book_id'] = self.book.pk
+        session.save()
+
+    def get_content(self, url, data=None, **extra):
+        response = self.client.get(url, data or {}, **extra)
+        self.assertEqual(response.status_code, 200)
+        return ''.join(response.streaming_content) if response.streaming else response.content
+
+    def post_json(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type='application/json')
+
+    def make_transaction(self, date, amount, description='API transaction'):
+        return {'creation_date': date, 'description': description,
+                'splits': [{'account': self.liability.pk, 'account_amount': amount, 'split_type': 'CREDIT'},
+                           {'account': self.asset.pk, 'account_amount': amount, 'split_type': 'DEBIT'}]}
+
+
+class KorovaApiTestCase(KorovaApiFixture, TestCase):
+    pass
+
+
+class KorovaBatchTransactionTests(KorovaApiTestCase):
+
+    def test_batch_is_posted_and_results_keep_request_order(self):
+        response = self.post_json('/api/transaction/batch/', {'transactions': [
+            self.make_transaction('2014-02-01T10:00:00', 30, 'second'),
+            self.make_transaction('2014-01-01T10:00:00', 70, 'first'),
+        ]})
+        self.assertEqual(response.status_code, 201)
+        results = json.loads(response.content)['results']
+        self.assertEqual([r['transaction']['description'] for r in results], ['second', 'first'])
+        self.assertEqual(self.asset.get_balances(), (100, 100))
+
+    def test_all_or_nothing_batch_is_rolled_back(self):
+        bad = self.make_transaction('2014-01-02', 10)
+        bad['splits'][1]['account_amount'] = 20
+        response = self.post_json('/api/transaction/batch/', {'transactions': [
+            self.make_transaction('2014-01-01', 30), bad]})
+        self.assertEqual(response.status_code, 400)
+        results = json.loads(response.content)['results']
+        self.assertEqual([r['status'] for r in results], ['rolled_back', 'error'])
+        self.assertEqual(Transaction.objects.count(), 0)
+        self.assertEqual(self.asset.get_balances(), (0, 0))
+
+    def test_best_effort_batch_skips_failed_transactions(self):
+        bad = self.make_transaction('2014-01-02', 10)
+        bad['splits'][0]['account'] = 0
+        response = self.post_json('/api/transaction/batch/', {'mode': 'best_effort', 'transactions': [
+            self.make_transaction('2014-01-01', 30), bad, 'not a transaction', self.make_transaction('2014-01-03', 5)]})
+        self.assertEqual(response.status_code, 201)
+        results = json.loads(response.content)['results']
+        self.assertEqual([r['status'] for r in results], ['created', 'error', 'error', 'created'])
+        self.assertEqual(results[2]['error'], 'Transaction must be an object')
+        self.assertEqual(self.asset.get_balances(), (35, 35))
+
+
+class KorovaVoidTransactionTests(KorovaApiTestCase):
+
+    def test_void_and_reverse(self):
+        posted = [Transaction.objects.get(pk=json.loads(self.post_json('/api/transaction/', data).content)['id'])
+                  for data in (self.make_transaction('2014-01-01', 100), self.make_transaction('2014-02-01', 30))]
+        repay = self.make_transaction('2014-03-01', 50, 'repay')
+        repay['splits'][0]['split_type'], repay['splits'][1]['split_type'] = 'DEBIT', 'CREDIT'
+        repaid = json.loads(self.post_json('/api/transaction/', repay).content)['id']
+
+        response = self.post_json('/api/transaction/%d/void/' % posted[1].pk, {})
+        self.assertEqual(json.loads(response.content), {'status': 'voided', 'id': posted[1].pk})
+        self.assertEqual(self.asset.get_balances(), (50, 50))
+        self.assertEqual(self.liability.get_balances(), (50, 50))
+        self.assertEqual(self.post_json('/api/transaction/%d/void/' % posted[1].pk, {}).status_code, 404)
+
+        self.book.end = date(2014, 12, 31)
+        self.book.save()
+        self.assertEqual(self.post_json('/api/transaction/%d/void/' % repaid, {}).status_code, 400)
+        self.assertEqual(self.post_json('/api/transaction/%d/void/' % repaid,
+                                        {'mode': 'reverse', 'date': '2015-02-30'}).status_code, 400)
+        response = self.post_json('/api/transaction/%d/void/' % repaid, {'mode': 'reverse', 'date': '2015-01-01'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.content)['transaction']['description'], 'Reversal of repay')
+        self.assertEqual(self.asset.get_balances(), (100, 100))
+
+
+class KorovaTransactionSearchTests(KorovaApiTestCase):
+
+    def search(self, **params):
+        response = self.client.get('/api/transaction/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_search_ranks_and_filters_by_date(self):
+        self.post_json('/api/transaction/batch/', {'transactions': [
+            self.make_transaction('2014-01-01', 10, u'Supplier ACME invoice'),
+            self.make_transaction('2014-02-01', 20, u'ACME acme refund'),
+            self.make_transaction('2014-03-01', 30, u'Payment to supplier Ac\xe9me'),
+        ]})
+
+        data = self.search(q='acme')
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['results'][0]['description'], 'ACME acme refund')
+
+        data = self.search(q='supplier acme', start='2014-01-15')
+        self.assertEqual(data['count'], 0)
+
+        data = self.search(q='cash supplier', page_size=1, page=2)
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['results'][0]['description'], 'Supplier ACME invoice')
+
+
+class KorovaConditionalGetTests(KorovaApiTestCase):
+
+    def test_accounts_answer_304_until_the_book_changes(self):
+        response = self.client.get('/api/accounts/')
+        etag = response['ETag']
+
+        with self.assertNumQueries(3):  # session, user and book version
+            response = self.client.get('/api/accounts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.post_json('/api/transaction/batch/', {'transactions': [self.make_transaction('2014-01-01', 10)]})
+        response = self.client.get('/api/accounts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_books_etag_changes_with_chart_edits(self):
+        etag = self.client.get('/api/books/')['ETag']
+        self.assertEqual(self.client.get('/api/books/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.group.create_child('Child', 'AG02')
+        self.assertEqual(self.client.get('/api/books/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_session_book_etag(self):
+        etag = self.client.get('/api/get_session_book/')['ETag']
+        self.assertEqual(self.client.get('/api/get_session_book/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class KorovaArchiveTests(KorovaApiTestCase):
+
+    def test_archived_transactions_are_listed_transparently(self):
+        from korova.archive import archive_book
+        from korova.verification import LedgerVerification
+        self.post_json('/api/transaction/batch/', {'transactions': [
+            self.make_transaction('2014-01-01', 10, 'first'),
+            self.make_transaction('2014-02-01', 20, 'second'),
+        ]})
+        self.book.end = date(2014, 12, 31)
+        self.book.save()
+
+        self.assertEqual(archive_book(self.book), 2)
+        self.assertEqual(Transaction.objects.count(), 0)
+        self.assertEqual(ArchiveSummary.objects.get(account=self.asset).account_amount, 30)
+        self.assertEqual(self.asset.get_balances(), (30, 30))
+        self.assertTrue(LedgerVerification(self.book, full=True).run().is_valid())
+
+        data = json.loads(self.get_content('/api/transaction/'))
+        self.assertEqual([t['description'] for t in data], ['first', 'second'])
+        self.assertEqual(sorted(s['account'] for s in data[0]['splits']), [self.asset.pk, self.liability.pk])
+
+        data = json.loads(self.get_content('/api/transaction/', {'start': '2015-01-01'}))
+        self.assertEqual(data, [])
+        self.assertEqual(self.client.get('/api/transaction/', {'end': '2015-02-30'}).status_code, 400)
+
+        # an archived book can't be posted to, the hot rows a listing merges are written directly
+        response = self.post_json('/api/transaction/', self.make_transaction('2014-01-15T10:00:00', 5, 'hot'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Transaction.objects.count(), 0)
+        hot = Transaction.objects.create(description='hot', creation_date=timezone.now(),
+                                         transaction_date=parse_transaction_date('2014-01-15T10:00:00'))
+        Split.objects.create(transaction=hot, account=self.liability, account_amount=5, profile_amount=5,
+                             split_type='CREDIT', is_linked=True)
+        Split.objects.create(transaction=hot, account=self.asset, account_amount=5, profile_amount=5,
+                             split_type='DEBIT', is_linked=True)
+        fast = self.get_content('/api/transaction/')
+        archived = self.get_content('/api/transaction/', HTTP_ACCEPT='application/json; indent=0')
+        self.assertEqual([t['description'] for t in json.loads(fast)], ['first', 'hot', 'second'])
+        self.assertEqual(json.loads(fast), json.loads(archived))
+        # archived and hot splits render the same keys, in the same order
+        first, hot = json.loads(fast, object_pairs_hook=OrderedDict)[:2]
+        self.assertEqual(list(first['splits'][0]), list(hot['splits'][0]))
+        self.assertTrue(first['splits'][0]['is_linked'])
+
+
+class KorovaTransactionListTests(KorovaApiTestCase):
+
+    def test_streamed_list_matches_the_serializers(self):
+        from api.rows import TransactionRows
+        from api.views import TransactionSerializer
+        from rest_framework.renderers import JSONRenderer
+        self.post_json('/api/transaction/batch/', {'transactions': [
+            self.make_transaction('2014-01-01T10:00:00.123456', '10.25', u'caf\xe9 "quoted"'),
+            self.make_transaction('2014-02-01', 20, 'second'),
+            self.make_transaction('2014-03-01', 30, 'third'),
+        ]})
+        Transaction.objects.create(description='no splits', creation_date=timezone.now(), transaction_date=timezone.now())
+
+        expected = JSONRenderer().render(TransactionSerializer(Transaction.objects.order_by('pk'), many=True).data)
+        self.assertEqual(self.get_content('/api/transaction/'), expected)
+        # datetimes keep the renderer's milliseconds
+        self.assertIn(':00:00.123Z"', expected)
+        self.assertEqual(self.get_content('/api/transaction/', {'start': '2014-02-01'}),
+                         JSONRenderer().render(TransactionSerializer(
+                             Transaction.objects.exclude(description__startswith='caf').order_by('pk'), many=True).data))
+
+        # one query per chunk of transactions, keyed on the last one read, and one for their splits
+        rows = TransactionRows(Transaction, Split)
+        rows.chunk_size = 2
+        with self.assertNumQueries(5):
+            ids = [row[1] for row in rows.rows(Transaction.objects.all())]
+        self.assertEqual(ids, list(Transaction.objects.order_by('pk').values_list('pk', flat=True)))
+        rows.chunk_size = 3
+        self.assertEqual([row[1] for row in rows.rows(Transaction.objects.all(), by_date=True)],
+                         list(Transaction.objects.order_by('transaction_date', 'pk').values_list('pk', flat=True)))
+
+
+class KorovaAccountAutocompleteTests(KorovaApiTestCase):
+
+    def test_accounts_are_completed_by_code_and_name_prefix(self):
+        self.group.create_account('A03', u'Cart\xe3o de cr\xe9dito', brl, 'LIABILITY')
+        self.group.create_account('B01', 'Credit union', brl, 'ASSET')
+
+        data = json.loads(self.client.get('/api/accounts/autocomplete/', {'q': 'cre'}).content)
+        self.assertEqual([a['code'] for a in data], ['A03', 'B01'])
+        data = json.loads(self.client.get('/api/accounts/autocomplete/', {'q': 'a0 cart'}).content)
+        self.assertEqual([a['label'] for a in data], [u'A03 - Cart\xe3o de cr\xe9dito'])
+
+        # the index is cached per book version
+        with self.assertNumQueries(3):  # session, user and book version
+            self.client.get('/api/accounts/autocomplete/', {'q': 'loan'})
+
+
+class KorovaProfilerTests(KorovaApiTestCase):
+
+    def test_requests_with_the_token_are_profiled(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(KOROVA_PROFILE_DIR=directory, KOROVA_PROFILE_TOKEN='secret'):
+                self.client.get('/api/accounts/')
+                self.assertEqual(list_captures(), [])
+                self.client.get('/api/accounts/', HTTP_X_KOROVA_PROFILE='secret')
+                names = list_captures()
+                self.assertEqual(len(names), 1)
+                capture = load_capture(names[0])
+                self.assertEqual((capture['path'], capture['status'], capture['user'], capture['book']),
+                                 ('/api/accounts/', 200, 'api_test', self.book.pk))
+                self.assertTrue(capture['queries'])
+                self.assertTrue(top_functions(capture, 5))
+                self.assertEqual(len(slowest_queries(capture, 1)), 1)
+                self.assertEqual(os.stat(capture['stats_path']).st_mode & 0777, 0600)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_refused_requests_are_profiled_and_nothing_is_without_a_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(KOROVA_PROFILE_DIR=directory, KOROVA_PROFILE_TOKEN='secret'):
+                response = self.client.post('/api/transaction/999999/void/', HTTP_X_KOROVA_PROFILE='secret')
+                self.assertEqual(response.status_code, 404)
+                self.assertEqual(load_capture(list_captures()[0])['status'], response.status_code)
+            with override_settings(KOROVA_PROFILE_DIR=None, KOROVA_PROFILE_TOKEN='secret'):
+                self.client.get('/api/accounts/', HTTP_X_KOROVA_PROFILE='secret')
+                self.assertEqual(list_captures(), [])
+        finally:
+            shutil.rmtree(directory)
+
+
+class KorovaLoadTestTests(KorovaApiFixture, LiveServerTestCase):
+
+    def test_scenario_is_reported_per_endpoint(self):
+        context = {'username': 'api_test', 'password': 'abc123', 'book_id': self.book.pk, 'date': '2014-01-01',
+                   'debit_account': self.asset.pk, 'credit_account': self.liability.pk}
+        report = LoadTest(self.live_server_url, SCENARIOS['post'], context, users=2, concurrency=2).run()
+        self.assertEqual(report['total']['requests'], 16)
+        self.assertEqual(report['total']['errors'], 0)
+        self.assertEqual(report['endpoints']['transaction_create']['requests'], 10)
+        self.assertEqual(self.asset.get_balances(), (10, 10))
+
+        summary = report['endpoints']['accounts_list']
+        self.assertTrue(summary['p50_ms'] <= summary['p95_ms'] <= summary['p99_ms'] <= summary['max_ms'])
+        self.assertEqual(percentile(range(1, 101), 0.95), 95)
+        self.assertEqual(percentile([1, 2], 0.5), 1)
+
+    def test_scenarios_that_post_need_to_be_allowed_to(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from korova.loadtest import scenario_writes
+        self.assertFalse(scenario_writes(SCENARIOS['browse']))
+        self.assertTrue(scenario_writes(SCENARIOS['post']))
+        with self.assertRaises(CommandError):
+            call_command('load_test', self.book.code, scenario='post', username='api_test', password='abc123',
+                         url=self.live_server_url)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+
+class KorovaReportTests(KorovaApiTestCase):
+
+    def test_realized_fx_report_of_the_active_book(self):
+        response = self.client.get('/api/reports/realized_fx/', {'period': 'year', 'start': '2014-01-01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), [])
+        self.assertEqual(self.client.get('/api/reports/realized_fx/', {'period': 'week'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/reports/realized_fx/', {'start': '2014-02-30'}).status_code, 400)
+
+    def test_books_are_consolidated(self):
+        from django.core.cache import cache
+        from korova.consolidation import Consolidation
+        from korova.exceptions import KorovaRateError
+        # ids and versions repeat from test to test
+        cache.clear()
+        usd = currencies['USD']
+        book2 = self.profile.create_book(code="A02", name="A02", start=timezone.now())
+        group2 = book2.create_top_level_group(name='API Group 2', code='BG01')
+        asset2 = group2.create_account('B01', 'cash', brl, 'ASSET')
+        income2 = group2.create_account('B03', 'fees', brl, 'INCOME')
+        user = User.objects.create_user('api_test_usd', 'usd@test.com', 'abc123')
+        book3 = Profile.create(usd, "USD Profile", user).create_book(code="U01", name="U01", start=timezone.now())
+        group3 = book3.create_top_level_group(name='USD Group', code='UG01')
+        asset3 = group3.create_account('U01', 'cash', usd, 'ASSET')
+        liability3 = group3.create_account('U02', 'loan', usd, 'LIABILITY')
+
+        self.post_json('/api/transaction/', self.make_transaction('2014-01-01', 100))
+        Transaction.create(timezone.now(), 'fees', [Split.create(30, income2, 'CREDIT'),
+                                                    Split.create(30, asset2, 'DEBIT')])
+        Transaction.create(timezone.now(), 'loan', [Split.create(10, liability3, 'CREDIT'),
+                                                    Split.create(10, asset3, 'DEBIT')])
+
+        response = self.client.get('/api/reports/consolidated/', {'books': '%s,%s' % (self.book.pk, book2.pk)})
+        report = json.loads(response.content)
+        self.assertEqual(report['currency'], 'BRL')
+        self.assertEqual([(a['code'], a['balance']) for a in report['accounts']],
+                         [('A01', '100.000000'), ('A02', '100.000000'), ('B01', '30.000000'), ('B03', '30.000000')])
+        self.assertEqual(report['profit_loss'], '30.000000')
+        self.assertEqual(self.client.get('/api/reports/consolidated/', {'books': book3.pk}).status_code, 400)
+        self.assertEqual(self.client.get('/api/reports/consolidated/', {'merge': 'type'}).status_code, 400)
+
+        consolidation = Consolidation([self.book, book2, book3], usd, rates={'BRL': '0.5'}, merge_on='name')
+        report = consolidation.run()
+        # the first two books were cached by the request
+        self.assertEqual(consolidation.computed, 1)
+        self.assertEqual([(a['name'], a['balance'], a['books'][book3.pk]) for a in report['accounts'][:2]],
+                         [('cash', Decimal('75'), Decimal('10')), ('loan', Decimal('60'), Decimal('10'))])
+        self.assertEqual(report['profit_loss'], Decimal('15'))
+
+        Transaction.create(timezone.now(), 'loan', [Split.create(5, liability3, 'CREDIT'),
+                                                    Split.create(5, asset3, 'DEBIT')])
+        consolidation = Consolidation([self.book, book2, book3], usd, rates={'BRL': '0.5'}, merge_on='name')
+        self.assertEqual(consolidation.run()['accounts'][0]['balance'], Decimal('80'))
+        self.assertEqual(consolidation.computed, 1)
+
+        # without rates, the ones the ledger stored are used, either way round
+        with self.assertRaises(KorovaRateError):
+            Consolidation([book3], brl).run()
+
+        class TwoReais(object):
+            def get_exchange_rate(self, rate_from, rate_to):
+                return 2
+
+        self.profile.set_exchange_rate_provider(TwoReais())
+        dollars = self.group.create_account('A03', 'dollars', usd, 'ASSET')
+        Transaction.create(timezone.now(), 'buy', [Split.create(200, self.liability, 'CREDIT'),
+                                                   Split.create(100, dollars, 'DEBIT')])
+        self.assertEqual(Consolidation([book3], brl).run()['books'][0]['rate'], Decimal('2'))
+        self.assertEqual(Consolidation([self.book], usd).get_rate('BRL'), Decimal('0.5'))
+
+
+class KorovaBalanceSeriesTests(KorovaApiTestCase):
+
+    def setUp(self):
+        super(KorovaBalanceSeriesTests, self).setUp()
+        self.post_json('/api/transaction/batch/', {'transactions': [
+            self.make_transaction('2013-12-20', 10), self.make_transaction('2014-01-02', 5)]})
+
+    @skipUnless(numpy, 'NumPy is not installed')
+    def test_daily_balances(self):
+        response = self.client.get('/api/accounts/balance_series/', {'group': self.group.pk,
+                                                                     'start': '2014-01-01', 'end': '2014-01-03'})
+        data = json.loads(response.content)
+        self.assertEqual([a['code'] for a in data['accounts']], ['A01', 'A02'])
+        self.assertEqual(data['accounts'][0]['account_balances'], [10, 15, 15])
+        self.assertEqual(data['accounts'][1]['profile_balances'], [10, 15, 15])
+
+    @skipUnless(numpy, 'NumPy is not installed')
+    def test_large_balances_keep_their_cents(self):
+        from korova.timeseries import BalanceSeries
+        self.post_json('/api/transaction/batch/', {'transactions': [
+            self.make_transaction('2014-01-02', '9876543210.01'), self.make_transaction('2014-01-03', '0.02')]})
+        series = BalanceSeries([self.asset], date(2014, 1, 1), date(2014, 1, 3))
+        self.assertEqual(series.account_units[0].tolist(), [10000000, 9876543225010000, 9876543225030000])
+
+    @skipUnless(numpy, 'NumPy is not installed')
+    def test_long_series_are_refused(self):
+        with self.settings(KOROVA_SERIES_MAX_DAYS=31):
+            response = self.client.get('/api/accounts/balance_series/', {'group': self.group.pk,
+                                                                         'start': '2014-01-01', 'end': '2014-02-01'})
+        self.assertEqual(response.status_code, 400)
+
+    @skipUnless(numpy, 'NumPy is not installed')
+    def test_binary_format(self):
+        response = self.client.get('/api/accounts/balance_series/', {'accounts': '%d' % self.asset.pk,
+                                                                     'start': '2014-01-01', 'end': '2014-01-02',
+                                                                     'output': 'binary'})
+        accounts, days, first_day = struct.unpack('<III', response.content[:12])
+        self.assertEqual((accounts, days, first_day), (1, 2, date(2014, 1, 1).toordinal()))
+        self.assertEqual(list(numpy.frombuffer(response.content[20:36], dtype='<f8')), [10, 15])
+
+
+class KorovaBalanceEventTests(KorovaApiFixture, TransactionTestCase):
+    # postings only publish once committed, so these tests can't run inside TestCase's transaction
+
+    class RecordingBroker(object):
+
+        def __init__(self):
+            self.published = []
+
+        def publish(self, book_id, data):
+            self.published.append((book_id, data))
+
+    def setUp(self):
+        from korova import events
+        super(KorovaBalanceEventTests, self).setUp()
+        # the tests running inside TestCase's transaction never flushed what they recorded
+        events.discard()
+        self.addCleanup(events.set_broker, None)
+
+    def test_committed_postings_are_published_once(self):
+        from korova import events
+        broker = self.RecordingBroker()
+        events.set_broker(broker)
+
+        self.post_json('/api/transaction/batch/', {'transactions': [
+            self.make_transaction('2014-01-01', 10), self.make_transaction('2014-01-02', 20)]})
+        self.assertEqual(broker.published, [(self.book.pk, {
+            'version': Book.get_version(self.book.pk),
+            'accounts': [[self.asset.pk, '30.000000', '30.000000'], [self.liability.pk, '30.000000', '30.000000']]})])
+
+        bad = self.make_transaction('2014-01-03', 10)
+        bad['splits'][1]['account_amount'] = 20
+        self.post_json('/api/transaction/batch/', {'transactions': [self.make_transaction('2014-01-03', 5), bad]})
+        self.assertEqual(len(broker.published), 1)
+
+    def test_postings_of_a_rolled_back_outer_transaction_are_not_published(self):
+        from django.db import transaction
+        from korova import events
+        broker = self.RecordingBroker()
+        events.set_broker(broker)
+
+        try:
+            with transaction.atomic():
+                Transaction.create(timezone.now(), 'rolled back', [Split.create(10, self.asset, 'DEBIT'),
+                                                                   Split.create(10, self.liability, 'CREDIT')])
+                raise KorovaError("rolled back")
+        except KorovaError:
+            pass
+        self.assertEqual(broker.published, [])
+
+        # the next request served by the thread starts without them
+        self.client.get('/api/accounts/')
+        events.flush()
+        self.assertEqual(broker.published, [])
+
+    @override_settings(KOROVA_EVENT_STREAM_SECONDS=0.1, KOROVA_EVENT_KEEPALIVE_SECONDS=0.05)
+    def test_stream_resumes_from_the_last_event_id(self):
+        from korova import events
+        broker = events.InProcessBroker()
+        events.set_broker(broker)
+        self.post_json('/api/transaction/batch/', {'transactions': [self.make_transaction('2014-01-01', 10)]})
+
+        response = self.client.get('/api/accounts/events/', HTTP_LAST_EVENT_ID='0')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = ''.join(response.streaming_content)
+        self.assertTrue(body.startswith('retry: 1000\n\nid: 1\nevent: balances\ndata: '))
+        data = json.loads(body.split('data: ')[1].split('\n')[0])
+        self.assertEqual(data['accounts'], [[self.asset.pk, '10.000000', '10.000000'],
+                                            [self.liability.pk, '10.000000', '10.000000']])
+
+        # a new subscriber only gets what is published after it connected
+        body = ''.join(self.client.get('/api/accounts/events/').streaming_content)
+        self.assertNotIn('event: balances', body)
+
+        # an id from another process, or from before a restart, is ahead of this one's: it resumes from now on
+        response = self.client.get('/api/accounts/events/', HTTP_LAST_EVENT_ID='50')
+        self.post_json('/api/transaction/batch/', {'transactions': [self.make_transaction('2014-01-02', 5)]})
+        self.assertIn('id: 2\nevent: balances', ''.join(response.streaming_content))
@@ -16,6 +16,16 @@ urlpatterns = patterns('',
                        url(r'^set_session_book/', 'api.views.set_session_book', name='set_session_book'),
                        url(r'^perform_login/', 'api.views.perform_login', name='perform_login'),
                        url(r'^perform_logout/', 'api.views.perform_logout', name='perform_logout'),
+                       url(r'^transaction/batch/$', 'api.views.create_transactions', name='create_transactions'),
+                       url(r'^transaction/(?P<pk>\d+)/void/$', 'api.views.void_transaction',
+                           name='void_transaction'),
+                       url(r'^transaction/search/$', 'api.views.search_transactions', name='search_transactions'),
+                       url(r'^reports/realized_fx/$', 'api.views.realized_fx_report', name='realized_fx_report'),
+                       url(r'^reports/consolidated/$', 'api.views.consolidated_report', name='consolidated_report'),
+                       url(r'^accounts/balance_series/$', 'api.views.balance_series', name='balance_series'),
+                       url(r'^accounts/autocomplete/$', 'api.views.autocomplete_accounts',
+                           name='autocomplete_accounts'),
+                       url(r'^accounts/events/$', 'api.views.balance_events', name='balance_events'),
                        url(r'^', include(router_transaction.urls)),
                        url(r'^', include(router_accounts.urls)),
                        url(r'^', include(router_books.urls))
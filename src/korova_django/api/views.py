@@ -3,15 +3,46 @@ from rest_framework import viewsets, serializers, status
 from rest_framework.views import  APIView
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
+from rest_framework.renderers import JSONRenderer
 from korova.models import *
 from django.db.models import get_model
 from django.contrib.auth import authenticate, login, logout
 from django.views.generic import View
 from django.views.decorators.csrf import csrf_exempt
+from django.http import HttpResponse, StreamingHttpResponse
+from django.conf import settings
+from api.rows import stream_transactions
+import json
+import time
+from django.views.decorators.http import condition
+from django.utils.decorators import method_decorator
 
 # Create your views here.
 
 
+def active_book_etag(request, *args, **kwargs):
+    """
+    ETag of anything derived from the session's active book: it only changes when the book's version does,
+    and computing it costs a single query on the book table.
+    """
+    if not request.user.is_authenticated():
+        return None
+    book_id = request.session.get('book_id')
+    if book_id is None:
+        return None
+    version = Book.get_version(book_id)
+    if version is None:
+        return None
+    return 'book-%s-%s-%s' % (request.user.pk, book_id, version)
+
+
+def profile_books_etag(request, *args, **kwargs):
+    if not request.user.is_authenticated():
+        return None
+    versions = Book.objects.filter(profile__user=request.user).order_by('pk').values_list('pk', 'version')
+    return 'books-%s-%s' % (request.user.pk, '-'.join('%s.%s' % v for v in versions))
+
+
 class BookSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -51,6 +82,7 @@ def perform_logout(request):
     return Response({'info': 'successful logout'})
 
 @api_view(['GET'])
+@condition(etag_func=active_book_etag)
 def get_session_book(request):
     if not request.user.is_authenticated():
         return Response(data={'error': 'not_authenticated'})
@@ -93,10 +125,24 @@ class TransactionSerializer(serializers.ModelSerializer):
         model = Transaction
 
 
+class ArchivedSplitSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ArchivedSplit
+
+
+class ArchivedTransactionSerializer(serializers.ModelSerializer):
+    splits = ArchivedSplitSerializer(source='splits', many=True)
+
+    class Meta:
+        model = ArchivedTransaction
+        exclude = ('book',)
+
+
 
 class BookViewSet(viewsets.ViewSet):
     model = Book
 
+    @method_decorator(condition(etag_func=profile_books_etag))
     def list(self, request):
         if not request.user.is_authenticated():
             return Response(data={'status': 'not_authenticated'})
@@ -134,6 +180,7 @@ class AccountSerializer(serializers.ModelSerializer):
 class AccountViewSet(viewsets.ViewSet):
     model = Account
 
+    @method_decorator(condition(etag_func=active_book_etag))
     def list(self, request):
         if not request.user.is_authenticated():
             return Response(data={'status': 'not_authenticated'})
@@ -146,32 +193,405 @@ class AccountViewSet(viewsets.ViewSet):
         return Response(acc_serializer.data)
 
 
+def get_split_account_ids(split_data):
+    account_ids = set()
+    for spl in split_data:
+        try:
+            account_ids.add(int(spl['account']))
+        except (KeyError, TypeError, ValueError):
+            pass
+    return account_ids
+
+
+def resolve_accounts(account_ids):
+    """
+    Loads the given accounts in one query, ready for posting: accounts of the same book share one book
+    and profile instance, and the book's main accounts are the same instances as the loaded ones.
+    """
+    accounts = Account.objects.select_related('currency', 'group__book__profile__default_currency').in_bulk(account_ids)
+    books = {}
+    for account in accounts.values():
+        if account.group is None:
+            continue
+        book = books.setdefault(account.group.book_id, account.group.book)
+        account.group.book = book
+        account.profile = book.profile
+
+    for book in books.values():
+        for field in Book.main_account_fields:
+            account_id = getattr(book, field + '_id')
+            if account_id in accounts:
+                setattr(book, field, accounts[account_id])
+
+    return accounts
+
+
+def build_splits(split_data, accounts):
+    splits = []
+    for spl in split_data:
+        try:
+            account_id = int(spl['account'])
+            sp = Split()
+            sp.account_amount = float(spl['account_amount'])
+            sp.split_type = spl['split_type']
+        except KeyError as e:
+            raise KorovaError("Split is missing %s" % e)
+        except (TypeError, ValueError) as e:
+            raise KorovaError("Invalid split: %s" % e)
+        try:
+            sp.account = accounts[account_id]
+        except KeyError:
+            raise KorovaError("Account %s does not exist" % account_id)
+        try:
+            sp.profile_amount = float(spl['profile_amount'])
+        except KeyError:
+            pass
+        splits.append(sp)
+    return splits
+
+
+@api_view(['POST'])
+def create_transactions(request):
+    """
+    Posts a list of transactions (same format as TransactionViewSet.create) in one database transaction.
+    mode is either 'all_or_nothing' (the default: any error rolls back the whole batch) or 'best_effort'
+    (failed transactions are skipped). The response holds one result per transaction, in request order:
+    'created', 'error' or, for the valid ones of a batch that was rolled back, 'rolled_back'.
+    """
+    if not request.user.is_authenticated():
+        return Response(data={'error': 'not_authenticated'})
+
+    try:
+        items = list(request.DATA['transactions'])
+    except (KeyError, TypeError):
+        return Response(data={'error': 'a list of transactions must be passed as argument'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    mode = request.DATA.get('mode', 'all_or_nothing')
+    if mode not in ('all_or_nothing', 'best_effort'):
+        return Response(data={'error': 'invalid mode %s' % mode}, status=status.HTTP_400_BAD_REQUEST)
+
+    account_ids = set()
+    for item in items:
+        if isinstance(item, dict):
+            account_ids.update(get_split_account_ids(item.get('splits', [])))
+    accounts = resolve_accounts(account_ids)
+
+    results = [None] * len(items)
+    entries = []
+    entry_indexes = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise KorovaError("Transaction must be an object")
+            try:
+                date = parse_transaction_date(item['creation_date'])
+                description = item['description']
+            except KeyError as e:
+                raise KorovaError("Transaction is missing %s" % e)
+            except (TypeError, ValueError):
+                raise KorovaError("Invalid date %s" % item['creation_date'])
+            entries.append((date, description, build_splits(item.get('splits', []), accounts)))
+            entry_indexes.append(index)
+        except KorovaError as e:
+            results[index] = {'status': 'error', 'error': unicode(e)}
+
+    if mode == 'all_or_nothing' and any(results):
+        for index in entry_indexes:
+            results[index] = {'status': 'rolled_back'}
+        return Response(data={'error': 'invalid transactions in batch', 'results': results},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        posted = Transaction.create_many(entries, all_or_nothing=(mode == 'all_or_nothing'))
+    except KorovaBatchError as e:
+        results[entry_indexes[e.index]] = {'status': 'error', 'error': unicode(e.error)}
+        for index in entry_indexes:
+            if results[index] is None:
+                results[index] = {'status': 'rolled_back'}
+        return Response(data={'error': 'batch rolled back', 'results': results},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    for index, result in zip(entry_indexes, posted):
+        if isinstance(result, KorovaError):
+            results[index] = {'status': 'error', 'error': unicode(result)}
+        else:
+            results[index] = {'status': 'created', 'transaction': TransactionSerializer(result).data}
+
+    created = [r for r in results if r['status'] == 'created']
+    return Response(data={'results': results},
+                    status=status.HTTP_201_CREATED if created or not results else status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['POST'])
+def void_transaction(request, pk):
+    """
+    Voids a transaction of the user's books, or with mode 'reverse' posts its reversal, dated date (now by
+    default) and described as description. The transactions of closed books can only be reversed.
+    """
+    if not request.user.is_authenticated():
+        return Response(data={'error': 'not_authenticated'})
+
+    try:
+        trans = Transaction.objects.filter(splits__account__group__book__profile__user=request.user).distinct().get(
+            pk=pk)
+    except Transaction.DoesNotExist:
+        return Response(data={'error': 'transaction %s not found' % pk}, status=status.HTTP_404_NOT_FOUND)
+
+    mode = request.DATA.get('mode', 'void')
+    if mode not in ('void', 'reverse'):
+        return Response(data={'error': 'invalid mode %s' % mode}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        if mode == 'void':
+            trans.void()
+            return Response(data={'status': 'voided', 'id': int(pk)})
+        date = parse_transaction_date(request.DATA['date']) if request.DATA.get('date') else None
+        reversal = trans.reverse(date, request.DATA.get('description'))
+    except KorovaError as e:
+        return Response(data={'error': unicode(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(data={'status': 'reversed', 'transaction': TransactionSerializer(reversal).data},
+                    status=status.HTTP_201_CREATED)
+
+
+@api_view(['GET'])
+def search_transactions(request):
+    """
+    Searches the active book's transactions by description and account names.
+    Parameters: q (required), start and end (dates, end excluded), page and page_size.
+    """
+    if not request.user.is_authenticated():
+        return Response(data={'error': 'not_authenticated'})
+
+    book = Book.get_active_book(request)
+    if book is None:
+        return Response(data={'info': 'no book set for this session'})
+
+    params = request.QUERY_PARAMS
+    try:
+        start = parse_transaction_date(params['start']) if params.get('start') else None
+        end = parse_transaction_date(params['end']) if params.get('end') else None
+        page = max(1, int(params.get('page', 1)))
+        page_size = min(100, max(1, int(params.get('page_size', 20))))
+    except (KorovaError, TypeError, ValueError):
+        return Response(data={'error': 'invalid date or page'}, status=status.HTTP_400_BAD_REQUEST)
+
+    count, matches = SearchToken.search(book, params.get('q', ''), start, end, page, page_size)
+    results = []
+    for trans, score in matches:
+        data = TransactionSerializer(trans).data
+        data['score'] = score
+        results.append(data)
+
+    return Response(data={'count': count, 'page': page, 'page_size': page_size, 'results': results})
+
+
+@api_view(['GET'])
+def realized_fx_report(request):
+    """
+    Realized exchange results of the active book per account and period.
+    Parameters: start and end (dates, end excluded) and period ('day', 'month' or 'year').
+    """
+    if not request.user.is_authenticated():
+        return Response(data={'error': 'not_authenticated'})
+
+    book = Book.get_active_book(request)
+    if book is None:
+        return Response(data={'info': 'no book set for this session'})
+
+    params = request.QUERY_PARAMS
+    period = params.get('period', 'month')
+    if period not in ('day', 'month', 'year'):
+        return Response(data={'error': 'invalid period %s' % period}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        start = parse_transaction_date(params['start']).date() if params.get('start') else None
+        end = parse_transaction_date(params['end']).date() if params.get('end') else None
+    except KorovaError as e:
+        return Response(data={'error': unicode(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(data=LotMatch.realized_report(book, start, end, period))
+
+
+@api_view(['GET'])
+def consolidated_report(request):
+    """
+    Balances and profit and loss of several books of the user's profile, merged on account code.
+    Parameters: books (comma separated ids, all the profile's books by default), currency (code, the
+    profile's currency by default) and merge ('code' or 'name', see korova.consolidation.Consolidation).
+    """
+    from korova.consolidation import Consolidation
+
+    if not request.user.is_authenticated():
+        return Response(data={'error': 'not_authenticated'})
+
+    profile = request.user.profile
+    params = request.QUERY_PARAMS
+    books = profile.books.order_by('start')
+    try:
+        if params.get('books'):
+            book_ids = [int(pk) for pk in params['books'].split(',')]
+            books = books.filter(pk__in=book_ids)
+            if len(books) != len(set(book_ids)):
+                raise KorovaError('unknown book in %s' % params['books'])
+        currency = Currency.objects.get(code=params['currency']) if params.get('currency') else \
+            profile.default_currency
+        report = Consolidation(books, currency, merge_on=params.get('merge', 'code')).run()
+    except (ValueError, KorovaError, Currency.DoesNotExist) as e:
+        return Response(data={'error': unicode(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(data=report)
+
+
+@api_view(['GET'])
+def balance_series(request):
+    """
+    Daily balances of accounts of the active book.
+    Parameters: accounts (comma separated ids) and/or group (id, includes its subgroups), start and end
+    (dates, both included) and output ('json' or 'binary', see BalanceSeries.to_binary).
+    """
+    from korova.timeseries import BalanceSeries
+
+    if not request.user.is_authenticated():
+        return Response(data={'error': 'not_authenticated'})
+
+    book = Book.get_active_book(request)
+    if book is None:
+        return Response(data={'info': 'no book set for this session'})
+
+    params = request.QUERY_PARAMS
+    try:
+        start = parse_transaction_date(params['start']).date()
+        end = parse_transaction_date(params['end']).date()
+        if params.get('group'):
+            series = BalanceSeries.for_group(Group.objects.get(pk=int(params['group']), book=book), start, end)
+        else:
+            account_ids = [int(pk) for pk in params.get('accounts', '').split(',') if pk]
+            series = BalanceSeries(Account.objects.filter(pk__in=account_ids, group__book=book), start, end)
+    except KeyError as e:
+        return Response(data={'error': 'missing %s' % e}, status=status.HTTP_400_BAD_REQUEST)
+    except (KorovaError, ValueError, Group.DoesNotExist) as e:
+        return Response(data={'error': unicode(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    if params.get('output') == 'binary':
+        return HttpResponse(series.to_binary(), content_type='application/octet-stream')
+    return Response(data=series.to_json())
+
+
+@api_view(['GET'])
+def autocomplete_accounts(request):
+    """
+    Accounts of the active book whose code, or a word of whose name, starts with every word of q.
+    Parameters: q and limit (at most 100, 20 by default).
+    """
+    from korova.autocomplete import get_account_index
+
+    if not request.user.is_authenticated():
+        return Response(data={'error': 'not_authenticated'})
+
+    book = Book.get_active_book(request)
+    if book is None:
+        return Response(data={'info': 'no book set for this session'})
+
+    try:
+        limit = min(100, max(1, int(request.QUERY_PARAMS.get('limit', 20))))
+    except ValueError:
+        return Response(data={'error': 'invalid limit'}, status=status.HTTP_400_BAD_REQUEST)
+
+    index = get_account_index(book.pk)
+    results = []
+    for pk in index.complete(request.QUERY_PARAMS.get('q', ''), limit):
+        code, name, label = index.accounts[pk]
+        results.append({'id': pk, 'code': code, 'name': name, 'label': label})
+    return Response(data=results)
+
+
+def balance_events(request):
+    """
+    Server-sent events stream of the active book's balance changes: an event with the book's version and the
+    [account id, account balance, profile balance] of the accounts of every committed posting.
+    The stream ends after settings.KOROVA_EVENT_STREAM_SECONDS, EventSource reconnects sending Last-Event-ID.
+    """
+    from korova.events import get_broker
+
+    if not request.user.is_authenticated():
+        return HttpResponse(status=403)
+
+    book = Book.get_active_book(request)
+    if book is None:
+        return HttpResponse(status=404)
+
+    broker = get_broker()
+    try:
+        last_id = int(request.META.get('HTTP_LAST_EVENT_ID', ''))
+    except ValueError:
+        last_id = broker.current_id()
+    # ids are numbered per process: one from another worker or from before a restart may be ahead of ours
+    last_id = min(last_id, broker.current_id())
+    stream_seconds = getattr(settings, 'KOROVA_EVENT_STREAM_SECONDS', 300)
+    keepalive_seconds = getattr(settings, 'KOROVA_EVENT_KEEPALIVE_SECONDS', 15)
+
+    def stream(last_id):
+        deadline = time.time() + stream_seconds
+        yield 'retry: 1000\n\n'
+        while time.time() < deadline:
+            events = broker.listen(book.pk, last_id, min(keepalive_seconds, max(0, deadline - time.time())))
+            for last_id, data in events:
+                yield 'id: %d\nevent: balances\ndata: %s\n\n' % (last_id, json.dumps(data, separators=(',', ':')))
+            if not events:
+                yield ': keepalive\n\n'
+
+    response = StreamingHttpResponse(stream(last_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
 class TransactionViewSet(viewsets.ViewSet):
     model = Transaction
 
     def list(self, request):
+        """
+        Optional parameters: start and end (dates, end excluded). Ranges reaching back before the end of the
+        last archived book are completed with the archived transactions.
+        """
+        from korova.archive import archived_transactions, get_archive_horizon
+
+        params = request.QUERY_PARAMS
+        try:
+            start = parse_transaction_date(params['start']) if params.get('start') else None
+            end = parse_transaction_date(params['end']) if params.get('end') else None
+        except KorovaError as e:
+            return Response(data={'error': unicode(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         transactions = Transaction.objects.all()
-        serializer = TransactionSerializer(transactions, many=True)
-        return Response(serializer.data)
+        if start is not None:
+            transactions = transactions.filter(transaction_date__gte=start)
+        if end is not None:
+            transactions = transactions.filter(transaction_date__lt=end)
+        horizon = get_archive_horizon()
+        archived = None
+        if horizon is not None and (start is None or start.date() <= horizon):
+            archived = archived_transactions(start, end)
+
+        # plain JSON is streamed straight from the rows, other renderers (e.g. the browsable api) get serializers
+        if type(request.accepted_renderer) is JSONRenderer and 'indent' not in request.accepted_media_type:
+            return StreamingHttpResponse(stream_transactions(transactions, archived),
+                                         content_type=request.accepted_media_type)
+
+        if archived is None:
+            return Response(TransactionSerializer(transactions.order_by('pk'), many=True).data)
+        data = list(TransactionSerializer(transactions, many=True).data) + \
+            list(ArchivedTransactionSerializer(archived, many=True).data)
+        return Response(sorted(data, key=lambda t: (t['transaction_date'], t['id'])))
 
     def create(self, request):
         d = request.DATA
         cdate = d['creation_date']
         desc = d['description']
-        splits = []
-        for spl in d['splits']:
-            sp = Split()
-            sp.account = Account.objects.get(pk=spl['account'])
-            sp.account.profile = sp.account.group.book.profile
-            sp.account_amount = float(spl['account_amount'])
-            sp.split_type=spl['split_type']
-            try:
-                sp.profile_amount = float(spl['profile_amount'])
-            except KeyError:
-                pass
-            splits.append(sp)
+        try:
+            splits = build_splits(d['splits'], resolve_accounts(get_split_account_ids(d['splits'])))
+            trans = Transaction.create(date=cdate,description=desc,splits=splits)
+        except KorovaError as e:
+            return Response(data={'error': unicode(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        trans = Transaction.create(date=cdate,description=desc,splits=splits)
         serializer = TransactionSerializer(trans)
 
         return Response(data=serializer.data, status=status.HTTP_201_CREATED)
@@ -0,0 +1,119 @@
+__author__ = 'aloysio'
+
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Count, Max, Min, Sum
+from exceptions import KorovaError
+from models import Account, ArchivedSplit, ArchivedTransaction, ArchiveSummary, Book, LotMatch, SearchToken, \
+    Split, Transaction, DECIMAL_ZERO, QUANTA
+from routers import get_archive_database
+
+
+def chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def archive_book(book, batch_size=1000):
+    """
+    Moves the transactions and splits of a closed book to the archive tables, leaving an ArchiveSummary per
+    account behind. Pockets and lot matches stay where they are: the accounts keep their balances and the
+    realized results report is unchanged. Archived transactions leave the search index.
+    Returns the number of transactions archived.
+    """
+    if book.archived:
+        raise KorovaError("Book %s is already archived" % book.code)
+    if book.end is None or book.end >= date.today():
+        raise KorovaError("Only closed books can be archived")
+
+    splits = Split.objects.filter(account__group__book=book, transaction__isnull=False)
+    transaction_ids = sorted(set(splits.values_list('transaction', flat=True)))
+    archive_database = get_archive_database()
+
+    with transaction.atomic(), transaction.atomic(using=archive_database):
+        summaries = {}
+        for account_id, account_type, split_type, count, account_amount, profile_amount, first, last in splits.filter(
+                is_linked=True).values('account', 'account__account_type', 'split_type').annotate(
+                Count('pk'), Sum('account_amount'), Sum('profile_amount'), Min('transaction__transaction_date'),
+                Max('transaction__transaction_date')).values_list(
+                'account', 'account__account_type', 'split_type', 'pk__count', 'account_amount__sum',
+                'profile_amount__sum', 'transaction__transaction_date__min', 'transaction__transaction_date__max'):
+            summary = summaries.setdefault(account_id, ArchiveSummary(
+                book=book, account_id=account_id, split_count=0, account_amount=DECIMAL_ZERO,
+                profile_amount=DECIMAL_ZERO, first_date=first, last_date=last))
+            sign = 1 if split_type == Account.split_processor_definitions[str(account_type)][0] else -1
+            summary.split_count += count
+            summary.account_amount += sign * Decimal(str(account_amount)).quantize(QUANTA)
+            summary.profile_amount += sign * Decimal(str(profile_amount)).quantize(QUANTA)
+            summary.first_date = min(summary.first_date, first)
+            summary.last_date = max(summary.last_date, last)
+        ArchiveSummary.objects.bulk_create(summaries.values())
+
+        LotMatch.objects.filter(book=book).update(split=None)
+        for ids in chunks(transaction_ids, batch_size):
+            ArchivedTransaction.objects.bulk_create([
+                ArchivedTransaction(id=pk, book=book.pk, description=description, creation_date=creation_date,
+                                    transaction_date=transaction_date)
+                for pk, description, creation_date, transaction_date in Transaction.objects.filter(
+                    pk__in=ids).values_list('pk', 'description', 'creation_date', 'transaction_date')])
+            ArchivedSplit.objects.bulk_create([
+                ArchivedSplit(id=pk, transaction_id=transaction_id, account=account_id, split_type=split_type,
+                              account_amount=account_amount, profile_amount=profile_amount, is_linked=is_linked)
+                for pk, transaction_id, account_id, split_type, account_amount, profile_amount, is_linked in
+                Split.objects.filter(transaction__in=ids).values_list(
+                    'pk', 'transaction', 'account', 'split_type', 'account_amount', 'profile_amount',
+                    'is_linked')])
+
+            SearchToken.objects.filter(transaction__in=ids).delete()
+            Split.objects.filter(transaction__in=ids).delete()
+            Transaction.objects.filter(pk__in=ids).delete()
+
+        book.archived = True
+        book.save(update_fields=['archived'])
+        Book.bump_version(book.pk)
+
+    return len(transaction_ids)
+
+
+def get_archive_horizon():
+    """
+    End of the most recent archived book: anything older may be in the archive.
+    """
+    return Book.objects.filter(archived=True).aggregate(Max('end'))['end__max']
+
+
+def archived_transactions(start=None, end=None):
+    transactions = ArchivedTransaction.objects.all()
+    if start is not None:
+        transactions = transactions.filter(transaction_date__gte=start)
+    if end is not None:
+        transactions = transactions.filter(transaction_date__lt=end)
+    return transactions.prefetch_related('splits')
+
+
+def archived_split_rows(accounts, limit):
+    """
+    (account, split type, account amount, profile amount, transaction date) of the linked archived splits of
+    accounts dated before limit, for the accounts that belong to an archived book. Two queries at most.
+    """
+    account_ids = list(Account.all_objects.filter(pk__in=[getattr(a, 'pk', a) for a in accounts],
+                                                   group__book__archived=True).values_list('pk', flat=True))
+    if not account_ids:
+        return []
+    return list(ArchivedSplit.objects.filter(account__in=account_ids, is_linked=True,
+                                             transaction__transaction_date__lt=limit)
+                .values_list('account', 'split_type', 'account_amount', 'profile_amount',
+                             'transaction__transaction_date'))
+
+
+def archive_summaries(account_ids):
+    """
+    Maps account ids to the signed (account amount, profile amount) their archived splits added up to.
+    """
+    summaries = defaultdict(lambda: (DECIMAL_ZERO, DECIMAL_ZERO))
+    for account_id, account_amount, profile_amount in ArchiveSummary.objects.filter(
+            account__in=account_ids).values_list('account', 'account_amount', 'profile_amount'):
+        summaries[account_id] = (account_amount, profile_amount)
+    return summaries
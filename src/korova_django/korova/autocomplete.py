@@ -0,0 +1,59 @@
+__author__ = 'aloysio'
+
+from bisect import bisect_left
+from django.core.cache import cache
+from models import Account, Book, SearchToken
+
+
+class AccountIndex(object):
+    """
+    The accounts of a book as form choices, sorted by code, and a sorted list of (prefix key, account id)
+    to complete account codes and name words with a binary search. Built once per book version and kept
+    in the cache, see get_account_index.
+    """
+
+    cache_key_template = 'korova-account-index-%s-%s'
+
+    def __init__(self, rows):
+        self.accounts = {}
+        self.choices = []
+        keys = []
+        for pk, code, name in sorted(rows, key=lambda row: row[1]):
+            label = u"%s - %s" % (code, name)
+            self.accounts[pk] = (code, name, label)
+            self.choices.append((pk, label))
+            keys.append((code.lower(), pk))
+            keys.extend((token, pk) for token in set(SearchToken.tokenize(name)))
+        keys.sort()
+        self.keys = keys
+
+    def complete(self, prefix, limit=20):
+        """
+        Ids of the accounts whose code, or a word of whose name, starts with every word of prefix, by code.
+        """
+        words = prefix.strip().lower().split()
+        if not words:
+            return []
+        # the code is matched as typed, name words are normalized the way the search index does
+        matches = None
+        for word in words:
+            found = set(self.lookup(word))
+            for token in SearchToken.tokenize(word):
+                found.update(self.lookup(token))
+            matches = found if matches is None else matches & found
+        return sorted(matches, key=lambda pk: self.accounts[pk][0])[:limit]
+
+    def lookup(self, key):
+        i = bisect_left(self.keys, (key,))
+        while i < len(self.keys) and self.keys[i][0].startswith(key):
+            yield self.keys[i][1]
+            i += 1
+
+
+def get_account_index(book_id):
+    key = AccountIndex.cache_key_template % (book_id, Book.get_version(book_id))
+    index = cache.get(key)
+    if index is None:
+        index = AccountIndex(Account.objects.filter(group__book=book_id).values_list('pk', 'code', 'name'))
+        cache.set(key, index)
+    return index
@@ -0,0 +1,230 @@
+__author__ = 'aloysio'
+
+import csv
+import json
+from django.db import transaction
+from exceptions import KorovaChartError
+from models import Account, Book, Currency, Group, DECIMAL_ZERO
+
+# the first digit of a dotted code tells the type of the accounts below it
+account_types = {'1': 'ASSET',
+                 '2': 'LIABILITY',
+                 '3': 'INCOME',
+                 '4': 'EXPENSE',
+                 '5': 'EQUITY'}
+
+chart_formats = ('pipe', 'csv', 'json')
+chart_columns = ('code', 'name', 'kind', 'parent', 'account_type', 'currency')
+
+
+class ChartEntry(object):
+    """
+    A group or an account of a chart of accounts. Whatever is left as None is derived from the dotted code:
+    the parent drops the last segment, codes shallower than account_depth are groups, and accounts take their
+    type from the first digit of the code.
+    """
+
+    def __init__(self, code, name, kind=None, parent=None, account_type=None, currency=None):
+        self.code = code
+        self.name = name
+        self.kind = kind
+        self.parent = parent
+        self.account_type = account_type
+        self.currency = currency
+
+    def __unicode__(self):
+        return u"ChartEntry(%s, %s, %s)" % (self.code, self.name, self.kind)
+
+
+def parse_pipe(stream):
+    """
+    Reads the hand written format of accounts.txt, one 'code | name [| currency]' entry per line.
+    The hierarchy comes from the dotted codes.
+    """
+    for line in stream:
+        if isinstance(line, str):
+            line = line.decode('utf-8')
+        values = [value.strip() for value in line.split('|')]
+        if not values[0]:
+            continue
+        yield ChartEntry(values[0], values[1] if len(values) > 1 else u'',
+                         currency=values[2] if len(values) > 2 and values[2] else None)
+
+
+def parse_csv(stream, delimiter=','):
+    """
+    Reads a CSV chart with a header row naming any of the chart_columns, code and name being required.
+    """
+    reader = csv.DictReader(stream, delimiter=delimiter)
+    for row in reader:
+        values = dict((k, v.strip().decode('utf-8')) for k, v in row.items() if k in chart_columns and v and v.strip())
+        if values.get('code'):
+            yield ChartEntry(**dict(values, name=values.get('name', u'')))
+
+
+def parse_json(stream):
+    """
+    Reads a JSON list of objects keyed by the chart_columns.
+    """
+    for values in json.load(stream):
+        yield ChartEntry(**dict((k, v) for k, v in values.items() if k in chart_columns))
+
+
+parsers = {'pipe': parse_pipe, 'csv': parse_csv, 'json': parse_json}
+
+
+class ChartLoader(object):
+    """
+    Creates a whole chart of accounts in a book with bulk inserts.
+
+    The entries are validated in memory first, every problem is reported at once with KorovaChartError and
+    nothing is written. Groups are then inserted one tree level at a time, each level being one insert and one
+    select to learn the ids its children point to, and all the accounts go in a last bulk insert.
+    Parents may be groups already in the book.
+    """
+
+    batch_size = 500
+
+    def __init__(self, book, account_depth=3):
+        self.book = book
+        self.account_depth = account_depth
+
+    def resolve(self, entries):
+        entries = list(entries)
+        errors = []
+        by_code = {}
+        for entry in entries:
+            if entry.code in by_code:
+                errors.append("Duplicate code %s" % entry.code)
+            by_code[entry.code] = entry
+            if entry.parent is None and '.' in entry.code:
+                entry.parent = entry.code.rsplit('.', 1)[0]
+            if entry.kind is None:
+                entry.kind = 'group' if entry.code.count('.') + 1 < self.account_depth else 'account'
+            if entry.kind not in ('group', 'account'):
+                errors.append("%s: unknown kind %s" % (entry.code, entry.kind))
+
+        existing_groups = dict(Group.objects.filter(book=self.book).values_list('code', 'pk'))
+        codes = list(by_code)
+        taken = set(Group.all_objects.filter(code__in=codes).values_list('code', flat=True)) | \
+            set(Account.all_objects.filter(code__in=codes).values_list('code', flat=True))
+        for code in sorted(taken):
+            errors.append("Code %s is already in use" % code)
+
+        profile = self.book.profile
+        currency_codes = set(e.currency for e in entries if e.currency)
+        currencies = dict((c.code, c) for c in Currency.objects.filter(code__in=currency_codes))
+        for code in sorted(currency_codes - set(currencies)):
+            errors.append("Unknown currency %s" % code)
+
+        for entry in entries:
+            if entry.parent is not None and entry.parent not in existing_groups:
+                parent = by_code.get(entry.parent)
+                if parent is None:
+                    errors.append("%s: parent %s not found" % (entry.code, entry.parent))
+                elif parent.kind != 'group':
+                    errors.append("%s: parent %s is an account" % (entry.code, entry.parent))
+            if entry.kind == 'account':
+                if entry.parent is None:
+                    errors.append("%s: an account must belong to a group" % entry.code)
+                if entry.account_type is None:
+                    entry.account_type = account_types.get(entry.code[:1])
+                if entry.account_type not in Account.account_natures:
+                    errors.append("%s: unknown account type %s" % (entry.code, entry.account_type))
+                currency = currencies.get(entry.currency, profile.default_currency)
+                if currency != profile.default_currency and entry.account_type in ('INCOME', 'EXPENSE'):
+                    errors.append("%s: a result account (INCOME | EXPENSE) cannot be in a foreign currency"
+                                  % entry.code)
+                entry.currency = currency
+
+        levels = self.get_levels([e for e in entries if e.kind == 'group'], by_code, existing_groups, errors)
+        if errors:
+            raise KorovaChartError(errors)
+        return levels, [e for e in entries if e.kind == 'account'], existing_groups
+
+    def get_levels(self, groups, by_code, existing_groups, errors):
+        depths = {}
+        for group in groups:
+            path = []
+            code = group.code
+            while code is not None and code not in depths and code not in existing_groups and code in by_code:
+                if code in path:
+                    errors.append("%s: circular parent" % group.code)
+                    break
+                path.append(code)
+                code = by_code[code].parent
+            else:
+                depth = depths.get(code, 0)
+                for code in reversed(path):
+                    depth += 1
+                    depths[code] = depth
+
+        levels = []
+        for group in groups:
+            if group.code in depths:
+                while len(levels) < depths[group.code]:
+                    levels.append([])
+                levels[depths[group.code] - 1].append(group)
+        return levels
+
+    def load(self, entries):
+        """
+        Returns a dict mapping the code of every group and account created to its id.
+        """
+        levels, accounts, group_ids = self.resolve(entries)
+        # the tree fragments of the existing groups getting a child are keyed by their version
+        parent_ids = set(group_ids[e.parent] for e in [g for level in levels for g in level] + accounts
+                         if e.parent in group_ids)
+        created = {}
+        with transaction.atomic():
+            for level in levels:
+                Group.objects.bulk_create([Group(code=g.code, name=g.name, book=self.book,
+                                                 parent_id=group_ids.get(g.parent)) for g in level],
+                                          batch_size=self.batch_size)
+                level_ids = dict(Group.objects.filter(code__in=[g.code for g in level]).values_list('code', 'pk'))
+                group_ids.update(level_ids)
+                created.update(level_ids)
+
+            Account.objects.bulk_create([Account(code=a.code, name=a.name, group_id=group_ids[a.parent],
+                                                 currency=a.currency, account_type=a.account_type,
+                                                 imbalance=DECIMAL_ZERO) for a in accounts],
+                                        batch_size=self.batch_size)
+            created.update(Account.objects.filter(code__in=[a.code for a in accounts]).values_list('code', 'pk'))
+            Group.bump_versions(parent_ids)
+            Book.bump_version(self.book.pk)
+        return created
+
+
+def load_chart(book, stream, chart_format='pipe', account_depth=3):
+    return ChartLoader(book, account_depth).load(parsers[chart_format](stream))
+
+
+def export_chart(book, stream, chart_format='pipe'):
+    """
+    Writes the chart of accounts of a book, sorted by code, in a format load_chart reads back.
+    The pipe format relies on dotted codes to carry the hierarchy.
+    """
+    groups = list(Group.objects.filter(book=book).order_by('code').values_list('code', 'name', 'parent__code'))
+    accounts = list(Account.objects.filter(group__book=book).order_by('code').values_list(
+        'code', 'name', 'group__code', 'account_type', 'currency__code'))
+    default_currency = book.profile.default_currency.code
+
+    rows = [{'code': code, 'name': name, 'kind': 'group', 'parent': parent}
+            for code, name, parent in groups]
+    rows += [{'code': code, 'name': name, 'kind': 'account', 'parent': parent, 'account_type': str(account_type),
+              'currency': currency} for code, name, parent, account_type, currency in accounts]
+    rows.sort(key=lambda row: (row['code'], row['kind'] == 'account'))
+
+    if chart_format == 'json':
+        json.dump(rows, stream, indent=1)
+    elif chart_format == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(chart_columns)
+        for row in rows:
+            writer.writerow([(row.get(column) or u'').encode('utf-8') for column in chart_columns])
+    else:
+        for row in rows:
+            line = u"%-8s | %s" % (row['code'], row['name'])
+            if row.get('currency') and row['currency'] != default_currency:
+                line += u" | %s" % row['currency']
+            stream.write((line + u"\n").encode('utf-8'))
@@ -0,0 +1,141 @@
+__author__ = 'aloysio'
+
+from decimal import Decimal
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q, Sum
+from exceptions import KorovaError, KorovaRateError
+from models import Account, Book, Currency, Pocket, DECIMAL_ZERO, QUANTA
+from verification import close_connections
+
+
+def book_balances(book_id):
+    """
+    The book's id, code and profile currency, and the balances of its accounts as {'code', 'name', 'type',
+    'currency', 'account_balance', 'profile_balance'} dicts sorted by code. Soft deleted accounts are listed
+    while they still hold a balance. Three queries.
+    """
+    book = Book.objects.select_related('profile__default_currency').get(pk=book_id)
+    sums = dict((account_id, (account_balance, profile_balance))
+                for account_id, account_balance, profile_balance in Pocket.objects.filter(
+                    account__group__book=book_id, account_balance__gt=0).values('account').annotate(
+                    Sum('account_balance'), Sum('profile_balance')).values_list(
+                    'account', 'account_balance__sum', 'profile_balance__sum'))
+
+    accounts = []
+    for pk, code, name, account_type, currency in Account.all_objects.filter(group__book=book_id).filter(
+            Q(deleted=False) | Q(pk__in=list(sums))).order_by('code').values_list(
+            'pk', 'code', 'name', 'account_type', 'currency__code'):
+        account_balance, profile_balance = sums.get(pk, (DECIMAL_ZERO, DECIMAL_ZERO))
+        accounts.append({'code': code, 'name': name, 'type': str(account_type), 'currency': currency,
+                         'account_balance': Decimal(str(account_balance)).quantize(QUANTA),
+                         'profile_balance': Decimal(str(profile_balance)).quantize(QUANTA)})
+    return {'id': book.pk, 'code': book.code, 'currency': book.profile.default_currency.code, 'accounts': accounts}
+
+
+class Consolidation(object):
+    """
+    Balances and profit and loss of a set of books, possibly of different profiles, in one currency.
+
+    The balances of each book are computed by a worker process of their own (one per book unless workers says
+    otherwise, and in the caller's process inside a transaction, which the workers couldn't see) and cached per
+    book version, so only the books posted to since the last run are computed again. They are converted from
+    each book's profile currency with rates (currency code -> rate in the target currency), or the stored rate
+    for the currencies missing from it, see get_rate, and merged on merge_on: account codes are unique across
+    books, so the same chart kept in several books under different codes is merged on the account names
+    (merge_on='name').
+    """
+
+    cache_key_template = 'korova-consolidation-%s-%s'
+
+    merge_fields = ('code', 'name')
+
+    def __init__(self, books, currency, rates=None, workers=None, merge_on='code'):
+        if merge_on not in self.merge_fields:
+            raise KorovaError("Accounts can't be merged on %s" % merge_on)
+        self.books = list(books)
+        self.merge_on = merge_on
+        self.currency = currency
+        self.rates = dict(rates or {})
+        self.workers = len(self.books) if workers is None else max(1, workers)
+        self.computed = 0
+
+    def get_book_balances(self):
+        versions = dict(Book.objects.filter(pk__in=[b.pk for b in self.books]).values_list('pk', 'version'))
+        keys = dict((b.pk, self.cache_key_template % (b.pk, versions[b.pk])) for b in self.books)
+        balances = cache.get_many(keys.values())
+        missing = [b.pk for b in self.books if keys[b.pk] not in balances]
+        self.computed = len(missing)
+
+        # forking closes the caller's connections, an open transaction would be lost
+        if self.workers > 1 and len(missing) > 1 and not connection.in_atomic_block:
+            from multiprocessing import Pool
+            close_connections()
+            pool = Pool(min(self.workers, len(missing)), initializer=close_connections)
+            try:
+                results = pool.map(book_balances, missing)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [book_balances(pk) for pk in missing]
+
+        computed = dict((keys[pk], result) for pk, result in zip(missing, results))
+        cache.set_many(computed)
+        balances.update(computed)
+        return [balances[keys[b.pk]] for b in self.books]
+
+    def get_rate(self, currency_code):
+        """
+        The rate given for currency_code, or else a stored one: from the rates file, or the one the ledger
+        last used (either way round). Never a live quote, so the same books consolidate to the same report.
+        """
+        if currency_code not in self.rates:
+            from currencies import FileRateProvider, LastRateProvider
+            currency = Currency.objects.get(code=currency_code)
+            for provider in (FileRateProvider(), LastRateProvider()):
+                try:
+                    self.rates[currency_code] = provider.get_exchange_rate(currency, self.currency)
+                    break
+                except KorovaRateError:
+                    pass
+                try:
+                    inverse = Decimal(str(provider.get_exchange_rate(self.currency, currency)))
+                except KorovaRateError:
+                    continue
+                if inverse:
+                    self.rates[currency_code] = (1 / inverse).quantize(QUANTA)
+                    break
+            else:
+                raise KorovaRateError(["no stored %s to %s rate, give it as a rate" % (currency_code,
+                                                                                    self.currency.code)])
+        return Decimal(str(self.rates[currency_code]))
+
+    def run(self):
+        """
+        Returns {'currency', 'books': [{'id', 'code', 'currency', 'rate', 'profit_loss'}, ...], 'accounts': [...],
+        'profit_loss'}. Accounts carry their total and per book id balances in the target currency, and the code
+        and name of the first account merged into them.
+        """
+        accounts = {}
+        books = []
+        for book in self.get_book_balances():
+            rate = self.get_rate(book['currency'])
+            profit_loss = DECIMAL_ZERO
+            for account in book['accounts']:
+                balance = (account['profile_balance'] * rate).quantize(QUANTA)
+                merged = accounts.setdefault(account[self.merge_on], {
+                    'code': account['code'], 'name': account['name'], 'type': account['type'],
+                    'balance': DECIMAL_ZERO, 'books': {}})
+                merged['balance'] += balance
+                merged['books'][book['id']] = balance
+                if account['type'] == 'INCOME':
+                    profit_loss += balance
+                elif account['type'] == 'EXPENSE':
+                    profit_loss -= balance
+            books.append({'id': book['id'], 'code': book['code'], 'currency': book['currency'],
+                          'rate': rate.quantize(QUANTA), 'profit_loss': profit_loss})
+
+        return {'currency': self.currency.code, 'books': books,
+                'accounts': sorted(accounts.values(), key=lambda a: a['code']),
+                'profit_loss': sum((b['profit_loss'] for b in books), DECIMAL_ZERO)}
@@ -1,11 +1,14 @@
 __author__ = 'aloysio'
 
+from django.conf import settings
 from django.db.utils import ProgrammingError
-from suds.client import Client
-from bs4 import BeautifulSoup
-from urllib2 import Request, urlopen
 import logging
-from decimal import Decimal
+import os
+import threading
+import time
+import Queue
+from decimal import Decimal, InvalidOperation
+from exceptions import KorovaRateError, KorovaRateNotFound
 
 currencies = {}
 
@@ -33,25 +36,348 @@ class XERateProvider(object):
 
     xe_url_template = 'http://www.xe.com/currencyconverter/convert/?Amount=1&From=%s&To=%s'
 
+    timeout = 10
+
     def get_exchange_rate(self, rate_from, rate_to):
+        # network/scraping libraries are imported here so that loading the ledger never pulls them in
+        from urllib2 import Request, urlopen
+        from bs4 import BeautifulSoup
         from models import QUANTA
 
         headers = {'User-Agent' : self.user_agent}
         request = Request(self.xe_url_template %(rate_from.code, rate_to.code),None, headers)
 
-        soup = BeautifulSoup(urlopen(request))
+        soup = BeautifulSoup(urlopen(request, timeout=self.timeout))
 
         # this is cryptic, I know... just reverse engineering on the xe HTML page
-        str_rate = soup.find_all(class_='uccResUnit')[0].find_all('td')[0].text.split()[3]
-        return Decimal(float(str_rate)).quantize(QUANTA)
+        try:
+            str_rate = soup.find_all(class_='uccResUnit')[0].find_all('td')[0].text.split()[3]
+            return Decimal(float(str_rate)).quantize(QUANTA)
+        except (IndexError, ValueError):
+            raise KorovaRateError(["xe.com page layout changed"])
 
 class WSRateProvider(object):
 
     ws_url = 'http://www.webservicex.net/CurrencyConvertor.asmx?WSDL'
 
-    def __init__(self):
-        self.ws_client = Client(self.ws_url)
-        logging.getLogger('suds.client').setLevel(logging.CRITICAL)
+    ws_client = None
+
+    timeout = 10
+
+    def get_client(self):
+        # building the client fetches the WSDL, so it is only done when a rate is actually requested
+        if self.ws_client is None:
+            from suds.client import Client
+            self.ws_client = Client(self.ws_url, timeout=self.timeout)
+            logging.getLogger('suds.client').setLevel(logging.CRITICAL)
+        return self.ws_client
+
+    def get_exchange_rate(self, rate_from, rate_to):
+        return self.get_client().service.ConversionRate(rate_from.code, rate_to.code)
+
+
+
+class LastRateProvider(object):
+    """
+    The rate of the most recent increase of an account in rate_from, in a profile whose currency is rate_to:
+    what the ledger itself last used. Answers from the database, never from the network.
+    """
+
+    remote = False
 
     def get_exchange_rate(self, rate_from, rate_to):
-        return self.ws_client.service.ConversionRate(rate_from.code, rate_to.code)
+        from django.db.models import Q
+        from models import Account, Split, QUANTA
+
+        increases = Q()
+        for account_type, (increase_operation, decrease_operation) in Account.split_processor_definitions.items():
+            increases |= Q(account__account_type=account_type, split_type=increase_operation)
+        rows = Split.objects.filter(increases, account__currency=rate_from,
+                                    account__group__book__profile__default_currency=rate_to, is_linked=True,
+                                    account_amount__gt=0, transaction__isnull=False).order_by(
+            '-transaction__transaction_date', '-pk').values_list('account_amount', 'profile_amount')[:1]
+        if not rows:
+            raise KorovaRateNotFound(["no %s to %s rate was ever used" % (rate_from.code, rate_to.code)])
+        account_amount, profile_amount = rows[0]
+        return (Decimal(str(profile_amount)) / Decimal(str(account_amount))).quantize(QUANTA)
+
+
+class FileRateProvider(object):
+    """
+    Rates kept in a text file (settings.KOROVA_RATES_FILE by default), one "FROM TO RATE" line per pair,
+    e.g. "USD BRL 2.250000". Lines starting with # are ignored; the file is read again when it changes.
+    """
+
+    remote = False
+
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, 'KOROVA_RATES_FILE', None)
+        self.rates = {}
+        self.mtime = None
+
+    def load(self):
+        if not self.path:
+            raise KorovaRateError(["no rates file configured"])
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            raise KorovaRateError([str(e)])
+        if mtime != self.mtime:
+            rates = {}
+            with open(self.path) as stream:
+                for number, line in enumerate(stream, 1):
+                    if not line.strip() or line.startswith('#'):
+                        continue
+                    try:
+                        rate_from, rate_to, rate = line.split()
+                        rates[(rate_from, rate_to)] = Decimal(rate)
+                    except (ValueError, InvalidOperation):
+                        raise KorovaRateError(["%s:%d: expected FROM TO RATE" % (self.path, number)])
+            self.rates, self.mtime = rates, mtime
+        return self.rates
+
+    def get_exchange_rate(self, rate_from, rate_to):
+        try:
+            return self.load()[(rate_from.code, rate_to.code)]
+        except KeyError:
+            raise KorovaRateNotFound(["%s has no %s to %s rate" % (self.path, rate_from.code, rate_to.code)])
+
+
+class CircuitBreaker(object):
+    """
+    Opens after failure_threshold consecutive failures, skipping its provider for cooldown seconds. After that
+    a single trial call is let through, the others are still skipped: a success closes the breaker, a failure
+    opens it for another cooldown. Whoever was allowed a call reports success, failure or release.
+    """
+
+    def __init__(self, failure_threshold=3, cooldown=300):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = None
+        self.trying = False
+        self.lock = threading.Lock()
+
+    def allows(self):
+        with self.lock:
+            if self.opened_until is None:
+                return True
+            if self.trying or time.time() < self.opened_until:
+                return False
+            # half open: this is the trial call
+            self.trying = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_until = None
+            self.trying = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trying = False
+            if self.failures >= self.failure_threshold:
+                self.opened_until = time.time() + self.cooldown
+
+    def release(self):
+        # the call was abandoned before it answered, the next caller may try again
+        with self.lock:
+            self.trying = False
+
+
+class FallbackRateProvider(object):
+    """
+    Asks an ordered list of providers for a rate, moving on to the next one when a provider fails or takes
+    longer than timeout seconds, so a post never waits for an upstream for more than the sum of the timeouts.
+    Every provider has a CircuitBreaker: one that keeps failing is skipped for a while. A provider that answers
+    it has no such rate (KorovaRateNotFound) hasn't failed.
+
+    Remote providers run in a worker thread that is abandoned if it times out. Providers with remote = False
+    (the database or a file) are called directly. With hedge_after, a slow remote provider doesn't block the
+    chain: after hedge_after seconds the next provider is asked too, and the first rate wins.
+    """
+
+    def __init__(self, providers, timeout=5, failure_threshold=3, cooldown=300, hedge_after=None):
+        self.providers = list(providers)
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.breakers = [CircuitBreaker(failure_threshold, cooldown) for provider in self.providers]
+
+    def start(self, index, rate_from, rate_to, results):
+        provider = self.providers[index]
+
+        def call():
+            try:
+                results.put((index, True, provider.get_exchange_rate(rate_from, rate_to)))
+            except Exception as e:
+                results.put((index, False, e))
+
+        if getattr(provider, 'remote', True):
+            thread = threading.Thread(target=call)
+            thread.daemon = True
+            thread.start()
+        else:
+            call()
+
+    def get_exchange_rate(self, rate_from, rate_to):
+        errors = []
+        # whether every provider asked answered it has no such rate
+        not_found = True
+        candidates = range(len(self.providers))
+        results = Queue.Queue()
+        running = {}  # index -> deadline
+        next_hedge = None
+        while True:
+            now = time.time()
+            hedge = next_hedge is not None and now >= next_hedge
+            if candidates and (not running or hedge):
+                index = candidates.pop(0)
+                # asked only when the provider is about to be called, a half open breaker allows a single call
+                if not self.breakers[index].allows():
+                    errors.append("%s skipped, circuit open" % type(self.providers[index]).__name__)
+                    not_found = False
+                    continue
+                running[index] = now + self.timeout
+                next_hedge = now + self.hedge_after if self.hedge_after is not None and candidates else None
+                self.start(index, rate_from, rate_to, results)
+                continue
+
+            for index, deadline in running.items():
+                if deadline <= now:
+                    del running[index]
+                    self.breakers[index].failure()
+                    errors.append("%s timed out" % type(self.providers[index]).__name__)
+                    not_found = False
+            if not running:
+                if candidates:
+                    continue
+                raise (KorovaRateNotFound if not_found else KorovaRateError)(errors)
+
+            wait_until = min(running.values() + ([next_hedge] if next_hedge is not None else []))
+            try:
+                index, ok, value = results.get(timeout=max(0, wait_until - now))
+            except Queue.Empty:
+                continue
+            if index not in running:
+                # the answer of a provider that already timed out
+                continue
+            del running[index]
+            if ok or isinstance(value, KorovaRateNotFound):
+                self.breakers[index].success()
+            else:
+                self.breakers[index].failure()
+                not_found = False
+            if ok:
+                for abandoned in running:
+                    self.breakers[abandoned].release()
+                return value
+            errors.append("%s failed: %s" % (type(self.providers[index]).__name__, value))
+
+
+class RateMatrix(object):
+    """
+    Exchange rates between any two currencies, derived from each currency's rate against a single pivot
+    currency: provider is asked once per currency and rate date instead of once per pair. Cross rates are
+    computed from the unrounded pivot rates and quantized once, to QUANTA.
+
+    A currency the provider can't rate against the pivot falls back to the direct pair, also cached for the
+    day, as are the rates the provider doesn't have. Quacks like a rate provider, so profiles can use it in
+    place of one.
+    """
+
+    def __init__(self, provider, pivot='USD'):
+        self.provider = provider
+        self.pivot = pivot
+        self.rate_date = None
+        self.pivot_rates = {}
+        self.direct_rates = {}
+        self.lock = threading.Lock()
+
+    def get_pivot_currency(self):
+        if self.pivot not in currencies:
+            from models import Currency
+            currencies[self.pivot] = Currency.objects.get(code=self.pivot)
+        return currencies[self.pivot]
+
+    def start_day(self):
+        from django.utils import timezone
+        today = timezone.now().date()
+        if today != self.rate_date:
+            self.rate_date, self.pivot_rates, self.direct_rates = today, {}, {}
+
+    def cached(self, name, key, fetch):
+        """
+        The value of key in the day's cache called name, fetched on a miss. The provider is called outside the
+        lock, so a slow one doesn't hold up the rates that are already known. A rate the provider answered it
+        doesn't have (KorovaRateNotFound) is cached too, and not asked for again that day.
+        """
+        with self.lock:
+            self.start_day()
+            rate_date = self.rate_date
+            value = getattr(self, name).get(key)
+        if value is None:
+            try:
+                value = fetch()
+            except KorovaRateNotFound as e:
+                value = e
+            with self.lock:
+                if self.rate_date == rate_date:
+                    getattr(self, name)[key] = value
+        if isinstance(value, KorovaRateError):
+            raise value
+        return value
+
+    def pivot_rate(self, currency):
+        """
+        Value of one unit of currency in the pivot currency, unrounded.
+        """
+        if currency.code == self.pivot:
+            return Decimal(1)
+        return self.cached('pivot_rates', currency.code, lambda: Decimal(str(
+            self.provider.get_exchange_rate(currency, self.get_pivot_currency()))))
+
+    def get_exchange_rate(self, rate_from, rate_to):
+        from models import QUANTA
+
+        if rate_from.code == rate_to.code:
+            return Decimal(1).quantize(QUANTA)
+        try:
+            return (self.pivot_rate(rate_from) / self.pivot_rate(rate_to)).quantize(QUANTA)
+        except KorovaRateError:
+            return self.cached('direct_rates', (rate_from.code, rate_to.code), lambda: Decimal(str(
+                self.provider.get_exchange_rate(rate_from, rate_to))).quantize(QUANTA))
+
+
+_default_provider = None
+_default_matrix = None
+
+
+def get_default_rate_provider():
+    """
+    The process-wide FallbackRateProvider built from settings.KOROVA_EXCHANGE_RATE_PROVIDERS, shared by every
+    profile so the circuit breakers see all the failures.
+    """
+    global _default_provider
+    if _default_provider is None:
+        from django.utils.module_loading import import_by_path
+        providers = [import_by_path(path)() for path in getattr(settings, 'KOROVA_EXCHANGE_RATE_PROVIDERS', (
+            'korova.currencies.XERateProvider', 'korova.currencies.WSRateProvider',
+            'korova.currencies.LastRateProvider'))]
+        _default_provider = FallbackRateProvider(
+            providers, timeout=getattr(settings, 'KOROVA_EXCHANGE_RATE_TIMEOUT', 5),
+            cooldown=getattr(settings, 'KOROVA_EXCHANGE_RATE_COOLDOWN', 300),
+            hedge_after=getattr(settings, 'KOROVA_EXCHANGE_RATE_HEDGE_AFTER', None))
+    return _default_provider
+
+
+def get_default_rate_matrix():
+    """
+    The process-wide RateMatrix over get_default_rate_provider, pivoting on settings.KOROVA_PIVOT_CURRENCY.
+    Every profile and report asks it, so a currency is rated once a day whatever the pairs.
+    """
+    global _default_matrix
+    if _default_matrix is None:
+        _default_matrix = RateMatrix(get_default_rate_provider(), getattr(settings, 'KOROVA_PIVOT_CURRENCY', 'USD'))
+    return _default_matrix
@@ -0,0 +1,153 @@
+__author__ = 'aloysio'
+
+from django.db import transaction
+from django.db.models import Q
+from archive import chunks
+from exceptions import KorovaError
+from models import Account, ArchivedSplit, ArchivedTransaction, ArchiveSummary, Book, Group, LotMatch, Pocket, \
+    SearchToken, Split, Transaction
+from routers import get_archive_database
+
+
+def raw_delete(queryset):
+    # a single DELETE, without loading the rows nor following relations: callers go in dependency order
+    queryset._raw_delete(queryset.db)
+
+
+def subtree_group_ids(group_ids):
+    """
+    The ids of the groups and of all their subgroups, soft deleted or not. One query per level.
+    """
+    found = set(group_ids)
+    level = list(found)
+    while level:
+        level = [pk for pk in Group.all_objects.filter(parent__in=level).values_list('pk', flat=True)
+                 if pk not in found]
+        found.update(level)
+    return sorted(found)
+
+
+def main_account_books(account_ids):
+    """
+    Codes of the books some of the accounts are a main account of.
+    """
+    main = Q()
+    for field in Book.main_account_fields:
+        main |= Q(**{field + '__in': account_ids})
+    return list(Book.all_objects.filter(main).values_list('code', flat=True))
+
+
+def check_deletable(account_ids):
+    """
+    Raises KorovaError if any of the accounts has a history (linked or archived splits) or is one of the
+    main accounts of a book. Such accounts can only be soft deleted, or purged with their whole book.
+    """
+    errors = []
+    codes = dict(Account.all_objects.filter(pk__in=account_ids).values_list('pk', 'code'))
+    linked = set(Split.objects.filter(account__in=account_ids, is_linked=True).values_list('account', flat=True)) | \
+        set(ArchiveSummary.objects.filter(account__in=account_ids).values_list('account', flat=True))
+    for pk in sorted(linked):
+        errors.append("%s has linked splits" % codes[pk])
+    for book_code in main_account_books(account_ids):
+        errors.append("the main accounts of book %s can't be deleted" % book_code)
+    if errors:
+        raise KorovaError("Can't delete: " + "; ".join(errors))
+
+
+def bump_versions(group_ids, book_ids):
+    Group.bump_versions(group_ids)
+    for book_id in set(book_ids):
+        Book.bump_version(book_id)
+        Book.invalidate_cache(book_id)
+
+
+@transaction.atomic
+def purge_accounts(account_ids):
+    """
+    Deletes accounts that never had a linked split with a handful of set based DELETEs: their drafted
+    (unlinked) splits, pockets and lot matches, then the accounts.
+    """
+    account_ids = list(account_ids)
+    check_deletable(account_ids)
+    groups = list(Account.all_objects.filter(pk__in=account_ids).values_list('group', 'group__book'))
+
+    raw_delete(LotMatch.objects.filter(account__in=account_ids))
+    raw_delete(Split.objects.filter(account__in=account_ids))
+    raw_delete(Pocket.objects.filter(account__in=account_ids))
+    raw_delete(Account.all_objects.filter(pk__in=account_ids))
+    bump_versions([g for g, b in groups], [b for g, b in groups if b is not None])
+
+
+@transaction.atomic
+def purge_groups(group_ids):
+    """
+    Deletes groups with their subgroups and accounts, none of which may have a history (see check_deletable).
+    """
+    group_ids = subtree_group_ids(group_ids)
+    book_ids = list(Group.all_objects.filter(pk__in=group_ids).values_list('book', flat=True))
+    account_ids = list(Account.all_objects.filter(group__in=group_ids).values_list('pk', flat=True))
+    parents = Group.all_objects.filter(pk__in=group_ids).exclude(parent=None).values_list('parent', flat=True)
+    parent_ids = set(parents) - set(group_ids)
+
+    purge_accounts(account_ids)
+    Group.all_objects.filter(pk__in=group_ids).update(parent=None)
+    raw_delete(Group.all_objects.filter(pk__in=group_ids))
+    bump_versions(parent_ids, book_ids)
+
+
+def purge_book(book, batch_size=1000):
+    """
+    Deletes a book and everything in it, its history included: transactions, splits, pockets, lot matches,
+    search tokens, archived rows, accounts and groups, with set based DELETEs in dependency order.
+    """
+    archive_database = get_archive_database()
+    transaction_ids = sorted(set(Split.objects.filter(account__group__book=book, transaction__isnull=False)
+                                 .values_list('transaction', flat=True)))
+
+    with transaction.atomic(), transaction.atomic(using=archive_database):
+        Book.all_objects.filter(pk=book.pk).update(**dict((field, None) for field in Book.main_account_fields))
+        raw_delete(SearchToken.objects.filter(book=book))
+        raw_delete(LotMatch.objects.filter(book=book))
+        raw_delete(Split.objects.filter(account__group__book=book))
+        for ids in chunks(transaction_ids, batch_size):
+            raw_delete(Split.objects.filter(transaction__in=ids))
+            raw_delete(Transaction.objects.filter(pk__in=ids))
+        raw_delete(Pocket.objects.filter(account__group__book=book))
+        raw_delete(ArchiveSummary.objects.filter(book=book))
+        raw_delete(ArchivedSplit.objects.filter(transaction__book=book.pk))
+        raw_delete(ArchivedTransaction.objects.filter(book=book.pk))
+        raw_delete(Account.all_objects.filter(group__book=book))
+        Group.all_objects.filter(book=book).update(parent=None)
+        raw_delete(Group.all_objects.filter(book=book))
+        raw_delete(Book.all_objects.filter(pk=book.pk))
+    Book.invalidate_cache(book.pk)
+
+
+@transaction.atomic
+def soft_delete_accounts(account_ids):
+    """
+    Hides accounts, keeping their splits and pockets: their transactions still balance and can still be listed.
+    """
+    account_ids = list(account_ids)
+    books = main_account_books(account_ids)
+    if books:
+        raise KorovaError("Can't delete the main accounts of book %s" % ", ".join(books))
+    groups = list(Account.all_objects.filter(pk__in=account_ids).values_list('group', 'group__book'))
+    Account.all_objects.filter(pk__in=account_ids).update(deleted=True)
+    bump_versions([g for g, b in groups], [b for g, b in groups if b is not None])
+
+
+@transaction.atomic
+def soft_delete_groups(group_ids):
+    group_ids = subtree_group_ids(group_ids)
+    soft_delete_accounts(Account.all_objects.filter(group__in=group_ids).values_list('pk', flat=True))
+    Group.all_objects.filter(pk__in=group_ids).update(deleted=True)
+    bump_versions(group_ids, Group.all_objects.filter(pk__in=group_ids).values_list('book', flat=True))
+
+
+@transaction.atomic
+def soft_delete_book(book):
+    Account.all_objects.filter(group__book=book).update(deleted=True)
+    Group.all_objects.filter(book=book).update(deleted=True)
+    Book.all_objects.filter(pk=book.pk).update(deleted=True)
+    bump_versions([], [book.pk])
@@ -0,0 +1,116 @@
+__author__ = 'aloysio'
+
+import threading
+import time
+from collections import deque
+from decimal import Decimal
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+from django.utils.module_loading import import_by_path
+from routers import use_primary
+
+_pending = threading.local()
+_broker = None
+
+
+class InProcessBroker(object):
+    """
+    Fans balance events out to the subscribers of the same process. Keeps the last backlog events of every
+    book, numbered with a process-wide sequence, so a subscriber that reconnects with the last id it saw
+    gets what it missed.
+    """
+
+    backlog = 1000
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.events = {}
+        self.last_id = 0
+
+    def publish(self, book_id, data):
+        with self.condition:
+            self.last_id += 1
+            self.events.setdefault(book_id, deque(maxlen=self.backlog)).append((self.last_id, data))
+            self.condition.notify_all()
+            return self.last_id
+
+    def current_id(self):
+        return self.last_id
+
+    def listen(self, book_id, last_id, timeout):
+        """
+        Returns the [(id, data), ...] events of book_id newer than last_id, waiting up to timeout seconds
+        for one to be published when there are none yet.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                events = [e for e in self.events.get(book_id, ()) if e[0] > last_id]
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events
+                self.condition.wait(remaining)
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = import_by_path(getattr(settings, 'KOROVA_EVENT_BROKER', 'korova.events.InProcessBroker'))()
+    return _broker
+
+
+def set_broker(broker):
+    global _broker
+    _broker = broker
+
+
+def record(book_id, account_ids):
+    """
+    Remembers the accounts a posting changed; their events are published by flush once it is committed.
+    """
+    if not hasattr(_pending, 'books'):
+        _pending.books = {}
+    _pending.books.setdefault(book_id, set()).update(account_ids)
+
+
+def discard():
+    _pending.books = {}
+
+
+def flush():
+    """
+    Publishes one event per book changed since the last flush, with the current balances of the accounts
+    that were posted to and the book's version. Does nothing while a database transaction is still open:
+    the outermost posting call flushes after committing, and korova.middleware.BalanceEventsMiddleware once
+    the request's transaction is committed. Whoever posts inside an atomic block of their own outside a request
+    flushes after it, or discards if it was rolled back.
+    """
+    if connection.in_atomic_block:
+        return
+    books, _pending.books = getattr(_pending, 'books', {}), {}
+
+    broker = get_broker()
+    for book_id, account_ids in books.items():
+        # read back from the primary, a replica may not have the postings yet
+        with use_primary():
+            event = balance_event(book_id, account_ids)
+        broker.publish(book_id, event)
+
+
+def balance_event(book_id, account_ids):
+    from models import Book, Pocket, DECIMAL_ZERO, QUANTA
+
+    zero = DECIMAL_ZERO.quantize(QUANTA)
+    balances = dict((account_id, (zero, zero)) for account_id in account_ids)
+    for account_id, account_balance, profile_balance in Pocket.objects.filter(
+            account__in=account_ids, account_balance__gt=0).values('account').annotate(
+            Sum('account_balance'), Sum('profile_balance')).values_list(
+            'account', 'account_balance__sum', 'profile_balance__sum'):
+        balances[account_id] = (Decimal(str(account_balance)).quantize(QUANTA),
+                                Decimal(str(profile_balance)).quantize(QUANTA))
+    return {
+        'version': Book.get_version(book_id),
+        'accounts': [[account_id, str(balance[0]), str(balance[1])]
+                     for account_id, balance in sorted(balances.items())],
+    }
@@ -2,4 +2,41 @@ __author__ = 'aloysio'
 
 
 class KorovaError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class KorovaBatchError(KorovaError):
+    """
+    Raised when an all-or-nothing batch fails; index is the position of the failing entry.
+    """
+
+    def __init__(self, index, error):
+        super(KorovaBatchError, self).__init__("Entry %d: %s" % (index, error))
+        self.index = index
+        self.error = error
+
+
+class KorovaChartError(KorovaError):
+    """
+    Raised when a chart of accounts fails validation; errors lists every problem found, not only the first.
+    """
+
+    def __init__(self, errors):
+        super(KorovaChartError, self).__init__("; ".join(errors))
+        self.errors = errors
+
+
+class KorovaRateError(KorovaError):
+    """
+    Raised when no exchange rate provider could answer; errors lists why each one was skipped or failed.
+    """
+
+    def __init__(self, errors):
+        super(KorovaRateError, self).__init__("No exchange rate available: " + "; ".join(errors))
+        self.errors = errors
+
+
+class KorovaRateNotFound(KorovaRateError):
+    """
+    Raised by a provider that works but has no rate for the pair: not a failure of the provider.
+    """
@@ -0,0 +1,201 @@
+__author__ = 'aloysio'
+
+import json
+import math
+import random
+import string
+import threading
+import time
+import urllib2
+from Cookie import SimpleCookie
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+# A scenario is the list of steps every simulated user goes through. A step is a dict with the name results are
+# reported under, the method, the path, an optional JSON body and how many times it is repeated. Body strings of
+# the form $name are replaced with the value of name in the run's context (book_id, debit_account, ...).
+# Steps that aren't GETs are taken to change the book unless they say 'writes': False, see scenario_writes.
+SCENARIOS = {
+    'browse': [
+        {'name': 'perform_login', 'method': 'POST', 'path': '/api/perform_login/', 'writes': False,
+         'data': {'username': '$username', 'password': '$password'}},
+        {'name': 'set_session_book', 'method': 'POST', 'path': '/api/set_session_book/', 'writes': False,
+         'data': {'book_id': '$book_id'}},
+        {'name': 'accounts_list', 'method': 'GET', 'path': '/api/accounts/', 'repeat': 10},
+    ],
+    'post': [
+        {'name': 'perform_login', 'method': 'POST', 'path': '/api/perform_login/', 'writes': False,
+         'data': {'username': '$username', 'password': '$password'}},
+        {'name': 'set_session_book', 'method': 'POST', 'path': '/api/set_session_book/', 'writes': False,
+         'data': {'book_id': '$book_id'}},
+        {'name': 'accounts_list', 'method': 'GET', 'path': '/api/accounts/'},
+        {'name': 'transaction_create', 'method': 'POST', 'path': '/api/transaction/', 'repeat': 5,
+         'data': {'creation_date': '$date', 'description': 'load test',
+                  'splits': [{'account': '$credit_account', 'account_amount': '1.00', 'split_type': 'CREDIT'},
+                             {'account': '$debit_account', 'account_amount': '1.00', 'split_type': 'DEBIT'}]}},
+    ],
+}
+
+
+def scenario_writes(scenario):
+    return any(step.get('writes', step['method'].upper() not in ('GET', 'HEAD')) for step in scenario)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host='127.0.0.1', port=0):
+    """
+    Serves main.wsgi from a background thread and returns the server; its address is server.server_address.
+    """
+    from main.wsgi import application
+    server = make_server(host, port, application, ThreadingWSGIServer, QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def fill(value, context):
+    if isinstance(value, dict):
+        return dict((k, fill(v, context)) for k, v in value.items())
+    if isinstance(value, list):
+        return [fill(v, context) for v in value]
+    if isinstance(value, basestring) and value.startswith('$'):
+        return context[value[1:]]
+    return value
+
+
+class VirtualUser(object):
+    """
+    One client session: keeps its cookies and sends the CSRF cookie back in a header, as the web client does.
+    Logging in rotates the token, so it starts with one of its own.
+    """
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cookies = {'csrftoken': ''.join(random.choice(string.ascii_letters + string.digits) for i in range(32))}
+
+    def request(self, method, path, data=None):
+        """
+        Returns (latency in seconds, ok). A request fails on a connection error, an HTTP error status or,
+        since the api answers some errors with 200, a JSON object carrying an 'error' key.
+        """
+        body = json.dumps(data) if data is not None else None
+        cookies = '; '.join('%s=%s' % cookie for cookie in self.cookies.items())
+        request = urllib2.Request(self.base_url + path, body, {
+            'Content-Type': 'application/json', 'Accept': 'application/json',
+            'Cookie': cookies, 'X-CSRFToken': self.cookies['csrftoken']})
+        request.get_method = lambda: method
+        start = time.time()
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+            content = response.read()
+        except (urllib2.URLError, IOError):
+            return time.time() - start, False
+        latency = time.time() - start
+
+        for header in response.info().getheaders('Set-Cookie'):
+            self.cookies.update((name, morsel.value) for name, morsel in SimpleCookie(header).items())
+        try:
+            answer = json.loads(content)
+        except ValueError:
+            return latency, True
+        return latency, not (isinstance(answer, dict) and 'error' in answer)
+
+    def run(self, scenario, context, iterations=1):
+        samples = []
+        for i in range(iterations):
+            for step in scenario:
+                data = fill(step.get('data'), context)
+                for n in range(step.get('repeat', 1)):
+                    latency, ok = self.request(step['method'], step['path'], data)
+                    samples.append((step['name'], latency, ok))
+        return samples
+
+
+def run_user(args):
+    base_url, scenario, context, iterations = args
+    return VirtualUser(base_url).run(scenario, context, iterations)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return None
+    return values[max(0, min(len(values), int(math.ceil(fraction * len(values)))) - 1)]
+
+
+def summarize(samples, elapsed):
+    """
+    Requests, errors, error rate, throughput (requests/s) and latency percentiles (ms) per endpoint and overall.
+    """
+    def summary(entries):
+        latencies = sorted(latency * 1000 for name, latency, ok in entries)
+        errors = len([ok for name, latency, ok in entries if not ok])
+        return {
+            'requests': len(entries),
+            'errors': errors,
+            'error_rate': float(errors) / len(entries) if entries else 0.0,
+            'throughput': len(entries) / elapsed if elapsed else None,
+            'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': latencies[-1] if latencies else None,
+        }
+
+    endpoints = {}
+    for sample in samples:
+        endpoints.setdefault(sample[0], []).append(sample)
+    return {
+        'elapsed': elapsed,
+        'total': summary(samples),
+        'endpoints': dict((name, summary(entries)) for name, entries in endpoints.items()),
+    }
+
+
+class LoadTest(object):
+    """
+    Runs users virtual users through scenario, concurrency of them at a time, each in a thread or, with
+    processes=True, in a worker process, against base_url. run() returns the summarize report of the run.
+    """
+
+    def __init__(self, base_url, scenario, context, users=10, concurrency=4, iterations=1, processes=False):
+        self.base_url = base_url
+        self.scenario = scenario
+        self.context = context
+        self.users = users
+        self.concurrency = max(1, concurrency)
+        self.iterations = iterations
+        self.processes = processes
+
+    def run(self):
+        if self.processes:
+            from multiprocessing import Pool
+        else:
+            from multiprocessing.pool import ThreadPool as Pool
+
+        pool = Pool(self.concurrency)
+        start = time.time()
+        try:
+            results = pool.map(run_user, [(self.base_url, self.scenario, self.context, self.iterations)] * self.users)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+
+        report = summarize([sample for samples in results for sample in samples], elapsed)
+        report.update({'users': self.users, 'concurrency': self.concurrency, 'iterations': self.iterations,
+                       'pool': 'processes' if self.processes else 'threads'})
+        return report
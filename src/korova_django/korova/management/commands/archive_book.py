@@ -0,0 +1,29 @@
+__author__ = 'aloysio'
+
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from korova.archive import archive_book
+from korova.exceptions import KorovaError
+from korova.models import Book
+
+
+class Command(BaseCommand):
+    args = '<book code>'
+    help = 'Moves the transactions and splits of a closed book to the archive tables'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Number of transactions moved per batch'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: archive_book %s" % self.args)
+
+        try:
+            book = Book.objects.get(code=args[0])
+            archived = archive_book(book, options['batch_size'])
+        except (Book.DoesNotExist, KorovaError) as e:
+            raise CommandError(e)
+
+        self.stdout.write("%d transactions archived" % archived)
@@ -0,0 +1,44 @@
+__author__ = 'aloysio'
+
+import json
+from decimal import Decimal, InvalidOperation
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from korova.consolidation import Consolidation
+from korova.exceptions import KorovaError
+from korova.models import Book, Currency
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class Command(BaseCommand):
+    args = '<book code> [book code ...]'
+    help = 'Consolidates the balances and profit and loss of several books, of any profile, in one currency'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--currency', dest='currency', default='USD', help='Currency of the consolidated report'),
+        make_option('--rate', action='append', dest='rates', default=[],
+                    help='Rate of a currency in the report currency, as CODE=RATE; may be repeated'),
+        make_option('--merge', type='choice', dest='merge', default='code', choices=Consolidation.merge_fields,
+                    help='Merge the accounts of the books on their code or on their name'),
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of worker processes, one per book by default'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Usage: consolidate %s" % self.args)
+
+        try:
+            books = [Book.objects.get(code=code) for code in args]
+            currency = Currency.objects.get(code=options['currency'])
+            rates = dict((code, Decimal(rate)) for code, rate in (r.split('=', 1) for r in options['rates']))
+        except (Book.DoesNotExist, Currency.DoesNotExist) as e:
+            raise CommandError(e)
+        except (ValueError, InvalidOperation):
+            raise CommandError("Rates are given as CODE=RATE")
+
+        try:
+            report = Consolidation(books, currency, rates, options['workers'], options['merge']).run()
+        except KorovaError as e:
+            raise CommandError(e)
+        self.stdout.write(json.dumps(report, cls=JSONEncoder, indent=2))
@@ -0,0 +1,34 @@
+__author__ = 'aloysio'
+
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from korova.charts import chart_formats, export_chart
+from korova.models import Book
+
+
+class Command(BaseCommand):
+    args = '<book code> [chart file]'
+    help = 'Writes the chart of accounts of a book, to the standard output by default'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='pipe',
+                    help='Chart format: pipe, csv or json'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) not in (1, 2):
+            raise CommandError("Usage: export_chart %s" % self.args)
+        if options['format'] not in chart_formats:
+            raise CommandError("Unknown chart format %s" % options['format'])
+
+        try:
+            book = Book.objects.select_related('profile__default_currency').get(code=args[0])
+        except Book.DoesNotExist as e:
+            raise CommandError(e)
+
+        if len(args) == 2:
+            with open(args[1], 'wb') as stream:
+                export_chart(book, stream, options['format'])
+        else:
+            export_chart(book, sys.stdout, options['format'])
@@ -0,0 +1,46 @@
+__author__ = 'aloysio'
+
+import io
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from korova.charts import chart_formats, load_chart
+from korova.exceptions import KorovaChartError
+from korova.models import Book
+
+
+class Command(BaseCommand):
+    args = '<book code> <chart file>'
+    help = 'Creates the groups and accounts of a chart of accounts file in a book'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+                    help='Chart format: pipe, csv or json (guessed from the file extension by default)'),
+        make_option('--account-depth', dest='account_depth', type='int', default=3,
+                    help='Number of segments of the dotted codes of accounts, shallower codes are groups'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Usage: import_chart %s" % self.args)
+        book_code, path = args
+
+        chart_format = options['format'] or {'txt': 'pipe'}.get(path.rsplit('.', 1)[-1].lower(),
+                                                                path.rsplit('.', 1)[-1].lower())
+        if chart_format not in chart_formats:
+            raise CommandError("Unknown chart format %s" % chart_format)
+
+        try:
+            book = Book.objects.select_related('profile').get(code=book_code)
+        except Book.DoesNotExist as e:
+            raise CommandError(e)
+
+        # the csv module wants bytes, the other parsers read text
+        with io.open(path, 'rb') if chart_format == 'csv' else io.open(path, encoding='utf-8') as stream:
+            try:
+                created = load_chart(book, stream, chart_format, options['account_depth'])
+            except KorovaChartError as e:
+                for error in e.errors:
+                    self.stderr.write(error)
+                raise CommandError("%d problems found, nothing was created" % len(e.errors))
+
+        self.stdout.write("%d groups and accounts created" % len(created))
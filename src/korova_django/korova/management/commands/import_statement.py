@@ -0,0 +1,70 @@
+__author__ = 'aloysio'
+
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from korova.exceptions import KorovaError
+from korova.models import Account
+from korova.statements import StatementImporter, parse_csv, parse_ofx, statement_range
+
+
+class Command(BaseCommand):
+    args = '<account code> <statement file>'
+    help = 'Reconciles a CSV or OFX bank statement against an account, posting the lines that have no matching split'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+                    help='Statement format: csv or ofx (guessed from the file extension by default)'),
+        make_option('--contra', dest='contra', default=None,
+                    help='Code of the account unmatched lines are posted against. Without it nothing is posted'),
+        make_option('--window', dest='window', type='int', default=3,
+                    help='Maximum distance, in days, between a statement line and the split it matches'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+                    help='Number of unmatched lines posted per batch'),
+        make_option('--date-format', dest='date_format', default='%Y-%m-%d',
+                    help='Date format of CSV statements'),
+        make_option('--delimiter', dest='delimiter', default=',',
+                    help='Column delimiter of CSV statements'),
+        make_option('--decimal-comma', action='store_true', dest='decimal_comma', default=False,
+                    help='CSV amounts use a comma as decimal separator'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Usage: import_statement %s" % self.args)
+        account_code, path = args
+
+        statement_format = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if statement_format not in ('csv', 'ofx'):
+            raise CommandError("Unknown statement format %s" % statement_format)
+
+        try:
+            account = Account.objects.get(code=account_code)
+            contra_account = Account.objects.get(code=options['contra']) if options['contra'] else None
+        except Account.DoesNotExist as e:
+            raise CommandError(e)
+
+        def read_lines(stream):
+            if statement_format == 'csv':
+                return parse_csv(stream, date_format=options['date_format'], delimiter=options['delimiter'],
+                                 decimal_comma=options['decimal_comma'])
+            return parse_ofx(stream)
+
+        # the whole file is checked before anything is posted: batches are committed as they go, and
+        # a file that fails half way would leave the first half posted. Lines already posted by an
+        # earlier run match their splits, so running the import again doesn't post them twice.
+        try:
+            with open(path, 'rb') as stream:
+                start, end, count = statement_range(read_lines(stream))
+            if not count:
+                raise CommandError("The statement has no lines")
+            with open(path, 'rb') as stream:
+                importer = StatementImporter(account, contra_account, date_window=options['window'],
+                                             batch_size=options['batch_size'], start=start,
+                                             end=end).run(read_lines(stream))
+        except KorovaError as e:
+            raise CommandError(e)
+
+        self.stdout.write("matched: %d, unmatched: %d, posted: %d, failed: %d" %
+                          (importer.matched, importer.unmatched, importer.posted, len(importer.errors)))
+        for line, error in importer.errors:
+            self.stdout.write(u"%s: %s" % (unicode(line), error))
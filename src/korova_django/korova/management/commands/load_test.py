@@ -0,0 +1,86 @@
+__author__ = 'aloysio'
+
+import json
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from korova.loadtest import SCENARIOS, LoadTest, scenario_writes, start_server
+from korova.models import Account, Book
+
+
+class Command(BaseCommand):
+    args = '<book code>'
+    help = 'Drives simulated users through an api scenario and reports throughput and latency percentiles as JSON'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--scenario', dest='scenario', default='browse',
+                    help='Built-in scenario (%s) or a JSON file with a list of steps' % ', '.join(sorted(SCENARIOS))),
+        make_option('--username', dest='username', help='User the simulated clients log in as'),
+        make_option('--password', dest='password', help='Password of that user'),
+        make_option('--accounts', dest='accounts', default=None,
+                    help='Codes of the debit and credit accounts posted to, separated by a comma'),
+        make_option('--users', type='int', dest='users', default=10, help='Number of simulated users'),
+        make_option('--concurrency', type='int', dest='concurrency', default=4,
+                    help='Number of users running at the same time'),
+        make_option('--iterations', type='int', dest='iterations', default=1,
+                    help='Times every user goes through the scenario'),
+        make_option('--processes', action='store_true', dest='processes', default=False,
+                    help='Run the users in worker processes instead of threads'),
+        make_option('--url', dest='url', default=None,
+                    help='Base url of a running server; by default main.wsgi is served locally for the run'),
+        make_option('--output', dest='output', default=None, help='Write the report to this file'),
+        make_option('--allow-writes', action='store_true', dest='allow_writes', default=False,
+                    help='Let a scenario that posts (such as post) write into the book; use a test book'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or not options['username'] or options['password'] is None:
+            raise CommandError("Usage: load_test %s --username <user> --password <password>" % self.args)
+
+        try:
+            book = Book.objects.get(code=args[0])
+        except Book.DoesNotExist as e:
+            raise CommandError(e)
+
+        scenario = SCENARIOS.get(options['scenario'])
+        if scenario is None:
+            try:
+                with open(options['scenario']) as stream:
+                    scenario = json.load(stream)
+            except (IOError, ValueError) as e:
+                raise CommandError("Could not read scenario %s: %s" % (options['scenario'], e))
+
+        if scenario_writes(scenario) and not options['allow_writes']:
+            raise CommandError("Scenario %s posts into book %s: run it against a test book with --allow-writes"
+                               % (options['scenario'], book.code))
+
+        accounts = Account.objects.filter(group__book=book).order_by('code')
+        if options['accounts']:
+            codes = options['accounts'].split(',')
+            accounts = sorted(accounts.filter(code__in=codes), key=lambda a: codes.index(a.code))
+        accounts = list(accounts[:2])
+        if len(accounts) < 2:
+            raise CommandError("Book %s needs a debit and a credit account" % book.code)
+
+        context = {'username': options['username'], 'password': options['password'], 'book_id': book.pk,
+                   'debit_account': accounts[0].pk, 'credit_account': accounts[1].pk,
+                   'date': timezone.now().strftime('%Y-%m-%dT%H:%M:%S')}
+
+        server = None
+        url = options['url']
+        if url is None:
+            server = start_server()
+            url = 'http://%s:%d' % server.server_address
+        try:
+            report = LoadTest(url, scenario, context, options['users'], options['concurrency'],
+                              options['iterations'], options['processes']).run()
+        finally:
+            if server is not None:
+                server.shutdown()
+
+        report.update({'scenario': options['scenario'], 'url': url, 'book': book.code})
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                stream.write(output)
+        self.stdout.write(output)
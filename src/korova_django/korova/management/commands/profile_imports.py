@@ -0,0 +1,78 @@
+__author__ = 'aloysio'
+
+import json
+import os
+import subprocess
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+
+# modules imported by a worker while booting, measured in this order
+BOOT_MODULES = (
+    'korova.models',
+    'korova.tools',
+    'api.views',
+    'main.views',
+    'main.urls',
+    'main.wsgi',
+)
+
+# the optional third party libraries that should only be loaded when an exchange rate is actually requested;
+# stdlib modules like urllib2 are left out, Django or any app module may import them legitimately
+HEAVY_MODULES = ('suds', 'suds.client', 'bs4')
+
+# runs in a fresh interpreter, so every measure starts from a cold sys.modules
+PROBE_SCRIPT = """
+import json, sys, time
+before = set(sys.modules)
+start = time.time()
+__import__(sys.argv[1])
+elapsed = (time.time() - start) * 1000.0
+heavy = [m for m in sys.argv[2:] if m in sys.modules and m not in before]
+print(json.dumps({'module': sys.argv[1], 'ms': elapsed, 'modules': len(sys.modules), 'heavy': heavy}))
+"""
+
+
+def measure_import(module, heavy_modules=HEAVY_MODULES):
+    """
+    Imports module in a new interpreter and returns a dict with the elapsed time (ms), the number of
+    loaded modules and the heavy modules that came along with it.
+    """
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'main.settings')
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(sys.modules['korova'].__file__)))
+    process = subprocess.Popen([sys.executable, '-c', PROBE_SCRIPT, module] + list(heavy_modules),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=cwd)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise CommandError("Could not import %s:\n%s" % (module, err))
+    return json.loads(out.strip().splitlines()[-1])
+
+
+class Command(BaseCommand):
+    args = '[module ...]'
+    help = 'Measures the cold import time of the modules loaded when a worker boots'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--max-ms', type='float', dest='max_ms', default=None,
+                    help='Fail if any module takes longer than this to import'),
+        make_option('--json', action='store_true', dest='json', default=False,
+                    help='Output the report as JSON'),
+    )
+
+    def handle(self, *args, **options):
+        modules = args or BOOT_MODULES
+        report = [measure_import(module) for module in modules]
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            for entry in report:
+                self.stdout.write("%-20s %9.1f ms %5d modules  heavy: %s" %
+                                  (entry['module'], entry['ms'], entry['modules'], ', '.join(entry['heavy']) or '-'))
+
+        failures = [entry for entry in report if entry['heavy'] or
+                    (options['max_ms'] is not None and entry['ms'] > options['max_ms'])]
+        if failures:
+            raise CommandError("Boot regression in: %s" % ', '.join(entry['module'] for entry in failures))
@@ -0,0 +1,37 @@
+__author__ = 'aloysio'
+
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from korova.models import Account, Book
+from korova.replay import PocketRebuild
+
+
+class Command(BaseCommand):
+    args = '<book code>'
+    help = 'Regenerates the pockets, lot matches and imbalances of a book by replaying its splits in date order'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--account', action='append', dest='accounts', default=[],
+                    help='Rebuild only the account with this code (repeatable)'),
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of worker processes rebuilding accounts in parallel'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: rebuild_pockets %s" % self.args)
+
+        try:
+            book = Book.objects.get(code=args[0])
+        except Book.DoesNotExist as e:
+            raise CommandError(e)
+
+        accounts = None
+        if options['accounts']:
+            accounts = list(Account.objects.filter(group__book=book, code__in=options['accounts']))
+            missing = set(options['accounts']) - set(a.code for a in accounts)
+            if missing:
+                raise CommandError("Unknown accounts: %s" % ', '.join(sorted(missing)))
+
+        rebuild = PocketRebuild(book, accounts, options['workers']).run()
+        self.stdout.write("%d splits replayed, %d profile amounts changed" % (rebuild.replayed, rebuild.changed))
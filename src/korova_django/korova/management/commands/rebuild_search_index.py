@@ -0,0 +1,15 @@
+__author__ = 'aloysio'
+
+from django.core.management.base import BaseCommand
+from korova.models import Book, SearchToken
+
+
+class Command(BaseCommand):
+    args = '[book code ...]'
+    help = 'Rebuilds the transaction search index of the given books (all books by default)'
+
+    def handle(self, *args, **options):
+        books = Book.objects.filter(code__in=args) if args else Book.objects.all()
+        for book in books:
+            SearchToken.reindex_book(book)
+            self.stdout.write("%s: %d tokens" % (book.code, book.search_tokens.count()))
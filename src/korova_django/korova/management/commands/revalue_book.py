@@ -0,0 +1,44 @@
+__author__ = 'aloysio'
+
+from optparse import make_option
+from decimal import Decimal, InvalidOperation
+from django.core.management.base import BaseCommand, CommandError
+from korova.exceptions import KorovaError
+from korova.models import Account, Book
+from korova.revaluation import Revaluation
+
+
+class Command(BaseCommand):
+    args = '<book code>'
+    help = 'Revalues the open balances of the foreign accounts of a book and optionally posts the adjustments'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rate', action='append', dest='rates', default=[],
+                    help='Rate of a currency in the profile currency, e.g. --rate USD=2.25 (repeatable). '
+                         'Missing currencies are asked to the exchange rate provider'),
+        make_option('--post', dest='adjustment', default=None,
+                    help='Post the adjustments against the account with this code'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: revalue_book %s" % self.args)
+
+        rates = {}
+        for rate in options['rates']:
+            try:
+                code, value = rate.split('=')
+                rates[code.upper()] = Decimal(value)
+            except (ValueError, InvalidOperation):
+                raise CommandError("Invalid rate %s" % rate)
+
+        try:
+            book = Book.objects.select_related('profile').get(code=args[0])
+            revaluation = Revaluation(book, rates)
+            for entry in revaluation:
+                self.stdout.write("%(account)6d %(balance)18s %(cost)18s %(market_value)18s %(unrealized)18s" % entry)
+            if options['adjustment']:
+                posted = revaluation.post(Account.objects.get(code=options['adjustment']))
+                self.stdout.write("%d adjusting entries posted" % len(posted))
+        except (Book.DoesNotExist, Account.DoesNotExist, KorovaError) as e:
+            raise CommandError(e)
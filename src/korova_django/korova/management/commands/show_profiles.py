@@ -0,0 +1,59 @@
+__author__ = 'aloysio'
+
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from korova.profiling import get_profile_dir, list_captures, load_capture, slowest_queries, top_functions
+
+
+class Command(BaseCommand):
+    args = '[capture ...]'
+    help = 'Lists the requests profiled by ProfilerMiddleware, or summarizes the given captures'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--top', type='int', dest='top', default=20,
+                    help='Number of functions and queries shown per capture'),
+        make_option('--sort', type='choice', dest='sort', default='cumulative',
+                    choices=('cumulative', 'tottime', 'calls'),
+                    help='Order of the functions: cumulative, tottime or calls'),
+        make_option('--last', action='store_true', dest='last', default=False,
+                    help='Summarize the most recent capture'),
+    )
+
+    def handle(self, *args, **options):
+        if not get_profile_dir():
+            raise CommandError("KOROVA_PROFILE_DIR is not set, nothing is profiled")
+        names = list(args)
+        if options['last']:
+            names.extend(list_captures()[-1:])
+
+        if not names:
+            for name in list_captures():
+                capture = load_capture(name)
+                self.stdout.write("%s  %s %-40s %3d %8.1f ms %4d queries" % (
+                    name, capture['method'], capture['path'], capture['status'], capture['elapsed'] * 1000,
+                    len(capture['queries'])))
+            return
+
+        for name in names:
+            try:
+                capture = load_capture(name)
+            except IOError:
+                raise CommandError("No capture %s in %s" % (name, get_profile_dir()))
+
+            sql_time = sum(float(q['time']) for q in capture['queries'])
+            self.stdout.write("%s %s -> %d, %s, user %s, book %s" % (
+                capture['method'], capture['path'], capture['status'],
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(capture['started'])),
+                capture['user'], capture['book']))
+            self.stdout.write("%.1f ms, %d queries taking %.1f ms" % (
+                capture['elapsed'] * 1000, len(capture['queries']), sql_time * 1000))
+
+            self.stdout.write("\n%8s %10s %10s  function" % ('calls', 'tottime', 'cumtime'))
+            for function, calls, total, cumulative in top_functions(capture, options['top'], options['sort']):
+                self.stdout.write("%8d %10.4f %10.4f  %s" % (calls, total, cumulative, function))
+
+            self.stdout.write("\n%10s  query" % 'ms')
+            for query in slowest_queries(capture, options['top']):
+                self.stdout.write("%10.1f  [%s] %s" % (float(query['time']) * 1000, query['alias'], query['sql']))
+            self.stdout.write("")
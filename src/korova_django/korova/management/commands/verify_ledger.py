@@ -0,0 +1,38 @@
+__author__ = 'aloysio'
+
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from korova.models import Book
+from korova.verification import LedgerVerification
+
+
+class Command(BaseCommand):
+    args = '<book code>'
+    help = 'Checks that account balances, pockets and splits of a book agree and that every transaction balances'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of worker processes verifying accounts in parallel'),
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help='Verify every account, not only the ones posted to since the last verification'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: verify_ledger %s" % self.args)
+
+        try:
+            book = Book.objects.get(code=args[0])
+        except Book.DoesNotExist as e:
+            raise CommandError(e)
+
+        verification = LedgerVerification(book, options['workers'], options['full']).run()
+        for account_id, message in verification.problems:
+            self.stdout.write("account %d: %s" % (account_id, message))
+        for transaction_id in verification.unbalanced:
+            self.stdout.write("transaction %d: debits and credits differ" % transaction_id)
+
+        self.stdout.write("%d accounts checked" % verification.checked)
+        if not verification.is_valid():
+            raise CommandError("%d account problems, %d unbalanced transactions" % (
+                len(verification.problems), len(verification.unbalanced)))
@@ -0,0 +1,111 @@
+__author__ = 'aloysio'
+
+import cProfile
+import random
+import time
+from django.conf import settings
+from django.db import connections
+from korova import events
+from korova.profiling import get_profile_dir, save_capture
+from korova.routers import pin_primary, reset_pin
+
+PIN_COOKIE = 'korova_primary_pin'
+PIN_COOKIE_SALT = 'korova.middleware.ReplicaPinMiddleware'
+
+
+class ReplicaPinMiddleware(object):
+    """
+    Pins requests that write (and, for a few seconds afterwards, every request of the same client)
+    to the primary database, so a client always reads what it has just posted. The pin travels in a
+    signed cookie: reading it from the session would already be a read, possibly from a lagging replica.
+    Should come before any middleware that reads the database.
+    """
+
+    write_methods = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+    def process_request(self, request):
+        # threads are reused between requests, so never inherit a pin from the previous one
+        reset_pin()
+        try:
+            pinned_until = float(request.get_signed_cookie(PIN_COOKIE, 0, salt=PIN_COOKIE_SALT))
+        except ValueError:
+            pinned_until = 0
+        if request.method in self.write_methods or pinned_until > time.time():
+            pin_primary()
+
+    def process_response(self, request, response):
+        reset_pin()
+        if request.method in self.write_methods and response.status_code < 400:
+            pin_seconds = getattr(settings, 'KOROVA_PRIMARY_PIN_SECONDS', 5)
+            response.set_signed_cookie(PIN_COOKIE, repr(time.time() + pin_seconds), salt=PIN_COOKIE_SALT,
+                                       max_age=pin_seconds, httponly=True)
+        return response
+
+
+class BalanceEventsMiddleware(object):
+    """
+    Publishes the balance events of a request's postings once its database transaction is committed: postings
+    made inside an outer atomic block (an atomic view, ATOMIC_REQUESTS) can't publish them themselves. The events
+    of a request that failed are dropped, and none are left for the next request served by the same thread.
+    """
+
+    def process_request(self, request):
+        events.discard()
+
+    def process_exception(self, request, exception):
+        events.discard()
+
+    def process_response(self, request, response):
+        events.flush()
+        return response
+
+
+class ProfilerMiddleware(object):
+    """
+    Profiles the view of a request with cProfile, with the SQL query log on, and stores both with
+    korova.profiling.save_capture. Only requests carrying an X-Korova-Profile header equal to
+    KOROVA_PROFILE_TOKEN, or picked at KOROVA_PROFILE_SAMPLE_RATE, are profiled, and only when KOROVA_PROFILE_DIR
+    is set. The profiler is switched on in process_view and off in process_response, so the view still runs
+    the way the handler runs it: inside ATOMIC_REQUESTS' transaction, through the exception middleware.
+    Should be the last middleware.
+    """
+
+    def should_profile(self, request):
+        if not get_profile_dir():
+            return False
+        token = getattr(settings, 'KOROVA_PROFILE_TOKEN', None)
+        if token and request.META.get('HTTP_X_KOROVA_PROFILE') == token:
+            return True
+        rate = getattr(settings, 'KOROVA_PROFILE_SAMPLE_RATE', 0)
+        return rate > 0 and random.random() < rate
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not self.should_profile(request):
+            return None
+
+        # log the queries even with DEBUG off, keeping only the ones this request ran
+        debug_cursors = [(c, c.use_debug_cursor, len(c.queries)) for c in connections.all()]
+        for c, debug_cursor, offset in debug_cursors:
+            c.use_debug_cursor = True
+
+        profiler = cProfile.Profile()
+        request.korova_profile = (profiler, time.time(), debug_cursors)
+        profiler.enable()
+        return None
+
+    def process_response(self, request, response):
+        # the last middleware's process_response runs first, right after the view and its template
+        profile = getattr(request, 'korova_profile', None)
+        if profile is None:
+            return response
+        profiler, start, debug_cursors = profile
+        profiler.disable()
+        del request.korova_profile
+
+        elapsed = time.time() - start
+        queries = []
+        for c, debug_cursor, offset in debug_cursors:
+            queries.extend(dict(q, alias=c.alias) for q in c.queries[offset:])
+            c.use_debug_cursor = debug_cursor
+        save_capture(profiler, request, response.status_code, elapsed, queries)
+        return response
@@ -1,10 +1,24 @@
 from django.db import models
 
 
+class LiveManager(models.Manager):
+    """
+    Leaves the soft deleted rows out of every queryset, including the reverse related managers.
+    """
+
+    def get_queryset(self):
+        return super(LiveManager, self).get_queryset().filter(deleted=False)
+
+
 class KorovaEntity(models.Model):
 
     code = models.CharField(max_length=30, unique=True)
     name = models.CharField(max_length=200)
+    # soft deleted entities keep their history but are hidden from querysets, see korova.deletion
+    deleted = models.BooleanField(default=False)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
 
     class Meta:
         abstract = True
@@ -1,17 +1,45 @@
 from django.db import models
-from exceptions import KorovaError
+from exceptions import KorovaError, KorovaBatchError
 from decimal import Decimal
+from django.utils.encoding import force_text
+import hashlib
+import re
+import unicodedata
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from datetime import datetime, time
 from django.core.urlresolvers import reverse
 from django.db import transaction
+from django.core.cache import cache
 from django.contrib.auth.models import User
 from mixins import KorovaEntity
+import events
 
 
 DECIMAL_ZERO = Decimal(0)
 QUANTA = Decimal(10) ** (-6)
 
 
+def parse_transaction_date(value):
+    """
+    Accepts a datetime or an ISO formatted date/datetime string and returns an aware datetime.
+    """
+    if isinstance(value, basestring):
+        try:
+            parsed = parse_datetime(value) or parse_date(value)
+        except ValueError:
+            # well formed but out of range, e.g. 2014-02-30
+            parsed = None
+        if parsed is None:
+            raise KorovaError("Invalid transaction date %s" % value)
+        value = parsed
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time())
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return value
+
+
 # TODO: REFACTOR THIS WHOLE THING TO USE ACCOUNT NATURE
 class SplitProcessor(object):
     def __init__(self, account, increase_operation, decrease_operation):
@@ -40,6 +68,9 @@ class SplitProcessor(object):
         split.is_linked  = True
         split.save()
 
+        if split.split_type == self.decrease_operation and self.account.is_foreign():
+            LotMatch.record(split, self.account.consumed_lots)
+
         # Now reprocess all the future splits:
         for f_split in future_splits:
             self.process(f_split)
@@ -54,6 +85,8 @@ class SplitProcessor(object):
             return_amount = self.account.deduct_amount(split.account_amount)
         elif split.split_type == self.decrease_operation:
             return_amount = self.account.increase_amount(split.account_amount, split.profile_amount)
+            if split.pk is not None:
+                LotMatch.forget(split)
 
         split.is_linked = False
         split.profile_amount = 0
@@ -88,6 +121,9 @@ class EnumField(models.Field):
         super(EnumField, self).__init__(*args, **kwargs)
 
     def db_type(self, connection):
+        if connection.vendor != 'mysql':
+            # ENUM is MySQL only, other backends (e.g. SQLite for local replicas) get a plain column
+            return "varchar({0})".format(max(len(v) for v in self.values))
         return "enum({0})".format(','.join("'%s'" % v for v in self.values))
 
 
@@ -107,28 +143,33 @@ class Profile(models.Model):
     accounting_mode = EnumField(values=('LIFO', 'FIFO'))  # for now, FIFO is assumed
     default_currency = models.ForeignKey(Currency)
     name = models.CharField(max_length=300)
-    exchange_rate_provider = None
+    _exchange_rate_provider = None
     user = models.OneToOneField(User)
     active_book = None
 
-    def __init__(self, *args, **kwargs):
-        from currencies import XERateProvider
-        super(Profile, self).__init__(*args, **kwargs)
-        try:
-            self.set_exchange_rate_provider(XERateProvider())
-        except AttributeError:
-            pass
-
     @classmethod
     def create(cls, default_currency, name, user, accounting_mode='FIFO'):
-        from currencies import XERateProvider
         instance = cls.objects.create(default_currency=default_currency,
                                       accounting_mode=accounting_mode, name=name, user=user)
-        instance.set_exchange_rate_provider(XERateProvider())
         return instance
 
+    @property
+    def exchange_rate_provider(self):
+        # built on first use: most profiles loaded from the database never need a rate
+        if self._exchange_rate_provider is None:
+            from currencies import get_default_rate_matrix
+            self._exchange_rate_provider = get_default_rate_matrix()
+        return self._exchange_rate_provider
+
     def set_exchange_rate_provider(self, provider):
-        self.exchange_rate_provider = provider
+        self._exchange_rate_provider = provider
+
+    def save(self, *args, **kwargs):
+        rv = super(Profile, self).save(*args, **kwargs)
+        # cached books carry a copy of their profile
+        for book_id in self.books.values_list('pk', flat=True):
+            Book.invalidate_cache(book_id)
+        return rv
 
     def create_book(self, code, name, start, end=None):
         return Book.objects.create(start=start, code=code, name=name, end=end, profile=self)
@@ -145,6 +186,10 @@ class Book(KorovaEntity):
     profit_loss_acc = models.ForeignKey('Account', null=True, blank=True, related_name='profit_loss_acc')
     currency_xe_income_acc = models.ForeignKey('Account', null=True, blank=True, related_name='currency_xe_income_acc')
     currency_xe_expense_acc = models.ForeignKey('Account', null=True, blank=True, related_name='currency_xe_expense_acc')
+    # bumped whenever anything in the book changes (postings, chart of accounts, the book itself)
+    version = models.PositiveIntegerField(default=0)
+    # the transactions of an archived book were moved to the archive tables, see korova.archive
+    archived = models.BooleanField(default=False)
 
     def create_top_level_group(self, name, code):
         return Group.objects.create(code=code, name=name, book=self, parent=None)
@@ -160,21 +205,107 @@ class Book(KorovaEntity):
     def __unicode__(self):
         return "%s: (%s to %s)" % (self.profile, self.start, self.end)
 
+    main_account_fields = ('initial_balances_acc', 'profit_loss_acc',
+                           'currency_xe_income_acc', 'currency_xe_expense_acc')
+
+    cache_key_template = 'korova-book-%s'
+    cache_version_key_template = 'korova-book-version-%s'
+
+    def save(self, *args, **kwargs):
+        # version is only ever changed by bump_version, never overwritten from a (possibly cached) instance
+        if self.pk is not None and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.local_fields if f.name not in ('id', 'version')]
+            rv = super(Book, self).save(*args, **kwargs)
+            Book.bump_version(self.pk)
+        else:
+            rv = super(Book, self).save(*args, **kwargs)
+        Book.invalidate_cache(self.pk)
+        return rv
+
+    @classmethod
+    def bump_version(cls, book_id):
+        if book_id is not None:
+            cls.objects.filter(pk=book_id).update(version=models.F('version') + 1)
+
+    @classmethod
+    def get_version(cls, book_id):
+        versions = cls.objects.filter(pk=book_id).values_list('version', flat=True)
+        return versions[0] if versions else None
+
+    def delete(self, *args, **kwargs):
+        # set based, the collector would load every split and pocket of the book, see korova.deletion
+        from deletion import purge_book
+        purge_book(self)
+
+    def soft_delete(self):
+        from deletion import soft_delete_book
+        soft_delete_book(self)
+
+    @classmethod
+    def get_cache_version(cls, book_id):
+        version_key = cls.cache_version_key_template % book_id
+        version = cache.get(version_key)
+        if version is None:
+            cache.add(version_key, 1, None)
+            version = cache.get(version_key, 1)
+        return version
+
+    @classmethod
+    def invalidate_cache(cls, book_id):
+        try:
+            cache.incr(cls.cache_version_key_template % book_id)
+        except ValueError:
+            # nothing was cached for this book yet
+            pass
+
+    @classmethod
+    def get_cached(cls, book_id):
+        """
+        Returns the book with its profile and main accounts already loaded, going to the database
+        only when the shared cache has no entry for the book's current version.
+        The main accounts are snapshots: reload them before posting to them.
+        """
+        key = cls.cache_key_template % book_id
+        version = cls.get_cache_version(book_id)
+        book = cache.get(key, version=version)
+        if book is None:
+            book = cls.objects.select_related('profile', 'profile__default_currency',
+                                              *cls.main_account_fields).get(pk=book_id)
+            for field in cls.main_account_fields:
+                account = getattr(book, field)
+                if account is not None:
+                    account.profile = book.profile
+            cache.set(key, book, version=version)
+        return book
+
     @classmethod
     def get_active_book(cls, request):
+        # the resolved book is memoized on the request, keyed by the session's book id so that
+        # switching books in the middle of a request is still honoured
+        http_request = getattr(request, '_request', request)
         try:
             book_id = request.session['book_id']
-            book = cls.objects.get(pk=book_id)
-            return book
-        except (KeyError, cls.DoesNotExist):
-            pass
+        except KeyError:
+            return None
 
-        return None
+        resolved = getattr(http_request, '_korova_active_book', None)
+        if resolved is not None and resolved[0] == book_id:
+            return resolved[1]
+
+        try:
+            book = cls.get_cached(book_id)
+        except cls.DoesNotExist:
+            book = None
+
+        http_request._korova_active_book = (book_id, book)
+        return book
 
 
 class Group(KorovaEntity):
     book = models.ForeignKey(Book, related_name='groups')
     parent = models.ForeignKey('self', null=True, blank=True, related_name='children')
+    # bumped when the group itself, one of its accounts or their balances change (not its subgroups)
+    version = models.PositiveIntegerField(default=0)
 
     def create_child(self, name, code):
         child = Group.objects.create(code=code, name=name, book=self.book, parent=self)
@@ -188,6 +319,33 @@ class Group(KorovaEntity):
         acc.save()
         return acc
 
+    def save(self, *args, **kwargs):
+        if self.pk is not None and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.local_fields if f.name not in ('id', 'version')]
+            rv = super(Group, self).save(*args, **kwargs)
+            Group.bump_versions([self.pk])
+        else:
+            rv = super(Group, self).save(*args, **kwargs)
+        Book.bump_version(self.book_id)
+        return rv
+
+    @classmethod
+    def bump_versions(cls, group_ids):
+        group_ids = [pk for pk in group_ids if pk is not None]
+        if group_ids:
+            cls.objects.filter(pk__in=group_ids).update(version=models.F('version') + 1)
+
+    def delete(self, *args, **kwargs):
+        """
+        Deletes the group with its subgroups and accounts. Raises KorovaError if any of them has linked splits.
+        """
+        from deletion import purge_groups
+        purge_groups([self.pk])
+
+    def soft_delete(self):
+        from deletion import soft_delete_groups
+        soft_delete_groups([self.pk])
+
     def __unicode__(self):
         return "%s - %s" % (self.code, self.name)
 
@@ -199,6 +357,9 @@ class Group(KorovaEntity):
 
 class Account(KorovaEntity):
     imbalance = models.DecimalField(max_digits=18, decimal_places=6, default=DECIMAL_ZERO)
+    # rolling hash of every amount moved in or out of the account's pockets, see korova.verification
+    chain = models.CharField(max_length=40, blank=True, default='')
+    verified_chain = models.CharField(max_length=40, blank=True, default='')
     group = models.ForeignKey(Group, related_name='accounts', null=True)
     currency = models.ForeignKey(Currency)
     account_type = EnumField(values=(
@@ -227,13 +388,39 @@ class Account(KorovaEntity):
     }
 
     split_processor = None
+    _profile = None
 
-    def __init__(self, *args, **kwargs):
-        super(Account, self).__init__(*args, **kwargs)
-        try:
-            self.profile = self.group.book.profile
-        except AttributeError:
-            pass
+    @property
+    def profile(self):
+        # resolved on first use, so loading accounts in bulk doesn't cost two queries per row
+        if self._profile is None:
+            if self.group is None:
+                raise AttributeError("Account has no group and no profile was set")
+            self._profile = self.group.book.profile
+        return self._profile
+
+    @profile.setter
+    def profile(self, value):
+        self._profile = value
+
+    def save(self, *args, **kwargs):
+        rv = super(Account, self).save(*args, **kwargs)
+        # imbalance only moves while posting, and Transaction.create bumps the version itself
+        if kwargs.get('update_fields') != ['imbalance', 'chain'] and self.group_id is not None:
+            Group.bump_versions([self.group_id])
+            Book.bump_version(self.group.book_id)
+        return rv
+
+    def delete(self, *args, **kwargs):
+        """
+        Raises KorovaError if the account has linked splits: those can only be soft deleted.
+        """
+        from deletion import purge_accounts
+        purge_accounts([self.pk])
+
+    def soft_delete(self):
+        from deletion import soft_delete_accounts
+        soft_delete_accounts([self.pk])
 
     def get_nature(self):
         return self.account_natures[str(self.account_type)]
@@ -291,49 +478,81 @@ class Account(KorovaEntity):
             raise KorovaError('Different amounts in local account')
 
         # fix account imbalance
-        inc_account_amount = max(0, account_amount - self.imbalance)
-
-        inc_profile_amount = ((profile_amount*inc_account_amount)/account_amount).quantize(QUANTA)
-
-        new_imbalance = max(0, self.imbalance - account_amount)
-        self.imbalance = new_imbalance
+        inc_account_amount, self.imbalance = self.split_increase(self.imbalance, account_amount)
         if inc_account_amount <= 0:
+            self.roll_chain('+', account_amount, DECIMAL_ZERO)
             return DECIMAL_ZERO
 
+        inc_profile_amount = ((profile_amount*inc_account_amount)/account_amount).quantize(QUANTA)
         #print 'increase_amount[2] inc_account_amount, inc_profile_amount:', inc_account_amount, inc_profile_amount
         profile_amt = self.create_pocket(inc_account_amount, inc_profile_amount)
-        self.save()
+        self.roll_chain('+', account_amount, profile_amt)
         #print 'increase_amount[3] profile_amt:',profile_amt
         return profile_amt
 
-    def deduct_amount(self, amount):
-        available_pockets = self.pockets.filter(account_balance__gt=0)
-        amount_to_cover = Decimal(amount).quantize(QUANTA)
+    @staticmethod
+    def split_increase(imbalance, account_amount):
+        """
+        Splits an increase between the imbalance, which absorbs it first, and the pocket it opens with the rest.
+        Returns (pocket account amount, imbalance left). Shared with the in memory replay.
+        """
+        return max(DECIMAL_ZERO, account_amount - imbalance), max(DECIMAL_ZERO, imbalance - account_amount)
+
+    @staticmethod
+    def consume_pockets(pockets, amount):
+        """
+        Takes amount out of pockets (Pocket instances with a balance, oldest first), updating their balances.
+        Returns (profile cost, [(pocket id, account amount, profile cost), ...] of the pockets touched, amount that
+        could not be covered). Shared with the in memory replay.
+        """
+        amount_to_cover = amount
         profile_currency_cost = DECIMAL_ZERO
-
-        for pocket in available_pockets:
-
+        lots = []
+        for pocket in pockets:
+            if amount_to_cover <= DECIMAL_ZERO:
+                break
             if pocket.account_balance > amount_to_cover:
                 profile_amount = ((pocket.profile_amount*amount_to_cover)/pocket.account_amount).quantize(QUANTA)
                 profile_currency_cost += profile_amount
+                lots.append((pocket.pk, amount_to_cover, profile_amount))
                 pocket.account_balance -= amount_to_cover
                 pocket.profile_balance -= profile_amount
-                if pocket.account_balance == DECIMAL_ZERO:
-                    pocket.delete()
-                else:
-                    pocket.save()
                 amount_to_cover = DECIMAL_ZERO
-                break
             else:
                 amount_to_cover -= pocket.account_balance
                 profile_currency_cost += pocket.profile_balance
+                lots.append((pocket.pk, pocket.account_balance, pocket.profile_balance))
+                pocket.account_balance = DECIMAL_ZERO
+                pocket.profile_balance = DECIMAL_ZERO
+        return profile_currency_cost, lots, amount_to_cover
+
+    @staticmethod
+    def next_chain(chain, operation, account_amount, profile_amount):
+        link = '%s|%s|%s|%s' % (chain, operation, account_amount, Decimal(profile_amount).quantize(QUANTA))
+        return hashlib.sha1(link).hexdigest()
+
+    def roll_chain(self, operation, account_amount, profile_amount):
+        # saves the imbalance as well: every pocket movement goes through here
+        self.chain = self.next_chain(self.chain, operation, account_amount, profile_amount)
+        self.save(update_fields=['imbalance', 'chain'])
+
+    def deduct_amount(self, amount):
+        available_pockets = list(self.pockets.filter(account_balance__gt=0).order_by('pk'))
+        # (pocket id, account amount, profile cost) of every pocket consumed, see LotMatch
+        profile_currency_cost, self.consumed_lots, amount_to_cover = self.consume_pockets(
+            available_pockets, Decimal(amount).quantize(QUANTA))
+
+        for pocket in available_pockets[:len(self.consumed_lots)]:
+            if pocket.account_balance == DECIMAL_ZERO:
                 pocket.delete()
+            else:
+                pocket.save()
 
         if amount_to_cover > DECIMAL_ZERO:
             # could not cover all the requested amount, imbalance
-            self.imbalance = amount_to_cover
-            self.save()
+            self.imbalance += amount_to_cover
 
+        self.roll_chain('-', Decimal(amount).quantize(QUANTA), profile_currency_cost)
         return profile_currency_cost
 
     def get_balances(self):
@@ -364,16 +583,127 @@ class Pocket(models.Model):
         )
 
 
+class LotMatch(models.Model):
+    """
+    Records which pocket (lot) of a foreign account a decreasing split consumed, how much of it, what it had cost
+    in the profile's currency and what it was realized for. proceeds - cost_basis is the realized exchange result.
+    pocket_id is kept as a plain integer because exhausted pockets are deleted.
+    """
+    book = models.ForeignKey(Book, related_name='lot_matches')
+    account = models.ForeignKey(Account, related_name='lot_matches')
+    # kept when the split is archived: lot matches are what the realized results report reads
+    split = models.ForeignKey('Split', related_name='lot_matches', null=True, on_delete=models.SET_NULL)
+    pocket_id = models.IntegerField()
+    date = models.DateField()
+    quantity = models.DecimalField(max_digits=18, decimal_places=6)     # in the account's currency
+    cost_basis = models.DecimalField(max_digits=18, decimal_places=6)   # in the profile's currency
+    proceeds = models.DecimalField(max_digits=18, decimal_places=6)     # in the profile's currency
+
+    class Meta:
+        index_together = [('book', 'date'), ('account', 'date')]
+
+    @classmethod
+    def record(cls, split, lots):
+        date = split.transaction.transaction_date
+        if timezone.is_aware(date):
+            date = timezone.localtime(date)
+        # a reprocessed split keeps what it was realized for, spread over the lots it consumes now
+        proceeds = getattr(split, 'lot_proceeds', None)
+        cost = sum((lot_cost for pocket_id, quantity, lot_cost in lots), DECIMAL_ZERO)
+
+        matches = []
+        for pocket_id, quantity, lot_cost in lots:
+            lot_proceeds = lot_cost
+            if proceeds is not None and cost:
+                lot_proceeds = (proceeds * lot_cost / cost).quantize(QUANTA)
+            matches.append(cls(book_id=split.account.group.book_id, account=split.account, split=split,
+                               pocket_id=pocket_id, date=date, quantity=quantity, cost_basis=lot_cost,
+                               proceeds=lot_proceeds))
+        cls.objects.bulk_create(matches)
+
+    @classmethod
+    def forget(cls, split):
+        matches = cls.objects.filter(split=split)
+        split.lot_proceeds = matches.aggregate(proceeds=models.Sum('proceeds'))['proceeds']
+        matches.delete()
+
+    @classmethod
+    def allocate_gain(cls, splits, gain):
+        """
+        Spreads the exchange result booked by a transaction over the lots consumed by its splits,
+        proportionally to their cost.
+        """
+        matches = list(cls.objects.filter(split__in=[s for s in splits if s.pk is not None]).order_by('pk'))
+        total_cost = sum((m.cost_basis for m in matches), DECIMAL_ZERO)
+        if not matches or not total_cost:
+            return
+
+        allocated = DECIMAL_ZERO
+        for m in matches[:-1]:
+            lot_gain = (gain * m.cost_basis / total_cost).quantize(QUANTA)
+            m.proceeds = m.cost_basis + lot_gain
+            allocated += lot_gain
+            m.save(update_fields=['proceeds'])
+        # the last lot takes the rounding residue, so the lots always add up to the booked result
+        matches[-1].proceeds = matches[-1].cost_basis + gain - allocated
+        matches[-1].save(update_fields=['proceeds'])
+
+    @classmethod
+    def realized_report(cls, book, start=None, end=None, period='month'):
+        """
+        Realized exchange results of book per account and period ('day', 'month' or 'year'), aggregated
+        from the lot matches of the date range (end excluded) by the database.
+        """
+        period_start = {
+            'day': lambda d: d,
+            'month': lambda d: d.replace(day=1),
+            'year': lambda d: d.replace(month=1, day=1),
+        }[period]
+
+        matches = cls.objects.filter(book=book)
+        if start is not None:
+            matches = matches.filter(date__gte=start)
+        if end is not None:
+            matches = matches.filter(date__lt=end)
+
+        report = {}
+        for row in matches.values('account', 'account__code', 'date').annotate(
+                quantity=models.Sum('quantity'), cost_basis=models.Sum('cost_basis'),
+                proceeds=models.Sum('proceeds')).order_by():
+            key = (row['account__code'], period_start(row['date']))
+            entry = report.setdefault(key, {'account': row['account'], 'code': row['account__code'],
+                                            'period': key[1], 'quantity': DECIMAL_ZERO,
+                                            'cost_basis': DECIMAL_ZERO, 'proceeds': DECIMAL_ZERO})
+            for field in ('quantity', 'cost_basis', 'proceeds'):
+                entry[field] += Decimal(str(row[field])).quantize(QUANTA)
+
+        for entry in report.values():
+            entry['gain'] = entry['proceeds'] - entry['cost_basis']
+        return [report[key] for key in sorted(report)]
+
+
 class Transaction(models.Model):
     description = models.CharField(max_length=500)
     creation_date = models.DateTimeField()
     transaction_date = models.DateTimeField()
 
     @classmethod
-    @transaction.atomic
     def create(cls, date, description, splits):
+        try:
+            instance = cls.post(date, description, splits)
+        except Exception:
+            if not transaction.get_connection().in_atomic_block:
+                events.discard()
+            raise
+        # balance events only go out once the outermost transaction is committed
+        events.flush()
+        return instance
+
+    @classmethod
+    @transaction.atomic
+    def post(cls, date, description, splits):
         instance = cls()
-        instance.transaction_date = date
+        instance.transaction_date = parse_transaction_date(date)
         instance.creation_date = timezone.now()
         instance.description = description
 
@@ -384,6 +714,12 @@ class Transaction(models.Model):
             if s.transaction is not None:
                 raise KorovaError("Split is already in a Transaction")
 
+        # a back-dated split couldn't replay the archived splits after it, see korova.archive
+        archived = Account.all_objects.filter(pk__in=[s.account_id for s in splits],
+                                              group__book__archived=True).values_list('group__book__code', flat=True)
+        if archived:
+            raise KorovaError("Book %s is archived, it can't be posted to" % ", ".join(sorted(set(archived))))
+
         t_debits = filter(lambda x: x.split_type == 'DEBIT', splits)
         t_credits = filter(lambda x: x.split_type == 'CREDIT', splits)
 
@@ -457,6 +793,8 @@ class Transaction(models.Model):
             if tot_credits != tot_debits:
                 foreign_credit_splits = [x for x in t_credits if x.account.is_foreign() is True]
                 if len(foreign_credit_splits) > 0:
+                    LotMatch.allocate_gain([x for x in foreign_credit_splits if x.operation_sign() == -1],
+                                           tot_debits - tot_credits)
                     xe_income_acc = splits[0].account.group.book.currency_xe_income_acc
                     xe_expense_acc = splits[0].account.group.book.currency_xe_expense_acc
                     #print 'xe_income_acc: ', xe_income_acc.code, xe_income_acc.name
@@ -479,12 +817,81 @@ class Transaction(models.Model):
         instance.save()
         # reparent all the splits and save
 
-        for s in splits:
+        # processed_splits also holds the exchange difference split, if one was added
+        for s in processed_splits:
             s.transaction = instance
             s.save()
 
+        SearchToken.index_transaction(instance, splits)
+        Group.bump_versions(set(s.account.group_id for s in processed_splits))
+        if splits[0].account.group_id is not None:
+            Book.bump_version(splits[0].account.group.book_id)
+            events.record(splits[0].account.group.book_id, set(s.account.pk for s in processed_splits))
+
         return instance
 
+    @classmethod
+    def create_many(cls, entries, all_or_nothing=True):
+        """
+        Posts several transactions, oldest first, inside a single database transaction.
+
+        entries is a list of (date, description, splits). Returns a list in the same order as entries
+        holding, for each one, the created Transaction or the KorovaError that prevented it; any other
+        error an entry raises is turned into a KorovaError too. With all_or_nothing, the first error rolls
+        the whole batch back and raises KorovaBatchError.
+        """
+        results = [None] * len(entries)
+        # in date order, the entries of the batch never land before one another; splits already posted
+        # after them are still unlinked and reprocessed by SplitProcessor
+        order = sorted(range(len(entries)), key=lambda i: entries[i][0])
+
+        try:
+            with transaction.atomic():
+                for i in order:
+                    date, description, splits = entries[i]
+                    try:
+                        results[i] = cls.create(date, description, splits)
+                    except Exception as e:
+                        if not isinstance(e, KorovaError):
+                            e = KorovaError("Could not post the transaction: %s" % e)
+                        if all_or_nothing:
+                            raise KorovaBatchError(i, e)
+                        results[i] = e
+                        # the failed entry was rolled back, but the account instances it touched
+                        # may be shared with later entries and still carry its imbalance changes
+                        accounts = dict((s.account.pk, s.account) for s in splits if s.account is not None)
+                        for pk, imbalance, chain in Account.all_objects.filter(pk__in=accounts.keys()).values_list(
+                                'pk', 'imbalance', 'chain'):
+                            accounts[pk].imbalance = imbalance
+                            accounts[pk].chain = chain
+        except Exception:
+            if not transaction.get_connection().in_atomic_block:
+                events.discard()
+            raise
+
+        events.flush()
+        return results
+
+    def void(self):
+        """
+        Takes the transaction back out of its accounts and deletes it, see korova.voiding.
+        """
+        from voiding import void_transaction
+        try:
+            void_transaction(self)
+        except Exception:
+            if not transaction.get_connection().in_atomic_block:
+                events.discard()
+            raise
+        events.flush()
+
+    def reverse(self, date=None, description=None):
+        """
+        Posts and returns the opposite of the transaction, which is left untouched.
+        """
+        from voiding import reverse_transaction
+        return reverse_transaction(self, date, description)
+
     def add_split(self, split):
         split.transaction = self
         rv = split.account.get_split_processor().process(split)
@@ -525,4 +932,127 @@ class Split(models.Model):
     def save(self, *args, **kwargs):
         if self.transaction is None:
             raise KorovaError("cannot save a split without transaction")
-        return super(Split, self).save(*args, **kwargs)
\ No newline at end of file
+        return super(Split, self).save(*args, **kwargs)
+
+
+class SearchToken(models.Model):
+    """
+    Inverted index entry: a token found in a transaction's description (or in the name of one of its
+    accounts) and the weight it has when ranking search results.
+    """
+    book = models.ForeignKey(Book, related_name='search_tokens')
+    transaction = models.ForeignKey(Transaction, related_name='search_tokens')
+    token = models.CharField(max_length=40)
+    transaction_date = models.DateTimeField()   # copied from the transaction to filter by date in the index
+    weight = models.IntegerField()
+
+    description_weight = 2
+    account_name_weight = 1
+    token_re = re.compile(r'\w+', re.UNICODE)
+
+    class Meta:
+        index_together = [('book', 'token', 'transaction_date')]
+
+    @classmethod
+    def tokenize(cls, text):
+        # accents are dropped, so searches work whether or not they are typed
+        text = unicodedata.normalize('NFKD', force_text(text).lower())
+        text = u''.join(c for c in text if not unicodedata.combining(c))
+        return [token[:40] for token in cls.token_re.findall(text) if len(token) > 1]
+
+    @classmethod
+    def index_transaction(cls, transaction, splits):
+        try:
+            book_id = splits[0].account.group.book_id
+        except (IndexError, AttributeError):
+            return
+
+        weights = {}
+        for token in cls.tokenize(transaction.description):
+            weights[token] = weights.get(token, 0) + cls.description_weight
+        for account_name in set(split.account.name for split in splits):
+            for token in cls.tokenize(account_name):
+                weights[token] = weights.get(token, 0) + cls.account_name_weight
+
+        cls.objects.bulk_create([cls(book_id=book_id, transaction=transaction, token=token,
+                                     transaction_date=transaction.transaction_date, weight=weight)
+                                 for token, weight in weights.items()])
+
+    @classmethod
+    def reindex_book(cls, book):
+        cls.objects.filter(book=book).delete()
+        transactions = Transaction.objects.filter(splits__account__group__book=book).distinct()
+        for transaction in transactions.prefetch_related('splits__account__group'):
+            cls.index_transaction(transaction, [split for split in transaction.splits.all()])
+
+    @classmethod
+    def search(cls, book, query, start=None, end=None, page=1, page_size=20):
+        """
+        Returns (count, [(transaction, score), ...]) for the page-th page of the transactions of book
+        holding every token of query, best scores (then most recent) first.
+        """
+        tokens = set(cls.tokenize(query))
+        if not tokens:
+            return 0, []
+
+        entries = cls.objects.filter(book=book, token__in=tokens)
+        if start is not None:
+            entries = entries.filter(transaction_date__gte=start)
+        if end is not None:
+            entries = entries.filter(transaction_date__lt=end)
+
+        matches = entries.values('transaction', 'transaction_date').annotate(
+            score=models.Sum('weight'), matched=models.Count('token')).filter(matched=len(tokens))
+
+        count = matches.count()
+        offset = (page - 1) * page_size
+        ranking = list(matches.order_by('-score', '-transaction_date', '-transaction')[offset:offset + page_size])
+        transactions = Transaction.objects.in_bulk([entry['transaction'] for entry in ranking])
+        return count, [(transactions[entry['transaction']], entry['score']) for entry in ranking]
+
+
+class ArchivedTransaction(models.Model):
+    """
+    A transaction of an archived book, moved out of the hot tables with the same id.
+    The archive models only hold plain ids of the other models, so they can live in a database of their own
+    (settings.KOROVA_ARCHIVE_DATABASE, see korova.routers).
+    """
+    id = models.IntegerField(primary_key=True)
+    book = models.IntegerField()
+    description = models.CharField(max_length=500)
+    creation_date = models.DateTimeField()
+    transaction_date = models.DateTimeField()
+
+    archive = True
+
+    class Meta:
+        index_together = [('book', 'transaction_date')]
+
+
+class ArchivedSplit(models.Model):
+    """
+    A split of an archived transaction, with the fields of Split in the same order, so both render alike.
+    """
+    id = models.IntegerField(primary_key=True)
+    account_amount = models.DecimalField(max_digits=18, decimal_places=6)
+    profile_amount = models.DecimalField(max_digits=18, decimal_places=6)
+    account = models.IntegerField(db_index=True)
+    split_type = EnumField(values=('DEBIT', 'CREDIT'))
+    is_linked = models.BooleanField(default=False)
+    transaction = models.ForeignKey(ArchivedTransaction, related_name='splits')
+
+    archive = True
+
+
+class ArchiveSummary(models.Model):
+    """
+    What an account's archived splits added up to, left in the hot tables: the net amounts are signed the
+    way they move the account's balance.
+    """
+    book = models.ForeignKey(Book, related_name='archive_summaries')
+    account = models.OneToOneField(Account, related_name='archive_summary')
+    split_count = models.IntegerField()
+    account_amount = models.DecimalField(max_digits=18, decimal_places=6)
+    profile_amount = models.DecimalField(max_digits=18, decimal_places=6)
+    first_date = models.DateTimeField(null=True)
+    last_date = models.DateTimeField(null=True)
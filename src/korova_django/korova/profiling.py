@@ -0,0 +1,93 @@
+__author__ = 'aloysio'
+
+import glob
+import json
+import marshal
+import os
+import pstats
+import re
+import time
+from django.conf import settings
+
+# a capture is <name>.prof (cProfile stats) next to <name>.json (request, timing and SQL log)
+slug_re = re.compile(r'[^A-Za-z0-9]+')
+
+
+def get_profile_dir():
+    """
+    Where captures are written, None (the default) when profiling is off.
+    """
+    return getattr(settings, 'KOROVA_PROFILE_DIR', None)
+
+
+def open_private(path):
+    # captures hold SQL with its parameters, only the server's user may read them
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb')
+
+
+def save_capture(profiler, request, status_code, elapsed, queries):
+    """
+    Writes a profiled request to the profile directory and returns the capture's name.
+    queries is a list of {'alias', 'sql', 'time'} dicts, time in seconds as Django logs it.
+    """
+    directory = get_profile_dir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+
+    started = time.time() - elapsed
+    name = '%s-%06d-%s-%s' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(started)),
+                              int(started * 1000000) % 1000000, request.method,
+                              slug_re.sub('_', request.path).strip('_')[:60] or 'root')
+    profiler.create_stats()
+    with open_private(os.path.join(directory, name + '.prof')) as stream:
+        marshal.dump(profiler.stats, stream)
+
+    user = getattr(request, 'user', None)
+    with open_private(os.path.join(directory, name + '.json')) as stream:
+        json.dump({
+            'path': request.get_full_path(),
+            'method': request.method,
+            'status': status_code,
+            'user': user.username if user is not None and user.is_authenticated() else None,
+            'book': request.session.get('book_id') if hasattr(request, 'session') else None,
+            'started': started,
+            'elapsed': elapsed,
+            'queries': queries,
+        }, stream, indent=1)
+    return name
+
+
+def list_captures():
+    """
+    Names of the captures in the profile directory, oldest first.
+    """
+    if not get_profile_dir():
+        return []
+    return sorted(os.path.basename(path)[:-len('.json')]
+                  for path in glob.glob(os.path.join(get_profile_dir(), '*.json')))
+
+
+def load_capture(name):
+    directory = get_profile_dir()
+    with open(os.path.join(directory, name + '.json')) as stream:
+        capture = json.load(stream)
+    capture['name'] = name
+    capture['stats_path'] = os.path.join(directory, name + '.prof')
+    return capture
+
+
+def top_functions(capture, limit=20, sort='cumulative'):
+    """
+    [(function, calls, total time, cumulative time), ...] of a capture, the most expensive first.
+    """
+    stats = pstats.Stats(capture['stats_path'])
+    key = {'cumulative': 3, 'tottime': 2, 'calls': 1}[sort]
+    rows = []
+    for (filename, line, function), (primitive_calls, calls, total, cumulative, callers) in stats.stats.items():
+        rows.append(('%s:%d(%s)' % (filename, line, function), calls, total, cumulative))
+    rows.sort(key=lambda row: row[key], reverse=True)
+    return rows[:limit]
+
+
+def slowest_queries(capture, limit=10):
+    return sorted(capture['queries'], key=lambda q: float(q['time']), reverse=True)[:limit]
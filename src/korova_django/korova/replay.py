@@ -0,0 +1,282 @@
+__author__ = 'aloysio'
+
+from collections import deque
+from itertools import groupby
+from decimal import Decimal
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+from deletion import raw_delete
+from exceptions import KorovaError
+from models import Account, Book, Group, LotMatch, Pocket, Split, DECIMAL_ZERO, QUANTA
+from verification import close_connections
+
+
+class PocketReplay(object):
+    """
+    The pockets of one account rebuilt in memory, with the arithmetic of Account.increase_amount and
+    Account.deduct_amount: increases absorb the imbalance first and open a pocket with the rest, decreases
+    consume the oldest pockets first and leave whatever they could not cover as imbalance.
+    The pockets it opens get negative provisional ids, which lot matches point to until save_pockets has the
+    database assign the real ones.
+    """
+
+    def __init__(self, account_id, local):
+        self.account_id = account_id
+        self.local = local
+        # Pocket instances, oldest first
+        self.pockets = deque()
+        # the pockets the replay opened, in the order it opened them
+        self.opened = []
+        self.imbalance = DECIMAL_ZERO
+        self.chain = ''
+        # rate of the account's currency in the profile's, see get_rate
+        self.rate = None
+
+    def add(self, pk, account_amount, profile_amount, account_balance, profile_balance):
+        """
+        Appends a pocket, a new one when pk is None.
+        """
+        pocket = Pocket(pk=pk, account_id=self.account_id, account_amount=account_amount,
+                        profile_amount=profile_amount, account_balance=account_balance,
+                        profile_balance=profile_balance)
+        if pk is None:
+            pocket.pk = -len(self.opened) - 1
+            self.opened.append(pocket)
+        self.pockets.append(pocket)
+        return pocket
+
+    def increase(self, account_amount, profile_amount):
+        account_amount = Decimal(account_amount).quantize(QUANTA)
+        inc_account_amount, self.imbalance = Account.split_increase(self.imbalance, account_amount)
+        if inc_account_amount <= 0:
+            self.chain = Account.next_chain(self.chain, '+', account_amount, DECIMAL_ZERO)
+            return DECIMAL_ZERO
+
+        # an increase split keeps the profile amount of the pocket it opened: that is what the lot cost
+        if self.local:
+            profile_amount = inc_account_amount
+        elif not profile_amount:
+            # one that went into an imbalance kept no cost, it is priced the way Transaction.post prices a
+            # foreign split without a profile amount
+            profile_amount = self.get_rate() * inc_account_amount
+        profile_amount = Decimal(profile_amount).quantize(QUANTA)
+        self.add(None, inc_account_amount, profile_amount, inc_account_amount, profile_amount)
+        self.chain = Account.next_chain(self.chain, '+', account_amount, profile_amount)
+        return profile_amount
+
+    def get_rate(self):
+        """
+        The rate of the account's currency in its profile's, asked once to the profile's exchange rate provider.
+        """
+        if self.rate is None:
+            account = Account.all_objects.select_related('currency', 'group__book__profile__default_currency').get(
+                pk=self.account_id)
+            profile = account.profile
+            self.rate = Decimal(str(profile.exchange_rate_provider.get_exchange_rate(account.currency,
+                                                                                     profile.default_currency)))
+        return self.rate
+
+    def deduct(self, account_amount):
+        account_amount = Decimal(account_amount).quantize(QUANTA)
+        cost, lots, amount_to_cover = Account.consume_pockets(self.pockets, account_amount)
+        while self.pockets and self.pockets[0].account_balance <= DECIMAL_ZERO:
+            self.pockets.popleft()
+
+        self.imbalance += amount_to_cover
+        self.chain = Account.next_chain(self.chain, '-', account_amount, cost)
+        return cost, lots
+
+    def open_pockets(self):
+        return [p for p in self.pockets if p.account_balance > DECIMAL_ZERO]
+
+
+def save_pockets(replays, matches):
+    """
+    Inserts the pockets the replays opened and points matches, their lot matches, to the ids the database gave
+    them, so nothing else writing pockets meanwhile can be handed the same ones. They are inserted in the order
+    they were opened, which keeps the pockets of an account in age order; the exhausted ones of a foreign
+    account are inserted and deleted again, as posting does, for its lot matches to keep pointing to a pocket id.
+    """
+    replays = list(replays)
+    account_ids = [r.account_id for r in replays]
+    existing = set(Pocket.objects.filter(account__in=account_ids).values_list('pk', flat=True))
+    opened = [p for r in replays for p in r.opened if not r.local or p.account_balance > DECIMAL_ZERO]
+    provisional = {}
+    for pocket in opened:
+        provisional.setdefault(pocket.account_id, []).append((pocket.pk, pocket))
+        pocket.pk = None
+    Pocket.objects.bulk_create(opened, batch_size=500)
+
+    ids = {}
+    for account_id, rows in groupby(Pocket.objects.filter(account__in=account_ids).order_by(
+            'account', 'pk').values_list('account', 'pk').iterator(), lambda row: row[0]):
+        new = [pk for account, pk in rows if pk not in existing]
+        for (provisional_id, pocket), pk in zip(provisional.get(account_id, []), new):
+            pocket.pk = pk
+            ids[(account_id, provisional_id)] = pk
+    for match in matches:
+        match.pocket_id = ids.get((match.account_id, match.pocket_id), match.pocket_id)
+    raw_delete(Pocket.objects.filter(pk__in=[p.pk for p in opened if p.account_balance <= DECIMAL_ZERO]))
+
+
+# the columns of the split rows replay_splits takes
+SPLIT_COLUMNS = ('pk', 'account', 'split_type', 'account_amount', 'profile_amount', 'transaction__transaction_date')
+
+
+def update_profile_amounts(changed, batch_size=500):
+    """
+    Writes the new profile amounts of [(split id, profile amount), ...], one UPDATE per batch_size splits.
+    """
+    table = connection.ops.quote_name(Split._meta.db_table)
+    column = connection.ops.quote_name(Split._meta.get_field('profile_amount').column)
+    pk_column = connection.ops.quote_name(Split._meta.pk.column)
+    cursor = connection.cursor()
+    for i in range(0, len(changed), batch_size):
+        batch = changed[i:i + batch_size]
+        params = []
+        for pk, profile_amount in batch:
+            params.extend((pk, profile_amount))
+        params.extend(pk for pk, profile_amount in batch)
+        cursor.execute('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+            table, column, pk_column, ' '.join(['WHEN %s THEN %s'] * len(batch)), pk_column,
+            ', '.join(['%s'] * len(batch))), params)
+
+
+def replay_splits(replay, rows, increase_operation, book_id, proceeds):
+    """
+    Replays the split rows of one account, in order. proceeds maps the decreasing splits to what they were
+    realized for. Returns (splits replayed, the lot matches the decreases of a foreign account record,
+    [(split id, new profile amount), ...] of the splits whose profile amount changed).
+    """
+    replayed = 0
+    matches = []
+    changed = []
+    for pk, account_id, split_type, account_amount, profile_amount, date in rows:
+        replayed += 1
+        if split_type == increase_operation:
+            new_profile_amount = replay.increase(account_amount, profile_amount)
+        else:
+            new_profile_amount, lots = replay.deduct(account_amount)
+            if not replay.local:
+                if timezone.is_aware(date):
+                    date = timezone.localtime(date)
+                split_proceeds = proceeds.get(pk)
+                for pocket_id, quantity, lot_cost in lots:
+                    lot_proceeds = lot_cost
+                    if split_proceeds is not None and new_profile_amount:
+                        lot_proceeds = (split_proceeds * lot_cost / new_profile_amount).quantize(QUANTA)
+                    matches.append(LotMatch(book_id=book_id, account_id=account_id, split_id=pk,
+                                            pocket_id=pocket_id, date=date, quantity=quantity,
+                                            cost_basis=lot_cost, proceeds=lot_proceeds))
+        if new_profile_amount != profile_amount:
+            changed.append((pk, new_profile_amount))
+    return replayed, matches, changed
+
+
+def rebuild_accounts(account_ids):
+    """
+    Rebuilds the pockets, lot matches, imbalance and chain of a partition of accounts from their linked splits.
+    Everything the replay derives is written back in bulk, inside a single database transaction.
+    Returns (splits replayed, [(split id, new profile amount), ...] of the splits whose profile amount changed).
+    """
+    accounts = dict((pk, (account_type, currency_id == default_currency_id, book_id))
+                    for pk, account_type, currency_id, book_id, default_currency_id in
+                    Account.all_objects.filter(pk__in=account_ids).values_list(
+                        'pk', 'account_type', 'currency', 'group__book', 'group__book__profile__default_currency'))
+    splits = Split.objects.filter(account__in=account_ids, is_linked=True, transaction__isnull=False).order_by(
+        'account', 'transaction__transaction_date', 'pk').values_list(*SPLIT_COLUMNS)
+
+    replayed = 0
+    changed = []
+    with transaction.atomic():
+        # what each split was realized for survives the rebuild, spread over the lots it consumes now
+        proceeds = dict(LotMatch.objects.filter(account__in=account_ids).values('split').annotate(
+            Sum('proceeds')).values_list('split', 'proceeds__sum'))
+        LotMatch.objects.filter(account__in=account_ids).delete()
+        Pocket.objects.filter(account__in=account_ids).delete()
+
+        replays = dict((pk, PocketReplay(pk, accounts[pk][1])) for pk in account_ids)
+        matches = []
+        for account_id, rows in groupby(splits.iterator(), lambda row: row[1]):
+            account_type, local, book_id = accounts[account_id]
+            increase_operation = Account.split_processor_definitions[str(account_type)][0]
+            count, account_matches, account_changed = replay_splits(replays[account_id], rows, increase_operation,
+                                                                    book_id, proceeds)
+            replayed += count
+            matches.extend(account_matches)
+            changed.extend(account_changed)
+
+        save_pockets(replays.values(), matches)
+        LotMatch.objects.bulk_create(matches, batch_size=500)
+        update_profile_amounts(changed)
+        for replay in replays.values():
+            Account.all_objects.filter(pk=replay.account_id).update(imbalance=replay.imbalance, chain=replay.chain)
+
+    return replayed, changed
+
+
+class PocketRebuild(object):
+    """
+    Regenerates the derived state of a book's accounts (pockets, lot matches, imbalances and chains) by replaying
+    their linked splits in date order, in memory. Accounts are independent of each other, so they are spread over
+    partitions of about the same number of splits, rebuilt in parallel by a pool of worker processes.
+
+    The amounts of the splits are the input of the replay: only the profile amount of decreasing splits, which is
+    what the consumed pockets cost, is recomputed. The book must not be posted to while it is rebuilt.
+    """
+
+    partitions_per_worker = 4
+
+    def __init__(self, book, accounts=None, workers=1):
+        self.book = book
+        self.accounts = accounts
+        self.workers = max(1, workers)
+        self.replayed = 0
+        self.changed = 0
+
+    def get_account_ids(self):
+        accounts = Account.all_objects.filter(group__book=self.book)
+        if self.accounts is not None:
+            accounts = accounts.filter(pk__in=[getattr(a, 'pk', a) for a in self.accounts])
+        return list(accounts.order_by('pk').values_list('pk', flat=True))
+
+    def partition(self, account_ids):
+        """
+        Spreads the accounts over the partitions, largest first, always into the one holding the fewest splits.
+        """
+        counts = dict(Split.objects.filter(account__in=account_ids).values('account').annotate(
+            Count('pk')).values_list('account', 'pk__count'))
+
+        partitions = [[0, []] for i in range(min(len(account_ids), self.workers * self.partitions_per_worker))]
+        for account_id in sorted(account_ids, key=lambda pk: -counts.get(pk, 0)):
+            partition = min(partitions, key=lambda p: p[0])
+            partition[0] += counts.get(account_id, 0)
+            partition[1].append(account_id)
+        return [accounts for size, accounts in partitions]
+
+    def run(self):
+        if self.book.archived:
+            raise KorovaError("The splits of an archived book can't be replayed")
+        account_ids = self.get_account_ids()
+        partitions = self.partition(account_ids)
+
+        if self.workers > 1 and len(partitions) > 1:
+            from multiprocessing import Pool
+            close_connections()
+            pool = Pool(self.workers, initializer=close_connections)
+            try:
+                results = pool.map(rebuild_accounts, partitions)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [rebuild_accounts(blocks) for blocks in partitions]
+
+        for replayed, changed in results:
+            self.replayed += replayed
+            self.changed += len(changed)
+
+        Group.bump_versions(set(Account.all_objects.filter(pk__in=account_ids).values_list('group', flat=True)))
+        Book.bump_version(self.book.pk)
+        return self
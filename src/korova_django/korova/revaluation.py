@@ -0,0 +1,130 @@
+__author__ = 'aloysio'
+
+from decimal import Decimal
+from django.db.models import Sum
+from django.utils import timezone
+from exceptions import KorovaError
+from models import Account, Currency, Pocket, Split, Transaction, DECIMAL_ZERO, QUANTA
+
+
+SCALE = 10 ** 6     # amounts are handled as integer millionths, the precision they are stored with
+
+# the description of the adjusting entries, by account code: how the ones already posted are found
+REVALUATION_DESCRIPTION = u'Revaluation of %s'
+
+
+def to_units(value):
+    return int((Decimal(value) * SCALE).to_integral_value())
+
+
+def from_units(units):
+    return (Decimal(int(units)) / SCALE).quantize(QUANTA)
+
+
+class Revaluation(object):
+    """
+    Mark-to-market of the open pockets of every foreign account of a book.
+
+    The pockets are loaded with a single query into columnar NumPy arrays of integer millionths and summed per
+    account in one vectorized pass, exactly. Each account's market value (open balance * rate) and unrealized
+    result are then worked out in Decimal: market value - cost for debit nature accounts, cost - market value
+    for credit nature ones (a liability that grew is a loss). rates maps currency codes to their rate in the
+    profile's currency; currencies missing from it are asked to the profile's exchange rate provider, once per
+    currency.
+    """
+
+    def __init__(self, book, rates=None):
+        try:
+            import numpy as np
+        except ImportError:
+            raise KorovaError("NumPy is required to revalue a book")
+
+        self.book = book
+        profile = book.profile
+        rows = Pocket.objects.filter(account__group__book=book, account_balance__gt=0).exclude(
+            account__currency=profile.default_currency_id).values_list(
+            'account', 'account__currency', 'account_balance', 'profile_balance')
+
+        account_column, currency_column, balance_column, cost_column = zip(*rows) if rows else ((), (), (), ())
+        self.account_ids, account_index = np.unique(np.array(account_column, dtype=np.int64), return_inverse=True)
+        currency_ids, currency_index = np.unique(np.array(currency_column, dtype=np.int64), return_inverse=True)
+
+        rates = dict(rates or {})
+        currencies = Currency.objects.in_bulk(currency_ids.tolist())
+        for currency_id in currency_ids.tolist():
+            currency = currencies[currency_id]
+            if currency.code not in rates:
+                rates[currency.code] = profile.exchange_rate_provider.get_exchange_rate(currency,
+                                                                                        profile.default_currency)
+        self.rates = rates
+
+        size = len(self.account_ids)
+        self.balances = np.zeros(size, dtype=np.int64)
+        self.costs = np.zeros(size, dtype=np.int64)
+        np.add.at(self.balances, account_index, np.array([to_units(v) for v in balance_column], dtype=np.int64))
+        np.add.at(self.costs, account_index, np.array([to_units(v) for v in cost_column], dtype=np.int64))
+        account_currencies = np.zeros(size, dtype=np.int64)
+        account_currencies[account_index] = currency_ids[currency_index]
+
+        natures = dict((pk, Account.account_natures[str(account_type)]) for pk, account_type in
+                       Account.all_objects.filter(pk__in=self.account_ids.tolist()).values_list('pk', 'account_type'))
+        self.entries = []
+        for i, account_id in enumerate(self.account_ids.tolist()):
+            balance = from_units(self.balances[i])
+            cost = from_units(self.costs[i])
+            rate = Decimal(str(rates[currencies[int(account_currencies[i])].code]))
+            market_value = (balance * rate).quantize(QUANTA)
+            unrealized = market_value - cost if natures[account_id] == 'DEBIT' else cost - market_value
+            self.entries.append({'account': account_id, 'balance': balance, 'cost': cost,
+                                 'market_value': market_value, 'unrealized': unrealized})
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def booked(self, adjustment_account):
+        """
+        What the revaluations already posted against adjustment_account booked, debits - credits, per
+        description.
+        """
+        booked = {}
+        for description, split_type, amount in Split.objects.filter(
+                account=adjustment_account, is_linked=True,
+                transaction__description__startswith=REVALUATION_DESCRIPTION % '').values(
+                'transaction__description', 'split_type').annotate(Sum('account_amount')).values_list(
+                'transaction__description', 'split_type', 'account_amount__sum'):
+            amount = Decimal(str(amount)).quantize(QUANTA)
+            if split_type == 'CREDIT':
+                amount = -amount
+            booked[description] = booked.get(description, DECIMAL_ZERO) + amount
+        return booked
+
+    def post(self, adjustment_account, gain_account=None, loss_account=None, date=None):
+        """
+        Posts one adjusting entry per revalued account, between adjustment_account (a local account holding
+        the revaluation) and the book's exchange income/expense accounts (or the ones given), through
+        Transaction.create_many. Only what the unrealized result moved since the revaluations already posted
+        against adjustment_account is posted, so running it again doesn't book the same result twice, and the
+        revaluation of an account with nothing open anymore is taken back. Returns the created transactions.
+        """
+        gain_account = gain_account or self.book.currency_xe_income_acc
+        loss_account = loss_account or self.book.currency_xe_expense_acc
+        if gain_account is None or loss_account is None:
+            raise KorovaError("Book has no exchange income/expense accounts to post the revaluation to")
+
+        date = date or timezone.now()
+        codes = dict(Account.all_objects.filter(pk__in=self.account_ids.tolist()).values_list('pk', 'code'))
+        booked = self.booked(adjustment_account)
+        unrealized = dict((REVALUATION_DESCRIPTION % codes[entry['account']], entry['unrealized']) for entry in self)
+        entries = []
+        for description in sorted(set(unrealized) | set(booked)):
+            change = unrealized.get(description, DECIMAL_ZERO) - booked.get(description, DECIMAL_ZERO)
+            amount = abs(change)
+            if amount == 0:
+                continue
+            if change > 0:
+                splits = [Split.create(amount, adjustment_account, 'DEBIT'), Split.create(amount, gain_account, 'CREDIT')]
+            else:
+                splits = [Split.create(amount, loss_account, 'DEBIT'), Split.create(amount, adjustment_account, 'CREDIT')]
+            entries.append((date, description, splits))
+
+        return Transaction.create_many(entries)
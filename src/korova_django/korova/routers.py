@@ -0,0 +1,89 @@
+__author__ = 'aloysio'
+
+import random
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+_state = threading.local()
+
+
+def get_read_replicas():
+    return tuple(getattr(settings, 'KOROVA_READ_REPLICAS', ()))
+
+
+def get_archive_database():
+    return getattr(settings, 'KOROVA_ARCHIVE_DATABASE', DEFAULT_DB_ALIAS)
+
+
+def is_primary_only(model):
+    # sessions are read at the start of every request, before anything tells a lagging replica is unsafe
+    return model._meta.app_label in ('sessions',)
+
+
+def is_archive(model):
+    return getattr(model, 'archive', False) is True
+
+
+def pin_primary():
+    _state.pinned = getattr(_state, 'pinned', 0) + 1
+
+
+def unpin_primary():
+    _state.pinned = max(0, getattr(_state, 'pinned', 0) - 1)
+
+
+def reset_pin():
+    _state.pinned = 0
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', 0) > 0
+
+
+@contextmanager
+def use_primary():
+    """
+    Sends every read issued by the current thread inside the block to the primary database.
+    """
+    pin_primary()
+    try:
+        yield
+    finally:
+        unpin_primary()
+
+
+class ReplicaRouter(object):
+    """
+    Sends reads to one of settings.KOROVA_READ_REPLICAS and writes to the primary ('default').
+
+    Reads stay on the primary while the thread is pinned (see use_primary and ReplicaPinMiddleware)
+    or while a transaction is open on the primary, so everything inside Transaction.create, which runs
+    atomically, sees its own writes. Sessions are always read from the primary. The archive models always go to settings.KOROVA_ARCHIVE_DATABASE.
+    """
+
+    def db_for_read(self, model, **hints):
+        if is_archive(model):
+            return get_archive_database()
+        replicas = get_read_replicas()
+        if not replicas or is_pinned() or is_primary_only(model) or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if is_archive(model):
+            return get_archive_database()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas are copies of the primary, so objects from any of them can be related
+        return True
+
+    def allow_syncdb(self, db, model):
+        if db in get_read_replicas():
+            return False
+        archive_database = get_archive_database()
+        if archive_database != DEFAULT_DB_ALIAS and (db == archive_database) != is_archive(model):
+            return False
+        return None
@@ -0,0 +1,212 @@
+__author__ = 'aloysio'
+
+import csv
+import re
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from django.utils import timezone
+from exceptions import KorovaError
+from models import Split, Transaction, QUANTA
+
+
+class StatementLine(object):
+    """
+    One line of a bank statement. amount is signed from the account holder's point of view:
+    positive lines are debits to the account (deposits, payments of a card bill), negative ones credits.
+    """
+
+    def __init__(self, date, amount, description, reference=None):
+        self.date = date
+        self.amount = amount
+        self.description = description
+        self.reference = reference
+
+    def __unicode__(self):
+        return u"StatementLine(%s, %s, %s)" % (self.date, self.amount, self.description)
+
+
+def parse_amount(value, decimal_comma=False):
+    value = value.strip().replace(' ', '')
+    if decimal_comma:
+        value = value.replace('.', '').replace(',', '.')
+    try:
+        return Decimal(value).quantize(QUANTA)
+    except InvalidOperation:
+        raise KorovaError("Invalid amount %s" % value)
+
+
+def parse_csv(stream, date_column=0, amount_column=1, description_column=2, date_format='%Y-%m-%d',
+              delimiter=',', decimal_comma=False, skip_header=True):
+    """
+    Yields a StatementLine for each row of a CSV statement, reading the stream one row at a time.
+    """
+    reader = csv.reader(stream, delimiter=delimiter)
+    for row_number, row in enumerate(reader):
+        if not row or (skip_header and row_number == 0):
+            continue
+        try:
+            date = datetime.strptime(row[date_column].strip(), date_format).date()
+            amount = parse_amount(row[amount_column], decimal_comma)
+            description = u''
+            if description_column is not None:
+                description = row[description_column].strip().decode('utf-8', 'replace')
+        except (IndexError, ValueError, KorovaError) as e:
+            raise KorovaError("Invalid statement row %d: %s" % (row_number + 1, e))
+        yield StatementLine(date, amount, description)
+
+
+# tags are matched one at a time, SGML style OFX files (1.x) don't close their leaf elements
+ofx_tag_re = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+
+def parse_ofx(stream, chunk_size=64 * 1024):
+    """
+    Yields a StatementLine for each <STMTTRN> of an OFX statement (SGML or XML flavour), reading the
+    stream in chunks so the whole file is never held in memory.
+    """
+    buffer = ''
+    transaction = None
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer += chunk
+        # only tokenize up to the last tag start, the rest may be cut in the middle
+        end = len(buffer) if not chunk else buffer.rfind('<')
+        if end <= 0 and chunk:
+            continue
+
+        for closing, tag, text in ofx_tag_re.findall(buffer[:end]):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if closing and transaction is not None:
+                    yield make_ofx_line(transaction)
+                    transaction = None
+                elif not closing:
+                    transaction = {}
+            elif transaction is not None and not closing:
+                transaction[tag] = text.strip()
+
+        buffer = buffer[end:]
+        if not chunk:
+            break
+
+
+def make_ofx_line(transaction):
+    try:
+        posted = transaction['DTPOSTED']
+        date = datetime(int(posted[:4]), int(posted[4:6]), int(posted[6:8])).date()
+        amount = parse_amount(transaction['TRNAMT'])
+    except (KeyError, ValueError) as e:
+        raise KorovaError("Invalid OFX transaction %s: %s" % (transaction, e))
+    description = transaction.get('NAME') or transaction.get('MEMO') or ''
+    return StatementLine(date, amount, description.decode('utf-8', 'replace'), transaction.get('FITID'))
+
+
+def statement_range(lines):
+    """
+    Reads a whole statement, raising KorovaError on the first line that can't be parsed, and returns
+    (first date, last date, number of lines). Lines are not kept, so it can run over a stream before importing it.
+    """
+    start = end = None
+    count = 0
+    for line in lines:
+        start = line.date if start is None else min(start, line.date)
+        end = line.date if end is None else max(end, line.date)
+        count += 1
+    return start, end, count
+
+
+class SplitIndex(object):
+    """
+    In memory hash index of an account's linked splits keyed by (signed amount, day), built with a
+    single query. Each split can be matched only once.
+    """
+
+    def __init__(self, account, start=None, end=None, date_window=3):
+        self.date_window = date_window
+        self.index = {}
+
+        splits = Split.objects.filter(account=account, is_linked=True)
+        if start is not None:
+            splits = splits.filter(transaction__transaction_date__gte=self.to_datetime(start - timedelta(date_window)))
+        if end is not None:
+            splits = splits.filter(transaction__transaction_date__lt=self.to_datetime(end + timedelta(date_window + 1)))
+
+        for pk, split_type, amount, date in splits.values_list('pk', 'split_type', 'account_amount',
+                                                               'transaction__transaction_date'):
+            signed_amount = amount if split_type == 'DEBIT' else -amount
+            if timezone.is_aware(date):
+                date = timezone.localtime(date)
+            self.index.setdefault((signed_amount.quantize(QUANTA), date.date().toordinal()), []).append(pk)
+
+    @staticmethod
+    def to_datetime(date):
+        return timezone.make_aware(datetime(date.year, date.month, date.day), timezone.get_default_timezone())
+
+    def match(self, line):
+        """
+        Returns the pk of the split with the same amount closest in date to line (and removes it from
+        the index), or None.
+        """
+        day = line.date.toordinal()
+        for distance in range(self.date_window + 1):
+            for offset in set((-distance, distance)):
+                candidates = self.index.get((line.amount, day + offset))
+                if candidates:
+                    return candidates.pop(0)
+        return None
+
+
+class StatementImporter(object):
+    """
+    Reconciles a stream of StatementLines against the splits already posted to account. Lines without
+    a matching split are posted against contra_account in batches through Transaction.create_many, so
+    memory use doesn't depend on the size of the statement (only on the size of the account's split index).
+    Statements should be in date order, otherwise posting has to reprocess later splits.
+    """
+
+    def __init__(self, account, contra_account=None, date_window=3, batch_size=500, start=None, end=None):
+        if account.pk == getattr(contra_account, 'pk', None):
+            raise KorovaError("Contra account must be different from the statement account")
+        self.account = account
+        self.contra_account = contra_account
+        self.batch_size = batch_size
+        self.index = SplitIndex(account, start, end, date_window)
+        self.matched = 0
+        self.posted = 0
+        self.unmatched = 0
+        self.errors = []
+
+    def make_splits(self, line):
+        amount = abs(line.amount)
+        if line.amount > 0:
+            return [Split.create(amount, self.account, 'DEBIT'), Split.create(amount, self.contra_account, 'CREDIT')]
+        return [Split.create(amount, self.account, 'CREDIT'), Split.create(amount, self.contra_account, 'DEBIT')]
+
+    def flush(self, pending):
+        entries = [(SplitIndex.to_datetime(line.date), line.description, self.make_splits(line)) for line in pending]
+        for line, result in zip(pending, Transaction.create_many(entries, all_or_nothing=False)):
+            if isinstance(result, KorovaError):
+                self.errors.append((line, result))
+            else:
+                self.posted += 1
+
+    def run(self, lines):
+        pending = []
+        for line in lines:
+            if line.amount == 0:
+                continue
+            if self.index.match(line) is not None:
+                self.matched += 1
+                continue
+
+            self.unmatched += 1
+            if self.contra_account is None:
+                continue
+            pending.append(line)
+            if len(pending) >= self.batch_size:
+                self.flush(pending)
+                pending = []
+
+        if pending:
+            self.flush(pending)
+        return self
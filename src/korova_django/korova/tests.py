@@ -1,11 +1,20 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
 from korova.models import *
 from korova.currencies import *
 from django.utils import timezone
 from django.db import IntegrityError
 import random
+import time
+from decimal import Decimal
+from unittest import skipUnless
+from datetime import date, datetime, timedelta
 from django.contrib.auth.models import User
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 brl = currencies['BRL']
 usd = currencies['USD']
 
@@ -253,6 +262,257 @@ class KorovaModelTests(TestCase):
         self.assertEqual(bal_xchg_expense_acc, 130)
         self.assertEqual(bal_xchg_expense_prof, 130)
 
+    def test_realized_exchange_result_is_recorded_per_lot(self):
+        asset_brl = self.group.create_account('T01', 'test account', brl, 'ASSET')
+        asset_usd = self.group.create_account('T02', 'test account', usd, 'ASSET')
+        liab_usd = self.group.create_account('T03', 'test account', usd, 'LIABILITY')
+        self.profile.set_exchange_rate_provider(self.MockRateProvider(2.0))
+
+        Transaction.create(timezone.now(), 'Lend 1', [Split.create(60, liab_usd, 'CREDIT'),
+                                                      Split.create(60, asset_usd, 'DEBIT')])
+        self.profile.set_exchange_rate_provider(self.MockRateProvider(3.0))
+        Transaction.create(timezone.now(), 'Lend 2', [Split.create(40, liab_usd, 'CREDIT'),
+                                                      Split.create(40, asset_usd, 'DEBIT')])
+        # 60 USD cost 120, 40 USD cost 120: sold for 300, a gain of 60 split by cost
+        sell = Split.create(100, asset_usd, 'CREDIT')
+        Transaction.create(timezone.now(), 'Sell', [sell, Split.create(300, asset_brl, 'DEBIT')])
+
+        matches = list(sell.lot_matches.order_by('pk'))
+        self.assertEqual([(m.quantity, m.cost_basis, m.proceeds) for m in matches], [(60, 120, 150), (40, 120, 150)])
+
+        report = LotMatch.realized_report(self.book, period='year')
+        self.assertEqual(len(report), 1)
+        self.assertEqual((report[0]['code'], report[0]['quantity'], report[0]['gain']), ('T02', 100, 60))
+
+    @skipUnless(numpy, 'NumPy is not installed')
+    def test_revaluation_of_foreign_accounts(self):
+        from korova.revaluation import Revaluation
+        asset_brl = self.group.create_account('T01', 'test account', brl, 'ASSET')
+        asset_usd = self.group.create_account('T02', 'test account', usd, 'ASSET')
+        asset_usd.increase_amount(100, 200)
+        asset_usd.increase_amount(50, 150)
+
+        revaluation = Revaluation(self.book, {'USD': Decimal('2.5')})
+        entry = [e for e in revaluation if e['account'] == asset_usd.pk][0]
+        self.assertEqual((entry['balance'], entry['cost'], entry['market_value'], entry['unrealized']),
+                         (150, 350, 375, 25))
+
+        revaluation.post(asset_brl)
+        self.assertEqual(asset_brl.get_balances(), (25, 25))
+        self.assertEqual(self.book.currency_xe_income_acc.get_balances(), (25, 25))
+        # posting again only books what moved since
+        self.assertEqual(Revaluation(self.book, {'USD': Decimal('2.5')}).post(asset_brl), [])
+        Revaluation(self.book, {'USD': Decimal('2.4')}).post(asset_brl)
+        self.assertEqual(asset_brl.get_balances(), (10, 10))
+        self.assertEqual(self.book.currency_xe_expense_acc.get_balances(), (15, 15))
+
+        # a liability that is worth more in the profile's currency is a loss
+        liab_usd = self.group.create_account('T03', 'test account', usd, 'LIABILITY')
+        liab_usd.increase_amount(Decimal('0.000001'), Decimal('0.000002'))
+        liab_usd.increase_amount(100, 200)
+        entry = [e for e in Revaluation(self.book, {'USD': Decimal('3')}) if e['account'] == liab_usd.pk][0]
+        self.assertEqual((entry['balance'], entry['cost'], entry['market_value'], entry['unrealized']),
+                         (Decimal('100.000001'), Decimal('200.000002'), Decimal('300.000003'), Decimal('-100.000001')))
+
+
+    def test_ledger_verification(self):
+        from korova.verification import LedgerVerification
+        asset_brl = self.group.create_account('T01', 'test account', brl, 'ASSET')
+        asset_usd = self.group.create_account('T02', 'test account', usd, 'ASSET')
+        liab_usd = self.group.create_account('T03', 'test account', usd, 'LIABILITY')
+        self.profile.set_exchange_rate_provider(self.MockRateProvider(2.0))
+
+        Transaction.create(timezone.now(), 'Lend', [Split.create(100, liab_usd, 'CREDIT'),
+                                                    Split.create(100, asset_usd, 'DEBIT')])
+        Transaction.create(timezone.now(), 'Sell', [Split.create(100, asset_usd, 'CREDIT'),
+                                                    Split.create(230, asset_brl, 'DEBIT')])
+
+        verification = LedgerVerification(self.book).run()
+        self.assertTrue(verification.is_valid(), verification.problems)
+        # the exchange income account was posted to as well
+        self.assertEqual(verification.checked, 4)
+        # nothing was posted since, so there is nothing left to check
+        self.assertEqual(LedgerVerification(self.book).run().checked, 0)
+
+        Pocket.objects.filter(account=asset_brl).update(account_balance=200)
+        self.assertEqual(LedgerVerification(self.book).run().checked, 0)
+        verification = LedgerVerification(self.book, full=True).run()
+        self.assertEqual([account_id for account_id, message in verification.problems], [asset_brl.pk])
+
+
+    def test_pocket_rebuild_replays_the_splits(self):
+        from korova.replay import PocketRebuild
+        from korova.verification import LedgerVerification
+        asset_brl = self.group.create_account('T01', 'test account', brl, 'ASSET')
+        asset_usd = self.group.create_account('T02', 'test account', usd, 'ASSET')
+        liab_usd = self.group.create_account('T03', 'test account', usd, 'LIABILITY')
+        self.profile.set_exchange_rate_provider(self.MockRateProvider(2.0))
+        Transaction.create(timezone.now(), 'Lend 1', [Split.create(60, liab_usd, 'CREDIT'),
+                                                      Split.create(60, asset_usd, 'DEBIT')])
+        self.profile.set_exchange_rate_provider(self.MockRateProvider(3.0))
+        Transaction.create(timezone.now(), 'Lend 2', [Split.create(40, liab_usd, 'CREDIT'),
+                                                      Split.create(40, asset_usd, 'DEBIT')])
+        Transaction.create(timezone.now(), 'Sell', [Split.create(80, asset_usd, 'CREDIT'),
+                                                    Split.create(250, asset_brl, 'DEBIT')])
+
+        def snapshot():
+            accounts = Account.objects.filter(group__book=self.book).order_by('pk')
+            return ([(a.get_balances(), a.imbalance) for a in accounts],
+                    list(LotMatch.objects.order_by('pk').values_list('quantity', 'cost_basis', 'proceeds')))
+
+        before = snapshot()
+        Pocket.objects.filter(account=asset_usd).update(profile_balance=1)
+        Pocket.objects.filter(account=asset_brl).delete()
+
+        rebuild = PocketRebuild(self.book).run()
+        self.assertEqual(rebuild.replayed, 7)
+        self.assertEqual(rebuild.changed, 0)
+        self.assertEqual(snapshot(), before)
+        # replaying the same splits rolls the same chain
+        self.assertEqual(Account.objects.get(pk=asset_usd.pk).chain, asset_usd.chain)
+        self.assertTrue(LedgerVerification(self.book, full=True).run().is_valid())
+
+    def test_pocket_rebuild_absorbs_imbalances_like_posting(self):
+        from korova.replay import PocketRebuild
+        asset_usd = self.group.create_account('T02', 'test account', usd, 'ASSET')
+        liab_usd = self.group.create_account('T03', 'test account', usd, 'LIABILITY')
+        self.profile.set_exchange_rate_provider(self.MockRateProvider(2.0))
+        Transaction.create(timezone.now(), 'Overdraw', [Split.create(50, asset_usd, 'CREDIT'),
+                                                        Split.create(50, liab_usd, 'DEBIT')])
+        self.profile.set_exchange_rate_provider(self.MockRateProvider(3.0))
+        Transaction.create(timezone.now(), 'Lend', [Split.create(100, liab_usd, 'CREDIT'),
+                                                    Split.create(100, asset_usd, 'DEBIT')])
+        Transaction.create(timezone.now(), 'Repay', [Split.create(30, asset_usd, 'CREDIT'),
+                                                     Split.create(30, liab_usd, 'DEBIT')])
+        pockets = list(Pocket.objects.filter(account=asset_usd).values_list('profile_amount', 'profile_balance'))
+
+        rebuild = PocketRebuild(self.book, accounts=[asset_usd]).run()
+        self.assertEqual(rebuild.changed, 0)
+        self.assertEqual(list(Pocket.objects.filter(account=asset_usd).values_list(
+            'profile_amount', 'profile_balance')), pockets)
+        # the lot matches point to the pockets the database gave ids to
+        self.assertEqual(set(LotMatch.objects.filter(account=asset_usd).values_list('pocket_id', flat=True)),
+                         set(Pocket.objects.filter(account=asset_usd).values_list('pk', flat=True)))
+
+    def test_replayed_increases_without_a_cost_are_priced_at_the_rate(self):
+        from korova.replay import PocketReplay, update_profile_amounts
+        asset_usd = self.group.create_account('T02', 'test account', usd, 'ASSET')
+        replay = PocketReplay(asset_usd.pk, False)
+        replay.imbalance = Decimal(10)
+        replay.rate = Decimal('2.5')
+        self.assertEqual(replay.increase(10, 0), 0)
+        # one that went into the imbalance when it was posted, but opens a pocket now
+        self.assertEqual(replay.increase(30, 0), 75)
+        self.assertEqual([(p.account_balance, p.profile_balance) for p in replay.open_pockets()], [(30, 75)])
+
+        liab_usd = self.group.create_account('T03', 'test account', usd, 'LIABILITY')
+        self.profile.set_exchange_rate_provider(self.MockRateProvider(2.0))
+        splits = [s for t in [Transaction.create(timezone.now(), 'Lend', [
+            Split.create(amount, liab_usd, 'CREDIT'), Split.create(amount, asset_usd, 'DEBIT')]) for amount in (1, 2)]
+            for s in t.splits.all()]
+        with self.assertNumQueries(1):
+            update_profile_amounts([(s.pk, Decimal(i) + Decimal('0.5')) for i, s in enumerate(splits)], batch_size=4)
+        self.assertEqual([Split.objects.get(pk=s.pk).profile_amount for s in splits], [Decimal('0.5'), Decimal('1.5'),
+                                                                                      Decimal('2.5'), Decimal('3.5')])
+
+    def test_batch_entries_failing_unexpectedly_are_reported(self):
+        asset_brl = self.group.create_account('T01', 'test account', brl, 'ASSET')
+        liab_brl = self.group.create_account('T03', 'test account', brl, 'LIABILITY')
+        results = Transaction.create_many([
+            (timezone.now(), 'Bad', [Split.create('abc', liab_brl, 'CREDIT'), Split.create('abc', asset_brl, 'DEBIT')]),
+            (timezone.now(), 'Good', [Split.create(10, liab_brl, 'CREDIT'), Split.create(10, asset_brl, 'DEBIT')]),
+        ], all_or_nothing=False)
+        self.assertIsInstance(results[0], KorovaError)
+        self.assertEqual(results[1].description, 'Good')
+        self.assertEqual(asset_brl.get_balances(), (10, 10))
+
+    def test_void_replays_only_the_later_splits(self):
+        from korova.replay import PocketRebuild
+        asset_usd = self.group.create_account('T02', 'test account', usd, 'ASSET')
+        liab_usd = self.group.create_account('T03', 'test account', usd, 'LIABILITY')
+        asset_brl = self.group.create_account('T01', 'test account', brl, 'ASSET')
+        lends = []
+        for amount, rate in ((60, 2.0), (40, 3.0), (30, 4.0)):
+            self.profile.set_exchange_rate_provider(self.MockRateProvider(rate))
+            lends.append(Transaction.create(timezone.now(), 'Lend', [Split.create(amount, liab_usd, 'CREDIT'),
+                                                                     Split.create(amount, asset_usd, 'DEBIT')]))
+        sell = Transaction.create(timezone.now(), 'Sell', [Split.create(80, asset_usd, 'CREDIT'),
+                                                           Split.create(250, asset_brl, 'DEBIT')])
+        Transaction.create(timezone.now(), 'Sell', [Split.create(10, asset_usd, 'CREDIT'),
+                                                    Split.create(40, asset_brl, 'DEBIT')])
+
+        def snapshot():
+            accounts = Account.objects.filter(group__book=self.book).order_by('pk')
+            return ([(a.get_balances(), a.imbalance) for a in accounts],
+                    list(LotMatch.objects.order_by('split', 'pk').values_list(
+                        'split', 'quantity', 'cost_basis', 'proceeds')))
+
+        lends[1].void()
+        self.assertFalse(Transaction.objects.filter(pk=lends[1].pk).exists())
+        # the first sell now takes the 20 it was missing from the third lend, at 4.0
+        self.assertEqual(sell.splits.get(account=asset_usd).profile_amount, 200)
+        # and booked 50 of exchange income instead of 70
+        self.assertEqual(list(sell.splits.filter(account=self.book.currency_xe_income_acc).values_list(
+            'split_type', 'account_amount', 'profile_amount')), [('CREDIT', 50, 50)])
+        self.assertEqual(Account.objects.get(pk=self.book.currency_xe_income_acc_id).get_balances(), (50, 50))
+        self.assertEqual(liab_usd.get_balances(), (90, 240))
+        self.assertEqual(Account.objects.get(pk=asset_usd.pk).get_balances(), (0, 0))
+
+        voided = snapshot()
+        PocketRebuild(self.book).run()
+        self.assertEqual(snapshot(), voided)
+
+    def test_closed_books_are_reversed(self):
+        asset_usd = self.group.create_account('T02', 'test account', usd, 'ASSET')
+        liab_usd = self.group.create_account('T03', 'test account', usd, 'LIABILITY')
+        self.profile.set_exchange_rate_provider(self.MockRateProvider(2.0))
+        lend = Transaction.create(timezone.now(), 'Lend', [Split.create(60, liab_usd, 'CREDIT'),
+                                                           Split.create(60, asset_usd, 'DEBIT')])
+        self.book.end = date.today() - timedelta(days=1)
+        self.book.save()
+
+        with self.assertRaises(KorovaError):
+            lend.void()
+        reversal = lend.reverse()
+        self.assertEqual(reversal.description, 'Reversal of Lend')
+        self.assertEqual(sorted(reversal.splits.values_list('split_type', 'profile_amount')),
+                         [('CREDIT', 120), ('DEBIT', 120)])
+        self.assertEqual(liab_usd.get_balances(), (0, 0))
+        self.assertEqual(asset_usd.get_balances(), (0, 0))
+        self.assertEqual(Transaction.objects.filter(pk=lend.pk).count(), 1)
+
+    def test_chart_is_loaded_level_by_level(self):
+        from korova.charts import load_chart, export_chart
+        from korova.exceptions import KorovaChartError
+        from StringIO import StringIO
+        chart = u"""
+            1        | Ativo
+            1.01     | Circulante
+            1.01.001 | Carteira
+            1.01.002 | D\xf3lares | USD
+            1.02     | Investimentos
+            1.02.001 | Poupan\xe7a
+        """
+        # the validation lookups, then an insert and a select per level of groups and for the accounts
+        with self.assertNumQueries(13):
+            created = load_chart(self.book, StringIO(chart.encode('utf-8')))
+        self.assertEqual(len(created), 6)
+
+        account = Account.objects.get(code='1.01.002')
+        self.assertEqual((account.name, account.account_type, account.currency, account.group.code),
+                         (u'D\xf3lares', 'ASSET', usd, '1.01'))
+        self.assertEqual(Group.objects.get(code='1.02').parent.code, '1')
+
+        stream = StringIO()
+        export_chart(self.book, stream, 'json')
+        self.assertIn('"1.02.001"', stream.getvalue())
+
+        with self.assertRaises(KorovaChartError) as error:
+            load_chart(self.book, StringIO("9 | Receitas\n9.01.001 | Sem grupo\n1.01 | Repetido\n"))
+        self.assertEqual(error.exception.errors, ["Code 1.01 is already in use",
+                                                  "9.01.001: parent 9.01 not found",
+                                                  "9.01.001: unknown account type None"])
+
 
 def test_transaction_mixed_accounts_with_xchg_income(self):
 
@@ -290,4 +550,387 @@ def test_transaction_mixed_accounts_with_xchg_income(self):
         self.assertEqual(bal_xchg_income_acc, 30)
         self.assertEqual(bal_xchg_income_prof, 30)
         self.assertEqual(bal_xchg_expense_acc, 0)
-        self.assertEqual(bal_xchg_expense_prof, 0)
\ No newline at end of file
+        self.assertEqual(bal_xchg_expense_prof, 0)
+
+class KorovaBootTests(TestCase):
+
+    def test_ledger_import_does_not_load_network_libraries(self):
+        from korova.management.commands.profile_imports import measure_import
+        for module in ('korova.models', 'main.views'):
+            self.assertEqual(measure_import(module)['heavy'], [])
+
+    def test_exchange_rate_provider_is_built_on_first_use(self):
+        profile = Profile()
+        self.assertIsNone(profile._exchange_rate_provider)
+        provider = profile.exchange_rate_provider
+        self.assertIs(provider, profile.exchange_rate_provider)
+
+
+class KorovaRateProviderTests(TestCase):
+
+    class SlowProvider(object):
+
+        def __init__(self, rate, delay=0, fail=False):
+            self.rate, self.delay, self.fail = rate, delay, fail
+            self.calls = 0
+
+        def get_exchange_rate(self, rate_from, rate_to):
+            self.calls += 1
+            time.sleep(self.delay)
+            if self.fail:
+                raise IOError("upstream down")
+            return self.rate
+
+    def rate(self, provider):
+        return provider.get_exchange_rate(currencies['USD'], brl)
+
+    def test_slow_and_failing_providers_are_skipped(self):
+        slow = self.SlowProvider(1, delay=2)
+        failing = self.SlowProvider(2, fail=True)
+        fallback = self.SlowProvider(3)
+        fallback.remote = False
+        provider = FallbackRateProvider([slow, failing, fallback], timeout=0.1, failure_threshold=2, cooldown=60)
+
+        start = time.time()
+        self.assertEqual(self.rate(provider), 3)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.rate(provider), 3)
+        # both breakers are open now: the fallback answers without waiting
+        start = time.time()
+        self.assertEqual(self.rate(provider), 3)
+        self.assertLess(time.time() - start, 0.05)
+        self.assertEqual((slow.calls, failing.calls, fallback.calls), (2, 2, 3))
+
+        fallback.fail = True
+        with self.assertRaises(KorovaRateError) as raised:
+            self.rate(provider)
+        self.assertEqual(len(raised.exception.errors), 3)
+
+    def test_missing_rates_are_not_failures_and_half_open_breakers_allow_one_call(self):
+        class NoRates(object):
+            remote = False
+            calls = 0
+
+            def get_exchange_rate(self, rate_from, rate_to):
+                self.calls += 1
+                raise KorovaRateNotFound(["no %s rate" % rate_from.code])
+
+        empty = NoRates()
+        fallback = self.SlowProvider(3)
+        fallback.remote = False
+        provider = FallbackRateProvider([empty, fallback], failure_threshold=1, cooldown=60)
+        for i in range(3):
+            self.assertEqual(self.rate(provider), 3)
+        self.assertEqual(empty.calls, 3)
+
+        breaker = CircuitBreaker(failure_threshold=1, cooldown=0)
+        breaker.failure()
+        self.assertTrue(breaker.allows())
+        self.assertFalse(breaker.allows())
+        breaker.failure()
+        self.assertTrue(breaker.allows())
+        breaker.success()
+        self.assertTrue(breaker.allows())
+        self.assertTrue(breaker.allows())
+
+    def test_hedged_request_returns_the_first_rate(self):
+        provider = FallbackRateProvider([self.SlowProvider(1, delay=1), self.SlowProvider(2, delay=0.05)],
+                                        timeout=5, hedge_after=0.05)
+        start = time.time()
+        self.assertEqual(self.rate(provider), 2)
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_cross_rates_are_triangulated_through_the_pivot(self):
+        class PivotFeed(object):
+            rates = {'BRL': '0.4', 'EUR': '1.1', 'CLP': '0.0015'}
+            calls = []
+
+            def get_exchange_rate(self, rate_from, rate_to):
+                self.calls.append((rate_from.code, rate_to.code))
+                if rate_from.code not in self.rates:
+                    raise KorovaRateError(["no %s rate" % rate_from.code])
+                return self.rates[rate_from.code]
+
+        feed = PivotFeed()
+        matrix = RateMatrix(feed, pivot='USD')
+        eur, clp = currencies['EUR'], currencies['CLP']
+        self.assertEqual(matrix.get_exchange_rate(eur, brl), Decimal('2.75'))
+        self.assertEqual(matrix.get_exchange_rate(brl, eur), Decimal('0.363636'))
+        self.assertEqual(matrix.get_exchange_rate(clp, eur), Decimal('0.001364'))
+        self.assertEqual(matrix.get_exchange_rate(usd, clp), Decimal('666.666667'))
+        self.assertEqual(matrix.get_exchange_rate(eur, eur), 1)
+        self.assertEqual(sorted(feed.calls), [('BRL', 'USD'), ('CLP', 'USD'), ('EUR', 'USD')])
+
+        # rated again on the next day
+        matrix.rate_date = None
+        self.assertEqual(matrix.get_exchange_rate(eur, usd), Decimal('1.1'))
+        self.assertEqual(len(feed.calls), 4)
+
+    def test_rate_matrix_fetches_outside_its_lock_and_remembers_missing_rates(self):
+        class PartialFeed(object):
+            calls = []
+
+            def get_exchange_rate(self, rate_from, rate_to):
+                self.calls.append((rate_from.code, rate_to.code))
+                assert not matrix.lock.locked()
+                if rate_from.code != 'EUR':
+                    raise KorovaRateNotFound(["no %s rate" % rate_from.code])
+                return '1.1'
+
+        feed = PartialFeed()
+        matrix = RateMatrix(feed, pivot='USD')
+        eur, clp = currencies['EUR'], currencies['CLP']
+        self.assertEqual(matrix.get_exchange_rate(eur, usd), Decimal('1.1'))
+        for i in range(2):
+            with self.assertRaises(KorovaRateNotFound):
+                matrix.get_exchange_rate(clp, eur)
+        self.assertEqual(feed.calls, [('EUR', 'USD'), ('CLP', 'USD'), ('CLP', 'EUR')])
+
+    def test_last_used_and_file_rates(self):
+        from tempfile import NamedTemporaryFile
+        user = User.objects.create_user('rates', 'rates@test.com', 'abc123')
+        profile = Profile.create(brl, "Rates", user)
+        group = profile.create_book(code="R01", name="R01", start=timezone.now()).create_top_level_group(
+            name='Rates', code='RG')
+        asset_usd = group.create_account('RA1', 'usd', currencies['USD'], 'ASSET')
+        liability_usd = group.create_account('RA2', 'loan', currencies['USD'], 'LIABILITY')
+        profile.set_exchange_rate_provider(KorovaModelTests.MockRateProvider(Decimal('2.5')))
+        Transaction.create(timezone.now(), 'Lend', [Split.create(100, liability_usd, 'CREDIT'),
+                                                    Split.create(100, asset_usd, 'DEBIT')])
+        self.assertEqual(self.rate(LastRateProvider()), Decimal('2.5'))
+        with self.assertRaises(KorovaRateError):
+            LastRateProvider().get_exchange_rate(currencies['EUR'], brl)
+
+        with NamedTemporaryFile() as rates:
+            rates.write("# from to rate\nUSD BRL 2.250000\n")
+            rates.flush()
+            self.assertEqual(self.rate(FileRateProvider(rates.name)), Decimal('2.25'))
+
+
+class KorovaDeletionTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('deletion', 'deletion@test.com', 'abc123')
+        self.profile = Profile.create(brl, "Deletion", user)
+        self.book = self.profile.create_book(code="D01", name="D01", start=timezone.now())
+        self.group = self.book.create_top_level_group(name='Deletion', code='DG1')
+        self.subgroup = self.group.create_child(name='Sub', code='DG2')
+        self.asset = self.subgroup.create_account('DA1', 'cash', brl, 'ASSET')
+        self.liability = self.group.create_account('DA2', 'loan', brl, 'LIABILITY')
+        self.book.profit_loss_acc = self.group.create_account('DA3', 'result', brl, 'EQUITY')
+        self.book.save()
+        Transaction.create(timezone.now(), 'Loan', [Split.create(100, self.liability, 'CREDIT'),
+                                                    Split.create(100, self.asset, 'DEBIT')])
+
+    def test_accounts_with_history_are_soft_deleted(self):
+        with self.assertRaises(KorovaError):
+            self.asset.delete()
+        with self.assertRaises(KorovaError):
+            self.subgroup.delete()
+        with self.assertRaises(KorovaError):
+            self.book.profit_loss_acc.soft_delete()
+
+        self.subgroup.soft_delete()
+        self.assertFalse(Account.objects.filter(pk=self.asset.pk).exists())
+        self.assertEqual(list(self.group.children.all()), [])
+        self.assertTrue(Account.all_objects.get(pk=self.asset.pk).deleted)
+        self.assertEqual(Split.objects.filter(account=self.asset).count(), 1)
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_soft_deleted_accounts_keep_their_balances(self):
+        from StringIO import StringIO
+        from korova.charts import load_chart
+        from korova.consolidation import book_balances
+        from korova.exceptions import KorovaChartError
+        from korova.replay import PocketRebuild
+        from korova.verification import LedgerVerification
+        self.subgroup.soft_delete()
+
+        verification = LedgerVerification(self.book, full=True).run()
+        self.assertEqual(verification.checked, 3)
+        self.assertTrue(verification.is_valid())
+        self.assertEqual(PocketRebuild(self.book).run().replayed, 2)
+        self.assertEqual(Pocket.objects.get(account=self.asset).account_balance, 100)
+        balances = dict((a['code'], a['account_balance']) for a in book_balances(self.book.pk)['accounts'])
+        self.assertEqual(balances, {'DA1': 100, 'DA2': 100, 'DA3': 0})
+        with self.assertRaises(KorovaChartError):
+            load_chart(self.book, StringIO("DG2 | Again\nDG2.01 | Again\nDG2.01.001 | Again\n"))
+
+    def test_purges_are_set_based(self):
+        empty = self.subgroup.create_child(name='Empty', code='DG3')
+        for i in range(8):
+            empty.create_account('DE%d' % i, 'empty %d' % i, brl, 'ASSET')
+        empty.create_child(name='Empty child', code='DG4').create_account('DE9', 'empty 9', brl, 'ASSET')
+        with self.assertNumQueries(24):
+            empty.delete()
+        self.assertEqual(Group.all_objects.filter(code__in=['DG3', 'DG4']).count(), 0)
+        self.assertEqual(Account.all_objects.filter(code__startswith='DE').count(), 0)
+
+        other = self.profile.create_book(code="D02", name="D02", start=timezone.now())
+        other_account = other.create_top_level_group(name='Other', code='OG1').create_account('OA1', 'other', brl,
+                                                                                             'ASSET')
+        self.book.delete()
+        self.assertFalse(Book.all_objects.filter(pk=self.book.pk).exists())
+        self.assertEqual((Transaction.objects.count(), Split.objects.count(), Pocket.objects.count()), (0, 0, 0))
+        self.assertEqual(Account.all_objects.filter(group__book=self.book.pk).count(), 0)
+        self.assertTrue(Account.objects.filter(pk=other_account.pk).exists())
+
+
+class KorovaActiveBookTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('book_test', 'book_test@test.com', 'abc123')
+        self.profile = Profile.create(brl, "Book Test Profile", user)
+        self.book = self.profile.create_book(code="B01", name="B01", start=timezone.now())
+        group = self.book.create_top_level_group(name='Book Group', code='BG01')
+        self.book.profit_loss_acc = group.create_account('BR01', 'profit and loss', brl, 'EQUITY')
+        self.book.save()
+
+    def make_request(self):
+        from django.test.client import RequestFactory
+        request = RequestFactory().get('/')
+        request.session = {'book_id': self.book.pk}
+        return request
+
+    def test_active_book_is_resolved_once_per_request(self):
+        request = self.make_request()
+        book = Book.get_active_book(request)
+        with self.assertNumQueries(0):
+            self.assertIs(Book.get_active_book(request), book)
+            self.assertEqual(book.profit_loss_acc.profile.pk, self.profile.pk)
+
+    def test_active_book_is_shared_across_requests(self):
+        Book.get_active_book(self.make_request())
+        with self.assertNumQueries(0):
+            self.assertEqual(Book.get_active_book(self.make_request()).pk, self.book.pk)
+
+    def test_active_book_cache_is_invalidated_on_save(self):
+        Book.get_active_book(self.make_request())
+        self.book.name = 'Renamed'
+        self.book.save()
+        self.assertEqual(Book.get_active_book(self.make_request()).name, 'Renamed')
+
+    def test_active_book_follows_session_changes(self):
+        request = self.make_request()
+        Book.get_active_book(request)
+        request.session['book_id'] = -1
+        self.assertIsNone(Book.get_active_book(request))
+
+
+class KorovaReplicaRoutingTests(SimpleTestCase):
+
+    def setUp(self):
+        from korova.routers import ReplicaRouter, reset_pin
+        reset_pin()
+        self.router = ReplicaRouter()
+
+    def test_reads_go_to_default_without_replicas(self):
+        with self.settings(KOROVA_READ_REPLICAS=()):
+            self.assertEqual(self.router.db_for_read(Account), 'default')
+
+    def test_reads_go_to_replicas_and_writes_to_default(self):
+        with self.settings(KOROVA_READ_REPLICAS=('replica',)):
+            self.assertEqual(self.router.db_for_read(Account), 'replica')
+            self.assertEqual(self.router.db_for_write(Account), 'default')
+            self.assertFalse(self.router.allow_syncdb('replica', Account))
+
+    def test_pinned_reads_go_to_default(self):
+        from korova.routers import use_primary
+        with self.settings(KOROVA_READ_REPLICAS=('replica',)):
+            with use_primary():
+                self.assertEqual(self.router.db_for_read(Account), 'default')
+            self.assertEqual(self.router.db_for_read(Account), 'replica')
+
+    def test_client_is_pinned_after_a_write(self):
+        from django.contrib.sessions.models import Session
+        from django.http import HttpResponse
+        from django.test.client import RequestFactory
+        from korova.middleware import ReplicaPinMiddleware, PIN_COOKIE
+        middleware = ReplicaPinMiddleware()
+        factory = RequestFactory()
+
+        with self.settings(KOROVA_READ_REPLICAS=('replica',)):
+            self.assertEqual(self.router.db_for_read(Session), 'default')
+            post = factory.post('/')
+            middleware.process_request(post)
+            self.assertEqual(self.router.db_for_read(Account), 'default')
+            response = middleware.process_response(post, HttpResponse())
+
+            get = factory.get('/')
+            get.COOKIES[PIN_COOKIE] = response.cookies[PIN_COOKIE].value
+            middleware.process_request(get)
+            self.assertEqual(self.router.db_for_read(Account), 'default')
+            middleware.process_response(get, HttpResponse())
+
+            # a forged or missing pin leaves reads on the replicas
+            get.COOKIES[PIN_COOKIE] = '9999999999'
+            middleware.process_request(get)
+            self.assertEqual(self.router.db_for_read(Account), 'replica')
+            middleware.process_response(get, HttpResponse())
+
+
+class KorovaStatementImportTests(TestCase):
+
+    ofx = """OFXHEADER:100
+DATA:OFXSGML
+
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20140105120000[-3:BRT]<TRNAMT>100.00<FITID>1<NAME>Salary</STMTTRN>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20140107<TRNAMT>-25.50<FITID>2<MEMO>Grocery</STMTTRN>
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+
+    def setUp(self):
+        user = User.objects.create_user('statement_test', 'statement_test@test.com', 'abc123')
+        profile = Profile.create(brl, "Statement Test Profile", user)
+        book = profile.create_book(code="S01", name="S01", start=timezone.now())
+        group = book.create_top_level_group(name='Statement Group', code='SG01')
+        self.bank = group.create_account('S01', 'bank', brl, 'ASSET')
+        self.suspense = group.create_account('S02', 'suspense', brl, 'EQUITY')
+
+    def test_parse_ofx_in_small_chunks(self):
+        from StringIO import StringIO
+        from korova.statements import parse_ofx
+        lines = list(parse_ofx(StringIO(self.ofx), chunk_size=7))
+        self.assertEqual([(l.date.day, l.amount, l.description) for l in lines],
+                         [(5, Decimal('100'), 'Salary'), (7, Decimal('-25.5'), 'Grocery')])
+
+    def test_parse_csv_with_decimal_comma(self):
+        from korova.statements import parse_csv
+        lines = list(parse_csv(['date;amount;description', '05/01/2014;-1.234,50;Rent'],
+                               date_format='%d/%m/%Y', delimiter=';', decimal_comma=True))
+        self.assertEqual(lines[0].amount, Decimal('-1234.5'))
+        self.assertEqual(lines[0].date.month, 1)
+
+    def test_matched_lines_are_not_posted_again(self):
+        from StringIO import StringIO
+        from korova.statements import StatementImporter, parse_ofx
+        salary_date = timezone.make_aware(datetime(2014, 1, 4, 12), timezone.get_default_timezone())
+        Transaction.create(salary_date, 'salary', [Split.create(100, self.suspense, 'CREDIT'),
+                                                   Split.create(100, self.bank, 'DEBIT')])
+
+        importer = StatementImporter(self.bank, self.suspense).run(parse_ofx(StringIO(self.ofx)))
+        self.assertEqual((importer.matched, importer.unmatched, importer.posted), (1, 1, 1))
+        self.assertEqual(self.bank.get_balances(), (Decimal('74.5'), Decimal('74.5')))
+
+        importer = StatementImporter(self.bank, self.suspense).run(parse_ofx(StringIO(self.ofx)))
+        self.assertEqual((importer.matched, importer.posted), (2, 0))
+
+    def test_invalid_statements_post_nothing(self):
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from korova.statements import parse_csv
+        with self.assertRaises(KorovaError):
+            list(parse_csv(['date,amount', '2014-01-05']))
+
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(handle, 'w') as stream:
+                stream.write('date,amount,description\n2014-01-05,10.00,Deposit\n2014-01-06,ten,Deposit\n')
+            with self.assertRaises(CommandError):
+                call_command('import_statement', 'S01', path, contra='S02', batch_size=1)
+        finally:
+            os.remove(path)
+        self.assertEqual(self.bank.splits.count(), 0)
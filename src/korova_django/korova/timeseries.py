@@ -0,0 +1,121 @@
+__author__ = 'aloysio'
+
+import calendar
+import struct
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.utils import timezone
+from archive import archived_split_rows
+from exceptions import KorovaError
+from models import Account, Group, Split
+from revaluation import SCALE, to_units
+
+
+class BalanceSeries(object):
+    """
+    Daily closing balances of a set of accounts between start and end (both included).
+
+    All the accounts' linked splits up to end (archived ones included) are pulled with a single query as arrays of
+    (account, day, signed amounts); splits before start form the opening balance and the daily
+    balances are a cumulative sum over the date grid, in int64 millionths so large balances keep their cents.
+    account_units and profile_units are those (accounts x days) matrices, in the accounts' and in the profile's
+    currency; account_balances and profile_balances the same as float64 amounts, for output. Series longer than
+    settings.KOROVA_SERIES_MAX_DAYS are refused.
+    """
+
+    def __init__(self, accounts, start, end):
+        try:
+            import numpy as np
+        except ImportError:
+            raise KorovaError("NumPy is required to build balance series")
+        if end < start:
+            raise KorovaError("Series end is before its start")
+        max_days = getattr(settings, 'KOROVA_SERIES_MAX_DAYS', 3660)
+        if (end - start).days + 1 > max_days:
+            raise KorovaError("Series can't be longer than %d days" % max_days)
+
+        self.start = start
+        self.end = end
+        self.accounts = sorted(accounts, key=lambda account: account.code)
+        self.days = (end - start).days + 1
+
+        # local midnight of every day of the grid, and of the day after it, as UTC timestamps
+        midnights = [timezone.make_aware(datetime(day.year, day.month, day.day), timezone.get_default_timezone())
+                     for day in (start + timedelta(i) for i in range(self.days + 1))]
+        boundaries = np.array([calendar.timegm(d.utctimetuple()) for d in midnights], dtype=np.int64)
+
+        pks = np.array([account.pk for account in self.accounts], dtype=np.int64)
+        natures = np.array([account.get_nature() for account in self.accounts])
+        order = np.argsort(pks)
+
+        rows = list(Split.objects.filter(account__in=pks.tolist(), is_linked=True,
+                                         transaction__transaction_date__lt=midnights[-1]).values_list(
+            'account', 'split_type', 'account_amount', 'profile_amount', 'transaction__transaction_date'))
+        rows += archived_split_rows(pks.tolist(), midnights[-1])
+
+        # the rows are turned into columns once, everything else is indexing over whole arrays
+        account_column, type_column, account_amounts, profile_amounts, date_column = \
+            zip(*rows) if rows else ((), (), (), (), ())
+        account_index = order[np.searchsorted(pks[order], np.array(account_column, dtype=np.int64))]
+        signs = np.where(np.array(type_column, dtype=natures.dtype) == natures[account_index], 1, -1)
+        timestamps = np.array([calendar.timegm(d.utctimetuple()) for d in date_column], dtype=np.int64)
+        day_index = np.searchsorted(boundaries, timestamps, side='right') - 1
+        account_amounts = np.array([to_units(v) for v in account_amounts], dtype=np.int64)
+        profile_amounts = np.array([to_units(v) for v in profile_amounts], dtype=np.int64)
+
+        # everything before the first day is part of its opening balance
+        np.clip(day_index, 0, None, out=day_index)
+        shape = (len(self.accounts), self.days)
+        self.account_units = np.zeros(shape, dtype=np.int64)
+        self.profile_units = np.zeros(shape, dtype=np.int64)
+        np.add.at(self.account_units, (account_index, day_index), signs * account_amounts)
+        np.add.at(self.profile_units, (account_index, day_index), signs * profile_amounts)
+        np.cumsum(self.account_units, axis=1, out=self.account_units)
+        np.cumsum(self.profile_units, axis=1, out=self.profile_units)
+        self.account_balances = self.account_units / float(SCALE)
+        self.profile_balances = self.profile_units / float(SCALE)
+
+    @classmethod
+    def for_group(cls, group, start, end):
+        """
+        Series of every account of group and of its subgroups, soft deleted ones included so the totals match
+        the books, loading the book's groups in one query.
+        """
+        children = {}
+        for pk, parent_id in Group.all_objects.filter(book=group.book_id).values_list('pk', 'parent'):
+            children.setdefault(parent_id, []).append(pk)
+        group_ids = []
+        pending = [group.pk]
+        while pending:
+            pk = pending.pop()
+            group_ids.append(pk)
+            pending.extend(children.get(pk, []))
+        return cls(Account.all_objects.filter(group__in=group_ids), start, end)
+
+    def profile_total(self):
+        # only profile balances can be added up, the accounts may be in different currencies
+        return self.profile_units.sum(axis=0) / float(SCALE)
+
+    def dates(self):
+        return [self.start + timedelta(i) for i in range(self.days)]
+
+    def to_json(self):
+        return {'start': self.start.isoformat(),
+                'end': self.end.isoformat(),
+                'accounts': [{'id': account.pk, 'code': account.code,
+                              'account_balances': self.account_balances[i].round(6).tolist(),
+                              'profile_balances': self.profile_balances[i].round(6).tolist()}
+                             for i, account in enumerate(self.accounts)],
+                'profile_total': self.profile_total().round(6).tolist()}
+
+    def to_binary(self):
+        """
+        Little endian: uint32 number of accounts, uint32 number of days, uint32 ordinal of the first day,
+        then the int64 account ids followed by the account balances and the profile balances as float64
+        matrices in row (account) order.
+        """
+        import numpy as np
+        header = struct.pack('<III', len(self.accounts), self.days, self.start.toordinal())
+        ids = np.array([account.pk for account in self.accounts], dtype='<i8')
+        return (header + ids.tobytes() + self.account_balances.astype('<f8').tobytes() +
+                self.profile_balances.astype('<f8').tobytes())
@@ -0,0 +1,153 @@
+__author__ = 'aloysio'
+
+from collections import defaultdict
+from decimal import Decimal
+from django.db import connection, connections
+from django.db.models import Count, F, Sum
+from archive import archive_summaries
+from models import Account, Group, Pocket, Split, DECIMAL_ZERO, QUANTA
+
+# amounts are stored with 6 decimal places, anything below that is the database's float arithmetic
+TOLERANCE = Decimal('0.0000005')
+
+
+def close_connections():
+    # a forked worker must never talk over the connection it inherited from its parent
+    for conn in connections.all():
+        conn.close()
+
+
+def verify_accounts(account_ids):
+    """
+    Checks a partition of accounts against their splits, with one query per table.
+
+    For every account, the open pockets minus the imbalance must add up to the signed sum of its linked splits
+    (and of its archived ones), in the account's currency and in the profile's, and every linked split must belong to a transaction.
+    Returns (problems, verified) where problems is a list of (account id, message) and verified maps the
+    accounts that passed to the chain they were checked at.
+    """
+    accounts = Account.all_objects.filter(pk__in=account_ids).values_list('pk', 'account_type', 'imbalance', 'chain')
+
+    moved = defaultdict(list)
+    for account_id, split_type, account_amount, profile_amount in Split.objects.filter(
+            account__in=account_ids, is_linked=True).values('account', 'split_type').annotate(
+            Sum('account_amount'), Sum('profile_amount')).values_list(
+            'account', 'split_type', 'account_amount__sum', 'profile_amount__sum'):
+        moved[account_id].append((split_type, account_amount, profile_amount))
+
+    balances = dict((account_id, (account_balance, profile_balance)) for account_id, account_balance, profile_balance in
+                    Pocket.objects.filter(account__in=account_ids).values('account').annotate(
+                        Sum('account_balance'), Sum('profile_balance')).values_list(
+                        'account', 'account_balance__sum', 'profile_balance__sum'))
+
+    archived = archive_summaries(account_ids)
+
+    orphans = dict(Split.objects.filter(account__in=account_ids, is_linked=True, transaction__isnull=True).values(
+        'account').annotate(Count('pk')).values_list('account', 'pk__count'))
+
+    problems = []
+    verified = {}
+    for account_id, account_type, imbalance, chain in accounts:
+        increase_operation = Account.split_processor_definitions[str(account_type)][0]
+        # the splits of an archived book only left their totals behind
+        expected_account, expected_profile = archived[account_id]
+        for split_type, account_amount, profile_amount in moved[account_id]:
+            sign = 1 if split_type == increase_operation else -1
+            expected_account += sign * Decimal(account_amount)
+            expected_profile += sign * Decimal(profile_amount)
+
+        account_balance, profile_balance = balances.get(account_id, (DECIMAL_ZERO, DECIMAL_ZERO))
+        account_balance = Decimal(account_balance or 0) - imbalance
+        profile_balance = Decimal(profile_balance or 0)
+
+        failed = len(problems)
+        if abs(account_balance - expected_account) > TOLERANCE:
+            problems.append((account_id, 'pockets hold %s but splits add up to %s' % (
+                account_balance.quantize(QUANTA), expected_account.quantize(QUANTA))))
+        if abs(profile_balance - expected_profile) > TOLERANCE:
+            problems.append((account_id, 'pockets cost %s but splits add up to %s in the profile currency' % (
+                profile_balance.quantize(QUANTA), expected_profile.quantize(QUANTA))))
+        if account_id in orphans:
+            problems.append((account_id, '%d linked splits without a transaction' % orphans[account_id]))
+        if failed == len(problems):
+            verified[account_id] = chain
+
+    return problems, verified
+
+
+def unbalanced_transactions(book):
+    """
+    Ids of the transactions of the book whose debits and credits differ in the profile's currency.
+    A single GROUP BY over the splits, so the rows never leave the database.
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT s.transaction_id FROM %(split)s s "
+        "JOIN %(account)s a ON s.account_id = a.id "
+        "JOIN %(group)s g ON a.group_id = g.id "
+        "WHERE g.book_id = %%s AND s.transaction_id IS NOT NULL "
+        "GROUP BY s.transaction_id "
+        "HAVING ABS(SUM(CASE WHEN s.split_type = 'DEBIT' THEN s.profile_amount ELSE -s.profile_amount END)) > %%s"
+        % {'split': Split._meta.db_table, 'account': Account._meta.db_table, 'group': Group._meta.db_table},
+        [book.pk, str(TOLERANCE)])
+    return [row[0] for row in cursor.fetchall()]
+
+
+class LedgerVerification(object):
+    """
+    Integrity check of a book's ledger.
+
+    Every account keeps a rolling hash (Account.chain) of the amounts moved through its pockets, and the chain
+    it was last verified at. Only the accounts whose chain moved since are checked again, unless full is set.
+    The accounts are split into partitions verified in parallel by a pool of worker processes; the
+    transaction-level debit == credit check is a single aggregate query run by the caller's process.
+    """
+
+    partitions_per_worker = 4
+
+    def __init__(self, book, workers=1, full=False):
+        self.book = book
+        self.workers = max(1, workers)
+        self.full = full
+        self.checked = 0
+        self.problems = []
+        self.unbalanced = []
+
+    def get_account_ids(self):
+        accounts = Account.all_objects.filter(group__book=self.book)
+        if not self.full:
+            accounts = accounts.exclude(chain=F('verified_chain'))
+        return list(accounts.order_by('pk').values_list('pk', flat=True))
+
+    def partition(self, account_ids):
+        size = max(1, -(-len(account_ids) // (self.workers * self.partitions_per_worker)))
+        return [account_ids[i:i + size] for i in range(0, len(account_ids), size)]
+
+    def run(self):
+        account_ids = self.get_account_ids()
+        partitions = self.partition(account_ids)
+
+        if self.workers > 1 and len(partitions) > 1:
+            from multiprocessing import Pool
+            close_connections()
+            pool = Pool(self.workers, initializer=close_connections)
+            try:
+                results = pool.map(verify_accounts, partitions)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [verify_accounts(ids) for ids in partitions]
+
+        for problems, verified in results:
+            self.problems.extend(problems)
+            for account_id, chain in verified.items():
+                # an account posted to while it was being checked keeps its new chain unverified
+                Account.all_objects.filter(pk=account_id, chain=chain).update(verified_chain=chain)
+
+        self.checked = len(account_ids)
+        self.unbalanced = unbalanced_transactions(self.book)
+        return self
+
+    def is_valid(self):
+        return not self.problems and not self.unbalanced
@@ -0,0 +1,254 @@
+__author__ = 'aloysio'
+
+from datetime import date
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.utils import timezone
+from deletion import raw_delete
+from exceptions import KorovaError
+from models import Account, Book, Group, LotMatch, Pocket, SearchToken, Split, Transaction, DECIMAL_ZERO, \
+    QUANTA
+from replay import PocketReplay, SPLIT_COLUMNS, rebuild_accounts, replay_splits, save_pockets, \
+    update_profile_amounts
+from verification import TOLERANCE
+import events
+
+
+def is_closed(book):
+    return book.end is not None and book.end < date.today()
+
+
+def signed_totals(rows, increase_operation):
+    account_total = DECIMAL_ZERO
+    profile_total = DECIMAL_ZERO
+    for pk, account_id, split_type, account_amount, profile_amount, split_date in rows:
+        sign = 1 if split_type == increase_operation else -1
+        account_total += sign * Decimal(account_amount)
+        profile_total += sign * Decimal(profile_amount)
+    return account_total, profile_total
+
+
+def unwind(replay, pockets, imbalance, removed, consumed, originals, increase_operation):
+    """
+    Sets replay to the pockets and imbalance its account had right before removed, its splits from the voided
+    ones on, worked out backwards from the current pockets (a list of Pocket) instead of replaying its history.
+
+    consumed maps the pockets the decreases among removed took from to the [quantity, cost] they took, and
+    originals the consumed pockets that are gone to their original [account amount, profile amount]. The pockets
+    the increases among removed opened are the newest ones. Returns False, leaving replay alone, when the result
+    doesn't add up to what the splits before removed moved: the pockets aren't what posting them in order gives.
+    """
+    account_moved, profile_moved = signed_totals(removed, increase_operation)
+    account_before = sum((p.account_balance for p in pockets), DECIMAL_ZERO) - imbalance - account_moved
+    profile_before = sum((p.profile_balance for p in pockets), DECIMAL_ZERO) - profile_moved
+
+    if replay.local:
+        # the pockets of a local account are all worth their amount, what was left of them is kept as one
+        balance = max(DECIMAL_ZERO, account_before)
+        state = []
+        if balance:
+            pk = min(p.pk for p in pockets) if pockets else None
+            state.append([pk, balance, balance, balance, balance])
+    else:
+        current = dict((p.pk, p) for p in pockets)
+        created = len([row for row in removed if row[2] == increase_operation and row[4]])
+        candidates = sorted(set(current) | set(consumed))
+        state = []
+        for pk in candidates[:max(0, len(candidates) - created)]:
+            quantity, cost = consumed.get(pk, (DECIMAL_ZERO, DECIMAL_ZERO))
+            if pk in current:
+                p = current[pk]
+                state.append([pk, p.account_amount, p.profile_amount, p.account_balance + quantity,
+                              p.profile_balance + cost])
+            elif pk in originals:
+                state.append([pk, originals[pk][0], originals[pk][1], quantity, cost])
+            else:
+                return False
+
+    balance = sum((p[3] for p in state), DECIMAL_ZERO)
+    imbalance_before = balance - account_before
+    if imbalance_before < -TOLERANCE or (imbalance_before > TOLERANCE and balance) or \
+            abs(sum((p[4] for p in state), DECIMAL_ZERO) - profile_before) > TOLERANCE:
+        return False
+
+    for p in state:
+        if p[3] > DECIMAL_ZERO:
+            replay.add(*p)
+    replay.imbalance = max(DECIMAL_ZERO, imbalance_before)
+    return True
+
+
+def restate_exchange_differences(split_ids):
+    """
+    Books again the exchange difference of the transactions of split_ids, splits whose profile amount a replay
+    changed, the way Transaction.post books it: what the debits and credits differ by in the profile currency
+    goes to the book's exchange income or expense account. Returns the ids of the accounts whose splits were
+    changed, their pockets have to be rebuilt.
+    """
+    transaction_ids = set(Split.objects.filter(pk__in=split_ids).values_list('transaction', flat=True))
+    by_transaction = {}
+    for row in Split.objects.filter(transaction__in=transaction_ids, is_linked=True).order_by('pk').values_list(
+            'pk', 'transaction', 'account', 'split_type', 'account_amount', 'profile_amount', 'account__group__book'):
+        by_transaction.setdefault(row[1], []).append(row)
+    books = dict((row[0], row[1:]) for row in Book.all_objects.filter(
+        pk__in=set(rows[0][6] for rows in by_transaction.values())).values_list(
+        'pk', 'currency_xe_income_acc', 'currency_xe_expense_acc'))
+
+    restated = set()
+    for transaction_id, rows in sorted(by_transaction.items()):
+        income_id, expense_id = books.get(rows[0][6], (None, None))
+        booked = [row for row in rows if row[2] in (income_id, expense_id)]
+        difference = sum(((row[5] if row[3] == 'DEBIT' else -row[5]) for row in rows if row not in booked),
+                         DECIMAL_ZERO).quantize(QUANTA)
+        if difference > DECIMAL_ZERO:
+            wanted = (income_id, 'CREDIT', difference)
+        elif difference < DECIMAL_ZERO:
+            wanted = (expense_id, 'DEBIT', -difference)
+        else:
+            wanted = None
+        if wanted is not None and wanted[0] is None:
+            raise KorovaError("Book has no exchange income/expense accounts to book the exchange difference to")
+
+        if len(booked) == 1 and wanted is not None and booked[0][2:4] == wanted[:2]:
+            pk, amount = booked[0][0], wanted[2]
+            if booked[0][4] == amount and booked[0][5] == amount:
+                continue
+            Split.objects.filter(pk=pk).update(account_amount=amount, profile_amount=amount)
+        elif booked or wanted is not None:
+            raw_delete(Split.objects.filter(pk__in=[row[0] for row in booked]))
+            if wanted is not None:
+                Split.objects.create(account_id=wanted[0], split_type=wanted[1], account_amount=wanted[2],
+                                     profile_amount=wanted[2], is_linked=True, transaction_id=transaction_id)
+        restated.update(row[2] for row in booked)
+        if wanted is not None:
+            restated.add(wanted[0])
+    return sorted(restated)
+
+
+@transaction.atomic
+def void_transaction(trans):
+    """
+    Takes a posted transaction back out of its accounts and deletes it.
+
+    Only the splits posted to the same accounts after it are replayed: each account's pockets are unwound to
+    where they were before the transaction from its current pockets and the lot matches of those later splits,
+    and the later splits replayed on top of them, in memory, with the writes done in bulk. An account whose
+    pockets can't be unwound that way is rebuilt from all its splits. When the cost of later decreases changes,
+    the exchange difference of their transactions is booked again (see restate_exchange_differences) and the
+    exchange income and expense accounts rebuilt. Transactions of closed books are reversed instead, see
+    reverse_transaction.
+    """
+    voided = list(Split.objects.filter(transaction=trans, is_linked=True).order_by('pk').values_list(*SPLIT_COLUMNS))
+    account_ids = sorted(set(row[1] for row in voided))
+    accounts = dict((row[0], row[1:]) for row in Account.all_objects.filter(pk__in=account_ids).values_list(
+        'pk', 'account_type', 'currency', 'group', 'group__book', 'group__book__profile__default_currency',
+        'imbalance', 'chain'))
+
+    book_ids = set(row[3] for row in accounts.values() if row[3] is not None)
+    for book in Book.all_objects.filter(pk__in=book_ids):
+        if book.archived or is_closed(book):
+            raise KorovaError("Transactions of the closed book %s can't be voided, only reversed" % book.code)
+
+    first_pk = voided[0][0] if voided else 0
+    later_splits = Split.objects.filter(is_linked=True, transaction__isnull=False).exclude(transaction=trans).filter(
+        Q(transaction__transaction_date__gt=trans.transaction_date) |
+        Q(transaction__transaction_date=trans.transaction_date, pk__gt=first_pk)).order_by(
+        'transaction__transaction_date', 'pk')
+
+    replays = []
+    rebuilt = []
+    removed_ids = [row[0] for row in voided]
+    for account_id in account_ids:
+        account_type, currency_id, group_id, book_id, default_currency_id, imbalance, chain = accounts[account_id]
+        increase_operation = Account.split_processor_definitions[str(account_type)][0]
+        local = currency_id == default_currency_id
+        later = list(later_splits.filter(account=account_id).values_list(*SPLIT_COLUMNS))
+        removed = [row for row in voided if row[1] == account_id] + later
+        pockets = list(Pocket.objects.filter(account=account_id).order_by('pk'))
+
+        consumed = {}
+        proceeds = {}
+        originals = {}
+        decreases = [row[0] for row in removed if row[2] != increase_operation]
+        if not local and decreases:
+            for split_id, pocket_id, quantity, cost, split_proceeds in LotMatch.objects.filter(
+                    split__in=decreases).values_list('split', 'pocket_id', 'quantity', 'cost_basis', 'proceeds'):
+                taken = consumed.setdefault(pocket_id, [DECIMAL_ZERO, DECIMAL_ZERO])
+                taken[0] += quantity
+                taken[1] += cost
+                proceeds[split_id] = proceeds.get(split_id, DECIMAL_ZERO) + split_proceeds
+            gone = set(consumed) - set(p.pk for p in pockets)
+            if gone:
+                # every lot match of an exhausted pocket adds up to what it was opened with
+                originals = dict((pocket_id, (Decimal(str(quantity)).quantize(QUANTA),
+                                              Decimal(str(cost)).quantize(QUANTA)))
+                                 for pocket_id, quantity, cost in
+                                 LotMatch.objects.filter(account=account_id, pocket_id__in=gone).values(
+                                     'pocket_id').annotate(Sum('quantity'), Sum('cost_basis')).values_list(
+                                     'pocket_id', 'quantity__sum', 'cost_basis__sum'))
+
+        replay = PocketReplay(account_id, local)
+        if not unwind(replay, pockets, imbalance, removed, consumed, originals, increase_operation):
+            rebuilt.append(account_id)
+            continue
+        replay.chain = chain
+        for row in removed[:len(removed) - len(later)]:
+            replay.chain = Account.next_chain(replay.chain, 'x', row[3], row[4])
+        replayed, matches, changed = replay_splits(replay, later, increase_operation, book_id, proceeds)
+        removed_ids.extend(row[0] for row in later)
+        replays.append((replay, pockets, matches, changed))
+
+    raw_delete(LotMatch.objects.filter(split__in=removed_ids))
+    raw_delete(SearchToken.objects.filter(transaction=trans))
+    raw_delete(Split.objects.filter(transaction=trans))
+    raw_delete(Transaction.objects.filter(pk=trans.pk))
+
+    stale = []
+    fresh = []
+    for replay, pockets, matches, changed in replays:
+        current = dict((p.pk, (p.account_amount, p.profile_amount, p.account_balance, p.profile_balance))
+                       for p in pockets)
+        # the pockets the replay opened are inserted by save_pockets
+        final = [p for p in replay.open_pockets() if p.pk > 0]
+        kept = set(p.pk for p in final if current.get(p.pk) == (p.account_amount, p.profile_amount,
+                                                                 p.account_balance, p.profile_balance))
+        stale.extend(pk for pk in current if pk not in kept)
+        fresh.extend(p for p in final if p.pk not in kept)
+    raw_delete(Pocket.objects.filter(pk__in=stale))
+    Pocket.objects.bulk_create(fresh, batch_size=500)
+    matches = [m for r in replays for m in r[2]]
+    save_pockets([r[0] for r in replays], matches)
+    LotMatch.objects.bulk_create(matches, batch_size=500)
+    update_profile_amounts([c for r in replays for c in r[3]])
+    for replay, pockets, matches, changed in replays:
+        Account.all_objects.filter(pk=replay.account_id).update(imbalance=replay.imbalance, chain=replay.chain)
+
+    repriced = [pk for r in replays for pk, profile_amount in r[3]]
+    if rebuilt:
+        repriced.extend(pk for pk, profile_amount in rebuild_accounts(rebuilt)[1])
+    group_ids = set(row[2] for row in accounts.values())
+    restated = restate_exchange_differences(repriced) if repriced else []
+    if restated:
+        rebuild_accounts(restated)
+        group_ids.update(Account.all_objects.filter(pk__in=restated).values_list('group', flat=True))
+        account_ids = sorted(set(account_ids) | set(restated))
+
+    Group.bump_versions(group_ids)
+    for book_id in book_ids:
+        Book.bump_version(book_id)
+        events.record(book_id, account_ids)
+
+
+def reverse_transaction(trans, date=None, description=None):
+    """
+    Posts the opposite of trans, dated date (now by default), and returns it. trans is left as it is, so this is
+    how the transactions of a closed book are corrected.
+    """
+    splits = []
+    for split in trans.splits.select_related('account__group__book__profile').order_by('pk'):
+        splits.append(Split.create(split.account_amount, split.account,
+                                   'CREDIT' if split.split_type == 'DEBIT' else 'DEBIT', split.profile_amount))
+    if not splits:
+        raise KorovaError("Transaction has no splits to reverse")
+    return Transaction.create(date or timezone.now(), description or u'Reversal of %s' % trans.description, splits)
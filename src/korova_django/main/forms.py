@@ -5,13 +5,26 @@ from django import forms
 from korova.models import Account, Group, Transaction, Split
 
 
-class AccountForm(ModelForm):
+class CodeFormMixin(object):
+    """
+    The model form's own unique check goes through the default manager, which doesn't see the soft deleted
+    entities still holding their codes.
+    """
+
+    def clean_code(self):
+        code = self.cleaned_data['code']
+        if self._meta.model.all_objects.filter(code=code).exclude(pk=self.instance.pk).exists():
+            raise forms.ValidationError("Code %s is already in use" % code, code='unique')
+        return code
+
+
+class AccountForm(CodeFormMixin, ModelForm):
     class Meta:
         model = Account
         fields = ['code', 'name', 'group', 'currency', 'account_type']
 
 
-class GroupForm(ModelForm):
+class GroupForm(CodeFormMixin, ModelForm):
     class Meta:
         model = Group
         fields = ['code', 'name', 'parent']
@@ -31,27 +44,54 @@ class SplitForm(ModelForm):
         fields = ['account', 'account_amount', 'profile_amount', 'split_type']
 
 
+class AccountChoiceField(forms.Field):
+    """
+    Account of a split, typed in a text box completed by /api/accounts/autocomplete/.
+    Values are checked against the book's cached account index, shared by every form, instead of a queryset
+    each form evaluates; only the account actually submitted is loaded.
+    """
+    default_error_messages = {
+        'invalid_choice': 'Select a valid account.',
+    }
+
+    def __init__(self, book, *args, **kwargs):
+        from korova.autocomplete import get_account_index
+        super(AccountChoiceField, self).__init__(*args, **kwargs)
+        self.index = get_account_index(book.pk)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            pk = int(value)
+        except (TypeError, ValueError):
+            pk = None
+        if pk not in self.index.accounts:
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        return Account.objects.get(pk=pk)
+
+
 def make_credit_split_form(book):
+    account_field = AccountChoiceField(book)
+
     class CreditSplitForm(SplitForm):
         split_type = forms.CharField(widget=forms.HiddenInput(), initial='CREDIT')
         #account = forms.ModelChoiceField(
         #    queryset=Account.objects.filter(
         #        Q(account_type='LIABILITY') | Q(account_type='INCOME') | Q(account_type='EQUITY'),
         #        group__book=book))
-        account = forms.ModelChoiceField(
-            queryset=Account.objects.filter(group__book=book).order_by('code'))
+        account = account_field
     return CreditSplitForm
 
 
 def make_debit_split_form(book):
+    account_field = AccountChoiceField(book)
+
     class DebitSplitForm(SplitForm):
         split_type = forms.CharField(widget=forms.HiddenInput(), initial='DEBIT')
         #account = forms.ModelChoiceField(
         #    queryset=Account.objects.filter(
         #        Q(account_type='ASSET') | Q(account_type='EXPENSE'),
         #        group__book=book))
-        account = forms.ModelChoiceField(
-            queryset=Account.objects.filter(group__book=book).order_by('code'))
+        account = account_field
     return DebitSplitForm
-
-
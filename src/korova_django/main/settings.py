@@ -49,7 +49,10 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    #'api.book_middleware.SetActiveBookMiddleware',
+    'korova.middleware.ReplicaPinMiddleware',
+    'api.book_middleware.SetActiveBookMiddleware',
+    'korova.middleware.BalanceEventsMiddleware',
+    'korova.middleware.ProfilerMiddleware',
 )
 
 ROOT_URLCONF = 'main.urls'
@@ -73,6 +76,57 @@ DATABASES = {
     }
 }
 
+# Read replicas: aliases in DATABASES holding read-only copies of 'default'.
+# Reads go to one of them unless the request writes, the client wrote less than
+# KOROVA_PRIMARY_PIN_SECONDS ago, or a transaction is open on 'default'.
+# Sessions are always read from the primary.
+# To try it locally with two SQLite databases (the replica being a copy of the primary file):
+#DATABASES['default'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': '/tmp/korova.sqlite3',
+#                        'TEST_NAME': '/tmp/korova_test.sqlite3'}
+#DATABASES['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': '/tmp/korova_replica.sqlite3',
+#                        'TEST_MIRROR': 'default'}
+#KOROVA_READ_REPLICAS = ('replica',)
+
+DATABASE_ROUTERS = ['korova.routers.ReplicaRouter']
+KOROVA_READ_REPLICAS = ()
+KOROVA_PRIMARY_PIN_SECONDS = 5
+
+# The archived transactions of closed books (see korova.archive) can be kept in a database of their own,
+# e.g. DATABASES['archive'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': '/tmp/korova_archive.sqlite3'}
+KOROVA_ARCHIVE_DATABASE = 'default'
+
+# Balance change events (api/accounts/events/) go through this broker, which only reaches the clients
+# connected to the same process. Streams are closed after KOROVA_EVENT_STREAM_SECONDS and resumed by the client.
+KOROVA_EVENT_BROKER = 'korova.events.InProcessBroker'
+KOROVA_EVENT_STREAM_SECONDS = 300
+KOROVA_EVENT_KEEPALIVE_SECONDS = 15
+
+# Requests sent with an X-Korova-Profile header equal to KOROVA_PROFILE_TOKEN, plus a KOROVA_PROFILE_SAMPLE_RATE
+# fraction of all requests, are profiled into KOROVA_PROFILE_DIR. See the show_profiles command.
+# Profiling is off while KOROVA_PROFILE_DIR is unset; captures hold SQL parameters, keep it private.
+KOROVA_PROFILE_TOKEN = None
+KOROVA_PROFILE_SAMPLE_RATE = 0
+KOROVA_PROFILE_DIR = None
+
+# Exchange rates are asked to these providers in order (see korova.currencies.FallbackRateProvider), each one
+# given KOROVA_EXCHANGE_RATE_TIMEOUT seconds and skipped for KOROVA_EXCHANGE_RATE_COOLDOWN seconds after failing
+# repeatedly. With KOROVA_EXCHANGE_RATE_HEDGE_AFTER set, the next provider is asked too once that many seconds
+# have passed. korova.currencies.FileRateProvider reads "FROM TO RATE" lines from KOROVA_RATES_FILE.
+KOROVA_EXCHANGE_RATE_PROVIDERS = (
+    'korova.currencies.XERateProvider',
+    'korova.currencies.WSRateProvider',
+    'korova.currencies.LastRateProvider',
+)
+KOROVA_EXCHANGE_RATE_TIMEOUT = 5
+KOROVA_EXCHANGE_RATE_COOLDOWN = 300
+KOROVA_EXCHANGE_RATE_HEDGE_AFTER = None
+KOROVA_RATES_FILE = None
+# Providers are only asked for the rate of each currency against this one, cross rates are derived from those.
+KOROVA_PIVOT_CURRENCY = 'USD'
+
+# Longest daily balance series (korova.timeseries.BalanceSeries) the api builds, in days.
+KOROVA_SERIES_MAX_DAYS = 3660
+
 # TODO: DISABLE IN PRODUCTION!
 PASSWORD_HASHERS = (
     'django.contrib.auth.hashers.MD5PasswordHasher',
@@ -0,0 +1,150 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils import timezone
+from korova.models import *
+from korova.currencies import currencies
+from main.views import AccountView, GroupView
+
+brl = currencies['BRL']
+
+
+# Create your tests here.
+class KorovaGroupTreeTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user('tree_test', 'tree_test@test.com', 'abc123')
+        profile = Profile.create(brl, "Tree Test Profile", user)
+        self.book = profile.create_book(code="TR01", name="TR01", start=timezone.now())
+        self.assets = self.book.create_top_level_group(name='Assets', code='1')
+        self.current = self.assets.create_child('Current', '1.01')
+        self.liabilities = self.book.create_top_level_group(name='Liabilities', code='2')
+        self.cash = self.current.create_account('1.01.001', 'Cash', brl, 'ASSET')
+        self.loan = self.liabilities.create_account('2.001', 'Loan', brl, 'LIABILITY')
+
+    def test_account_tree_markup(self):
+        Transaction.create(timezone.now(), 'loan', [Split.create(10, self.loan, 'CREDIT'),
+                                                    Split.create(10, self.cash, 'DEBIT')])
+        html = AccountView().render_book_tree(self.book)
+        self.assertEqual(html,
+                         '<ul><li>1 - Assets<ul><li>1.01 - Current<ul><li>1.01.001 - Cash - 10.000000 BRL    '
+                         '<a href="/account/%d/delete_object">delete</a></li></ul></li></ul></li>'
+                         '<li>2 - Liabilities<ul><li>2.001 - Loan - 10.000000 BRL    '
+                         '<a href="/account/%d/delete_object">delete</a></li></ul></li></ul>' %
+                         (self.cash.pk, self.loan.pk))
+
+    def test_default_tree_markup(self):
+        from main.views import GroupTreeMixin
+
+        class PlainTree(GroupTreeMixin):
+            tree_name = 'plain'
+            uses_accounts = True
+
+        self.assertEqual(PlainTree().render_book_tree(self.book),
+                         '<ul><li>1 - Assets<ul><li>1.01 - Current<ul><li>1.01.001 - Cash</li></ul></li></ul></li>'
+                         '<li>2 - Liabilities<ul><li>2.001 - Loan</li></ul></li></ul>')
+
+    def test_unchanged_tree_comes_from_the_cache(self):
+        view = AccountView()
+        html = view.render_book_tree(self.book)
+        with self.assertNumQueries(1):  # the book version
+            self.assertEqual(view.render_book_tree(self.book), html)
+
+    def test_only_the_changed_branch_is_rendered(self):
+        view = GroupView()
+        view.render_book_tree(self.book)
+        self.liabilities.create_child('Long term', '2.02')
+
+        rendered = []
+        build_group_tree = view.build_group_tree
+        view.build_group_tree = lambda group, *args: rendered.append(group.code) or build_group_tree(group, *args)
+        html = view.render_book_tree(self.book)
+        self.assertEqual(sorted(rendered), ['2', '2.02'])
+        self.assertIn('2.02 - Long term', html)
+
+
+    def test_chart_loads_refresh_the_existing_parents(self):
+        from StringIO import StringIO
+        from korova.charts import load_chart
+        AccountView().render_book_tree(self.book)
+        load_chart(self.book, StringIO("1.01.002 | Savings\n"))
+        self.assertIn('1.01.002 - Savings', AccountView().render_book_tree(self.book))
+
+
+class KorovaSplitFormTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user('form_test', 'form_test@test.com', 'abc123')
+        profile = Profile.create(brl, "Form Test Profile", user)
+        self.book = profile.create_book(code="FT01", name="FT01", start=timezone.now())
+        group = self.book.create_top_level_group(name='Assets', code='F1')
+        self.cash = group.create_account('F1.001', 'Cash', brl, 'ASSET')
+
+    def test_split_forms_share_the_cached_account_index(self):
+        from django.forms.models import inlineformset_factory
+        from main.forms import make_debit_split_form
+        make_debit_split_form(self.book)
+        with self.assertNumQueries(1):  # the book version
+            form_class = make_debit_split_form(self.book)
+        formset = inlineformset_factory(Transaction, Split, form=form_class, can_delete=False, extra=6)(
+            prefix='debit')
+        self.assertTrue(all(f.fields['account'].index is formset[0].fields['account'].index for f in formset))
+
+        form = form_class({'account': self.cash.pk, 'account_amount': '10', 'profile_amount': '10',
+                           'split_type': 'DEBIT'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['account'], self.cash)
+        self.assertFalse(form_class({'account': '999999', 'account_amount': '10', 'profile_amount': '10',
+                                     'split_type': 'DEBIT'}).is_valid())
+
+
+class KorovaDeleteViewTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user('delete_test', 'delete_test@test.com', 'abc123')
+        profile = Profile.create(brl, "Delete Test Profile", user)
+        self.book = profile.create_book(code="DV01", name="DV01", start=timezone.now())
+        self.group = self.book.create_top_level_group(name='Assets', code='V1')
+        self.cash = self.group.create_account('V1.001', 'Cash', brl, 'ASSET')
+        self.loan = self.group.create_account('V1.002', 'Loan', brl, 'LIABILITY')
+        self.book.profit_loss_acc = self.group.create_account('V1.003', 'Result', brl, 'EQUITY')
+        self.book.save()
+        Transaction.create(timezone.now(), 'loan', [Split.create(10, self.loan, 'CREDIT'),
+                                                    Split.create(10, self.cash, 'DEBIT')])
+        self.client.login(username='delete_test', password='abc123')
+        self.client.post('/api/set_session_book/', {'book_id': self.book.pk})
+
+    def messages(self, url):
+        response = self.client.get(url, follow=True)
+        self.assertEqual(response.status_code, 200)
+        return [(m.tags, unicode(m)) for m in response.context['messages']]
+
+    def test_deletions_tell_what_happened(self):
+        empty = self.group.create_account('V1.004', 'Empty', brl, 'ASSET')
+        self.assertEqual(self.messages('/account/%d/delete_object' % empty.pk), [('success', 'V1.004 was deleted')])
+        self.assertFalse(Account.all_objects.filter(pk=empty.pk).exists())
+
+        [(level, message)] = self.messages('/account/%d/delete_object' % self.cash.pk)
+        self.assertEqual(level, 'warning')
+        self.assertTrue(message.startswith('V1.001 was hidden instead of deleted'))
+        self.assertTrue(Account.all_objects.get(pk=self.cash.pk).deleted)
+
+        [(level, message)] = self.messages('/account/%d/delete_object' % self.book.profit_loss_acc.pk)
+        self.assertEqual(level, 'error')
+        self.assertIn('main accounts of book DV01', message)
+        self.assertFalse(Account.all_objects.get(pk=self.book.profit_loss_acc.pk).deleted)
+
+        [(level, message)] = self.messages('/group/%d/delete_object' % self.group.pk)
+        self.assertEqual(level, 'error')
+        self.assertFalse(Group.all_objects.get(pk=self.group.pk).deleted)
+
+    def test_codes_of_soft_deleted_accounts_stay_taken(self):
+        self.cash.soft_delete()
+        response = self.client.post('/account/', {'code': 'V1.001', 'name': 'Cash again', 'group': self.group.pk,
+                                                  'currency': brl.pk, 'account_type': 'ASSET'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Code V1.001 is already in use', response.content)
+        self.assertEqual(Account.all_objects.filter(code='V1.001').count(), 1)
@@ -4,18 +4,55 @@ from django.http import HttpResponse
 from django.template import RequestContext, loader
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
+from django.contrib import messages
 from django.shortcuts import redirect
 from django.template import RequestContext
 from django.views.generic import View
 from korova.exceptions import KorovaError
 from .forms import AccountForm, GroupForm, TransactionForm, make_credit_split_form, make_debit_split_form
-from korova.models import Group, Account, Transaction, Split
+from korova.models import Group, Account, Transaction, Split, Pocket, DECIMAL_ZERO
+from django.core.cache import cache
+from django.db.models import Sum
+import hashlib
 from django.forms.formsets import formset_factory
 from django.forms.models import inlineformset_factory
 from korova.models import Book
 from django import forms
 
 
+class LazyTemplate(object):
+    """
+    Class attribute that loads its template on first access instead of at import time.
+    """
+
+    def __init__(self, template_name):
+        self.template_name = template_name
+        self.template = None
+
+    def __get__(self, instance, owner):
+        if self.template is None:
+            self.template = loader.get_template(self.template_name)
+        return self.template
+
+
+def delete_or_hide(request, entity):
+    """
+    Deletes a group or an account, or soft deletes it when it has a history, and tells the user which one
+    happened. The main accounts of a book can be neither: the refusal is reported instead.
+    """
+    try:
+        entity.delete()
+    except KorovaError as refusal:
+        try:
+            entity.soft_delete()
+        except KorovaError as e:
+            messages.error(request, unicode(e))
+        else:
+            messages.warning(request, u"%s was hidden instead of deleted (%s)" % (entity.code, refusal))
+    else:
+        messages.success(request, u"%s was deleted" % entity.code)
+
+
 class KorovaRequestContext(RequestContext):
     def __init__(self, *args, **kwargs):
         super(KorovaRequestContext, self).__init__(*args, **kwargs)
@@ -121,66 +158,140 @@ class KorovaEntityView(View):
         return view
 
 
-class AccountView(KorovaEntityView):
-    list_template = loader.get_template('website/account/list.html')
-    form_template = loader.get_template('website/account/form.html')
-
-    def build_group_tree(self, group, html_result=""):
-        original = html_result
-        html_result += "<li>%s - %s" % (group.code, group.name)
-        for subgroup in group.children.all():
-            html_result += "<ul>" + self.build_group_tree(subgroup, original) + "</ul>"
-        accounts_html = ""
-        for account in group.accounts.all():
-            accounts_html += "<li>%s - %s - %s %s    <a href=\"/account/%d/delete_object\">delete</a></li>" % \
-                             (account.code, account.name, account.get_balances()[0], account.currency.code, account.pk)
+class GroupTreeMixin(object):
+    """
+    Renders a book's groups as a tree of <ul>s and caches it, both whole (per book version) and per group.
+    A group's fragment is keyed by its version and the keys of its subgroups, so a change in one group
+    only re-renders that group and its ancestors; every other branch comes from the cache.
+    """
+    tree_name = None
+    uses_accounts = False
+
+    def group_label(self, group):
+        return "%s - %s" % (group.code, group.name)
+
+    def account_label(self, account):
+        return "%s - %s" % (account.code, account.name)
+
+    def build_group_tree(self, group, children_html, accounts):
+        """
+        The <li> of a group: its label, then its subgroups' fragments and its accounts, each in a <ul>.
+        Views change what a group or an account shows through group_label and account_label.
+        """
+        html_result = ["<li>%s" % self.group_label(group)]
+        for subgroup_html in children_html:
+            html_result.append("<ul>" + subgroup_html + "</ul>")
+        accounts_html = ["<li>%s</li>" % self.account_label(account) for account in accounts]
         if accounts_html:
-            html_result += "<ul>" + accounts_html + "</ul>"
-        html_result += "</li>"
-        return html_result
+            html_result.append("<ul>" + "".join(accounts_html) + "</ul>")
+        html_result.append("</li>")
+        return "".join(html_result)
+
+    def get_account_balances(self, accounts):
+        balances = Pocket.objects.filter(account__in=accounts, account_balance__gt=0).values('account').annotate(
+            balance=Sum('account_balance'))
+        return dict((entry['account'], entry['balance']) for entry in balances)
+
+    def render_book_tree(self, book):
+        book_key = 'korova-tree-%s-%s-%s' % (self.tree_name, book.pk, Book.get_version(book.pk))
+        book_html = cache.get(book_key)
+        if book_html is not None:
+            return book_html
+
+        groups = list(Group.objects.filter(book=book).order_by('pk'))
+        children = {}
+        for group in groups:
+            children.setdefault(group.parent_id, []).append(group)
+
+        keys = {}
+
+        def compute_key(group):
+            child_keys = [compute_key(child) for child in children.get(group.pk, [])]
+            raw = '%s|%s|%s|%s' % (self.tree_name, group.pk, group.version, ','.join(child_keys))
+            keys[group.pk] = 'korova-tree-group-' + hashlib.md5(raw).hexdigest()
+            return keys[group.pk]
+
+        top_level = children.get(None, [])
+        for group in top_level:
+            compute_key(group)
+
+        fragments = cache.get_many(keys.values())
+        missing = [group for group in groups if group.pk in keys and keys[group.pk] not in fragments]
+
+        accounts = {}
+        if self.uses_accounts and missing:
+            group_accounts = list(Account.objects.filter(group__in=missing).select_related('currency').order_by('pk'))
+            balances = self.get_account_balances(group_accounts)
+            for account in group_accounts:
+                account.balance = balances.get(account.pk, DECIMAL_ZERO)
+                accounts.setdefault(account.group_id, []).append(account)
+
+        rendered = {}
+
+        def render(group):
+            key = keys[group.pk]
+            if key not in fragments:
+                children_html = [render(child) for child in children.get(group.pk, [])]
+                fragments[key] = self.build_group_tree(group, children_html, accounts.get(group.pk, []))
+                rendered[key] = fragments[key]
+            return fragments[key]
+
+        book_html = "<ul>" + "".join(render(group) for group in top_level) + "</ul>"
+        if rendered:
+            cache.set_many(rendered)
+        cache.set(book_key, book_html)
+        return book_html
+
+
+class AccountView(GroupTreeMixin, KorovaEntityView):
+    list_template = LazyTemplate('website/account/list.html')
+    form_template = LazyTemplate('website/account/form.html')
+    tree_name = 'account'
+    uses_accounts = True
+
+    def account_label(self, account):
+        return "%s - %s - %s %s    <a href=\"/account/%d/delete_object\">delete</a>" % (
+            account.code, account.name, account.balance, account.currency.code, account.pk)
 
     def delete_object(self, request, pk, action):
         account = Account.objects.get(pk=pk)
-        account.delete()
+        delete_or_hide(request, account)
         return redirect('/account')
 
     def add_object(self, request):
         form = AccountForm(request.POST)
+        if not form.is_valid():
+            return self.render_form(request, form)
         new_account = form.save()
         return redirect('/account')
 
     def show_form(self, request, pk=None):
-        profile = request.user.profile
-        form = AccountForm()
+        return self.render_form(request, AccountForm())
+
+    def render_form(self, request, form):
         form.fields['group'].queryset = Group.objects.filter(book=Book.get_active_book(request)).order_by('code')
         context = KorovaRequestContext(request, {'form' : form})
         return HttpResponse(self.form_template.render(context))
 
     def list_objects(self, request):
         book = Book.get_active_book(request)
-        book_html = "<ul>"
-        for group in book.groups.filter(parent=None):
-            book_html += self.build_group_tree(group)
-        book_html += "</ul>"
+        book_html = self.render_book_tree(book)
         context = KorovaRequestContext(request, {'book_html' : book_html})
         return HttpResponse(self.list_template.render(context))
 
 
-class GroupView(KorovaEntityView):
-    list_template = loader.get_template('website/group/list.html')
-    form_template = loader.get_template('website/group/form.html')
+class GroupView(GroupTreeMixin, KorovaEntityView):
+    list_template = LazyTemplate('website/group/list.html')
+    form_template = LazyTemplate('website/group/form.html')
+    tree_name = 'group'
 
-    def build_group_tree(self, group, html_result=""):
-        original = html_result
-        html_result += "<li>%s - %s - - <a href=\"/account/%d/delete_object\">delete</a>" % (group.code, group.name,
-                                                                                             group.pk)
-        for subgroup in group.children.all():
-            html_result += "<ul>" + self.build_group_tree(subgroup, original) + "</ul>"
-        return html_result
+    def group_label(self, group):
+        return "%s - %s - - <a href=\"/group/%d/delete_object\">delete</a>" % (group.code, group.name, group.pk)
 
     def add_object(self, request):
         form = GroupForm(request.POST)
-        print 'is_valid: ' + str(form.is_valid())
+        if not form.is_valid():
+            return self.render_form(request, form)
         new_group = Group(**form.cleaned_data)
         profile = request.user.profile
         new_group.book = Book.get_active_book(request)
@@ -188,31 +299,29 @@ class GroupView(KorovaEntityView):
         return redirect('/group')
 
     def show_form(self, request, pk=None):
-        profile = request.user.profile
-        form = GroupForm()
+        return self.render_form(request, GroupForm())
+
+    def render_form(self, request, form):
         form.fields['parent'].queryset = Group.objects.filter(book=Book.get_active_book(request)).order_by('code')
         context = KorovaRequestContext(request, {'form' : form})
         return HttpResponse(self.form_template.render(context))
 
     def delete_object(self, request, pk, action):
         group = Group.objects.get(pk=pk)
-        group.delete()
+        delete_or_hide(request, group)
         return redirect('/group')
 
     def list_objects(self, request):
         profile = request.user.profile
         book = Book.get_active_book(request)
-        book_html = "<ul>"
-        for group in book.groups.filter(parent=None):
-            book_html += self.build_group_tree(group)
-        book_html += "</ul>"
+        book_html = self.render_book_tree(book)
         context = KorovaRequestContext(request, {'book_html' : book_html})
         return HttpResponse(self.list_template.render(context))
 
 
 class TransactionView(KorovaEntityView):
-    list_template = loader.get_template("website/transaction/list.html")
-    form_template = loader.get_template("website/transaction/form.html")
+    list_template = LazyTemplate("website/transaction/list.html")
+    form_template = LazyTemplate("website/transaction/form.html")
 
     def list_objects(self, request):
         context = KorovaRequestContext(request, {})
@@ -230,7 +339,7 @@ class TransactionView(KorovaEntityView):
                                               extra=6)
         transaction_form = TransactionForm(request.POST)
         credit_formset = _CreditFormSet(request.POST, request.FILES, prefix='credit')
-        debit_formset = _CreditFormSet(request.POST, request.FILES, prefix='debit')
+        debit_formset = _DebitFormSet(request.POST, request.FILES, prefix='debit')
 
         splits = []
         date = transaction_form.data['transaction_date'] + ' 00:00'